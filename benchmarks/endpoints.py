@@ -0,0 +1,216 @@
+"""
+Latency and throughput of the API resources on a synthetic cookbook, run
+through the Flask test client. From the repository root:
+
+    python -m benchmarks.endpoints --recipes 5000 --output baseline.json
+    python -m benchmarks.endpoints --recipes 5000 --compare baseline.json
+
+Each run creates a throwaway database, fills it with SyntheticCookbook,
+sends ``--requests`` GET requests to every resource and writes the
+results as JSON. ``--compare`` reports the resources whose p95 latency or
+throughput got worse than ``--threshold`` percent against an earlier run,
+and exits with status 1 if there are any.
+"""
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from database import create_app, db
+from database.models import Recipe, User
+from database.synthetic import SyntheticCookbook, zipf_weights
+
+# Path of a request to each resource, given a random generator, the
+# cookbook and the (user, recipe) name pairs of the recipes that have an
+# owner. Names are drawn with the same skew the data was generated with,
+# so popular recipes and users are requested more often.
+RESOURCES = {
+    "recipecollection": lambda pick, book, owned: "/api/recipes/",
+    "recipeitem": lambda pick, book, owned: "/api/recipes/{}/".format(
+        book.recipe_name(pick(book.recipes))),
+    "userrecipecollection": lambda pick, book, owned: "/api/{}/".format(
+        book.user_name(pick(book.users))),
+    "userrecipe": lambda pick, book, owned: "/api/{}/{}/".format(*owned[pick(len(owned))]),
+    "usercollection": lambda pick, book, owned: "/api/users",
+    "ingredients": lambda pick, book, owned: "/api/ingredients",
+    "recipeingredients": lambda pick, book, owned: "/api/recipeingredients/",
+    "recipesearch": lambda pick, book, owned: "/api/recipes/search?q=bake+golden",
+    "recipematch": lambda pick, book, owned: "/api/recipes/match?ingredients={},{},{}&missing=2".format(
+        *(book.ingredient_name(pick(book.ingredients)) for _ in range(3))),
+    "recipebatch": lambda pick, book, owned: "/api/recipes/batch?names={}".format(
+        ",".join(book.recipe_name(pick(book.recipes)) for _ in range(10))),
+    "userrecommendations": lambda pick, book, owned: "/api/{}/recommendations".format(
+        book.user_name(pick(book.users))),
+    "shoppinglist": lambda pick, book, owned: "/api/{}/shopping-list?recipes={}".format(
+        book.user_name(pick(book.users)), ",".join(book.recipe_name(pick(book.recipes)) for _ in range(3))),
+    "recipeexport": lambda pick, book, owned: "/api/export",
+}
+
+
+def percentile(quantiles, number):
+    return quantiles[number - 1]
+
+def summarize(durations, errors):
+    """
+    Latency statistics in milliseconds of one resource's ``durations``,
+    given in seconds.
+    """
+    total = sum(durations)
+    quantiles = statistics.quantiles(durations, n=100, method="inclusive")
+    return {
+        "requests": len(durations),
+        "errors": errors,
+        "seconds": round(total, 6),
+        "throughput": round(len(durations) / total, 2) if total else None,
+        "mean_ms": round(statistics.mean(durations) * 1000, 3),
+        "p50_ms": round(percentile(quantiles, 50) * 1000, 3),
+        "p95_ms": round(percentile(quantiles, 95) * 1000, 3),
+        "p99_ms": round(percentile(quantiles, 99) * 1000, 3),
+        "max_ms": round(max(durations) * 1000, 3),
+    }
+
+def measure(client, paths):
+    durations = []
+    errors = 0
+    for path in paths:
+        start = time.perf_counter()
+        response = client.get(path)
+        response.get_data()
+        durations.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            errors += 1
+    return summarize(durations, errors)
+
+def run(database_path, book, requests=100, warmup=20, seed=0, config=None):
+    """
+    Creates an app on ``database_path``, writes ``book`` into it and
+    measures every resource in RESOURCES. Returns the JSON report.
+
+    The response cache is off unless ``config`` turns it on: most paths
+    repeat between requests, so with it the report would time cache hits
+    instead of the resources.
+    """
+    config = {"RESPONSE_CACHE_SIZE": 0, **(config or {})}
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///{}".format(database_path),
+        **config,
+    })
+    missing = set(RESOURCES) - set(app.view_functions)
+    if missing:
+        raise ValueError("No such resources: {}".format(", ".join(sorted(missing))))
+
+    with app.app_context():
+        start = time.perf_counter()
+        with db.engine.begin() as connection:
+            counts = book.write(connection)
+        generate_seconds = time.perf_counter() - start
+        owned = db.session.query(User.name, Recipe.name).join(Recipe, Recipe.user_id == User.id).order_by(
+            Recipe.id
+        ).all()
+
+    rng = random.Random(seed)
+    weights = {}
+
+    def pick(count):
+        if count not in weights:
+            weights[count] = zipf_weights(count)
+        return rng.choices(range(count), cum_weights=weights[count])[0]
+
+    client = app.test_client()
+    results = {}
+    for endpoint, path in RESOURCES.items():
+        for _ in range(warmup):
+            client.get(path(pick, book, owned))
+        results[endpoint] = measure(client, [path(pick, book, owned) for _ in range(requests)])
+        results[endpoint]["example"] = path(pick, book, owned)
+
+    return {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "config": {
+            "users": book.users,
+            "recipes": book.recipes,
+            "ingredients": book.ingredients,
+            "rows_per_recipe": book.rows_per_recipe,
+            "seed": book.seed,
+            "requests": requests,
+            "warmup": warmup,
+            "app": config,
+        },
+        "rows": counts,
+        "generate_seconds": round(generate_seconds, 3),
+        "results": results,
+    }
+
+def compare(old, new, threshold=10.0):
+    """
+    Lines describing the resources of report ``new`` that are more than
+    ``threshold`` percent slower at p95, or have that much less
+    throughput, than in report ``old``.
+    """
+    regressions = []
+    for endpoint, result in new["results"].items():
+        before = old["results"].get(endpoint)
+        if before is None:
+            continue
+        p95 = (result["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100
+        if p95 > threshold:
+            regressions.append("{}: p95 {:.3f} ms -> {:.3f} ms ({:+.1f}%)".format(
+                endpoint, before["p95_ms"], result["p95_ms"], p95))
+        if before["throughput"] and result["throughput"]:
+            throughput = (result["throughput"] - before["throughput"]) / before["throughput"] * 100
+            if throughput < -threshold:
+                regressions.append("{}: throughput {:.1f}/s -> {:.1f}/s ({:+.1f}%)".format(
+                    endpoint, before["throughput"], result["throughput"], throughput))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--recipes", type=int, default=2000)
+    parser.add_argument("--ingredients", type=int, default=300)
+    parser.add_argument("--rows-per-recipe", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=100, help="Measured requests per resource.")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests per resource.")
+    parser.add_argument("--profile", choices=["default", "production"], default="default",
+                        help="DATABASE_PROFILE of the app.")
+    parser.add_argument("--response-cache", type=int, default=0, metavar="SIZE",
+                        help="Measure with a response cache of SIZE entries, off by default.")
+    parser.add_argument("--output", type=Path, help="File to write the JSON report to, stdout by default.")
+    parser.add_argument("--compare", type=Path, help="Earlier report to check for regressions.")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Regression threshold in percent.")
+    args = parser.parse_args(argv)
+    if args.requests < 2:
+        parser.error("--requests must be at least 2")
+
+    config = {"DATABASE_PROFILE": args.profile, "RESPONSE_CACHE_SIZE": args.response_cache}
+    book = SyntheticCookbook(args.users, args.recipes, args.ingredients, args.rows_per_recipe, args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        report = run(Path(directory) / "benchmark.db", book, args.requests, args.warmup, args.seed, config)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        regressions = compare(json.loads(args.compare.read_text()), report, args.threshold)
+        for line in regressions:
+            print(line, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
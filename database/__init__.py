@@ -1,46 +1,89 @@
-import json
-from flask_sqlalchemy import SQLAlchemy
 from flask_restful import Api
-from flask import Flask, request
+from flask import Flask
 
+from .engine import CookbookSQLAlchemy, apply_engine_profile, configure_engines
 
-db = SQLAlchemy()
 
+db = CookbookSQLAlchemy()
 
-def create_app():
+
+def create_app(test_config=None):
     """Construct the core application."""
     app = Flask(__name__)
     app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///cookbook.db"
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config["DATABASE_PROFILE"] = "default"
+    if test_config is not None:
+        app.config.update(test_config)
+    apply_engine_profile(app)
 
     db.init_app(app)
 
     with app.app_context():
+        configure_engines(app, db.engine)
 
         from . import models
-        from .api_routes import recipe_route, populate_route, ingredient_route, user_route, recipe_ingredients
+        from .api_routes import recipe_route, populate_route, ingredient_route, user_route, recipe_ingredients, search_route, match_route, import_route, export_route, metrics_route, recommend_route, job_route, shopping_route, recipe_batch_route, batch_route
+        from .search import create_search_index
+        from .migrations import run_migrations
+        from .matching import init_ingredient_index
+        from .recommend import init_recommender
+        from .caching import init_response_cache
+        from .compression import init_compression
+        from .identity import init_identity_cache
+        from .commands import register_commands
+        from .engine import read_engine
+        from .timing import dumps, init_timing, output_json
+        from .metrics import init_metrics
+        from .jobs import init_jobs
+        from .admission import init_admission
         from database.builders.builders import RecipeBuilder, RecipeConverter, RecipeItem, RecipeCollection, UserConverter, UserRecipe, UserRecipeCollection
 
         db.create_all()  # Create database tables for our data models
+        run_migrations(db.engine)
+        create_search_index(db.engine)
+        init_ingredient_index(app, db.session)
+        init_recommender(app, db.session)
+        init_response_cache(app, db.session)
+        init_compression(app)
+        init_identity_cache(app, db.session)
+        register_commands(app)
+        init_timing(app, [db.engine, read_engine()])
+        init_metrics(app, {"write": db.engine, "read": read_engine()})
+        init_jobs(app, db.session)
 
         api = Api(app)
+        api.representations["application/json"] = output_json
 
         api.add_resource(populate_route.Populate, "/api/populate")
+        api.add_resource(import_route.RecipeImport, "/api/import")
+        api.add_resource(export_route.RecipeExport, "/api/export")
+        api.add_resource(metrics_route.Metrics, "/api/metrics")
+        api.add_resource(job_route.JobCollection, "/api/jobs")
+        api.add_resource(job_route.JobItem, "/api/jobs/<int:job>")
+        api.add_resource(job_route.JobResult, "/api/jobs/<int:job>/result")
+        api.add_resource(batch_route.Batch, "/api/batch")
         api.add_resource(ingredient_route.Ingredients, "/api/ingredients")
         api.add_resource(user_route.UserCollection, "/api/users")
         api.add_resource(recipe_ingredients.Recipeingredients, "/api/recipeingredients/")
         api.add_resource(RecipeCollection, "/api/recipes/")
+        api.add_resource(search_route.RecipeSearch, "/api/recipes/search")
+        api.add_resource(match_route.RecipeMatch, "/api/recipes/match")
+        api.add_resource(recipe_batch_route.RecipeBatch, "/api/recipes/batch")
         app.url_map.converters["recipe"] = RecipeConverter
         app.url_map.converters["user"] = UserConverter
         api.add_resource(RecipeItem, "/api/recipes/<recipe:recipe>/")
         api.add_resource(UserRecipeCollection, "/api/<user:user>/")
+        api.add_resource(recommend_route.UserRecommendations, "/api/<user:user>/recommendations")
+        api.add_resource(shopping_route.ShoppingList, "/api/<user:user>/shopping-list")
         api.add_resource(UserRecipe, "/api/<user:user>/<recipe:recipe>/")
 
         @app.route("/api/")
         def view():
             bob = RecipeBuilder()
             bob.add_control_recipes_all()
-            return json.dumps(bob)
+            bob.add_control_search_recipes()
+            return dumps(bob)
 
         @app.route("/profiles/<profile_name>")
         def redirect_to_profile(profile_name):
@@ -50,4 +93,7 @@ def create_app():
         def send_link_relations_html():
             return "here be link relations"
 
+        # Last, it wraps the app with every route in place
+        init_admission(app)
+
         return app
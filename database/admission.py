@@ -0,0 +1,309 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+from werkzeug.wrappers import Request, Response
+from werkzeug.wsgi import ClosingIterator
+
+from .builders.builders import ERROR_PROFILE, MASON, MasonBuilder
+from .metrics import get_metrics, process_alive
+from .timing import dumps
+
+_EXTENSION = "cookbook_admission"
+
+# Tokens a client gets back per second and the most it can save up. A
+# request takes the cost of its endpoint from the bucket of its client.
+RATE = 20.0
+BURST = 100.0
+DEFAULT_COST = 1
+# Endpoints that read or write a lot of rows cost more than an item read.
+# Merged with the ADMISSION_COSTS config value.
+ENDPOINT_COSTS = {
+    "recipecollection": 5,
+    "userrecipecollection": 5,
+    "usercollection": 10,
+    "recipeingredients": 10,
+    "ingredients": 5,
+    "recipesearch": 3,
+    "recipematch": 5,
+    "userrecommendations": 5,
+    "shoppinglist": 3,
+    "recipebatch": 5,
+    "batch": 5,
+    "recipeexport": 50,
+    "recipeimport": 50,
+    "populate": 50,
+    "metrics": 0,
+}
+# Requests handled at once by all the workers together before the rest
+# are turned away with 503
+MAX_CONCURRENT = 32
+# Seconds a client turned away for load is asked to wait
+OVERLOAD_RETRY_AFTER = 1
+BUCKET_SLOTS = 4096
+PROCESS_SLOTS = 256
+# Slots looked at for a client before the least recently used one is reused
+PROBE = 8
+
+_PROCESS = struct.Struct("<qq")
+_BUCKET = struct.Struct("<Qdd")
+# Converters of this app that look rows up; the admission map matches
+# their segments as plain strings
+_CONVERTER = re.compile(r"<(\w+)(\([^)]*\))?:")
+
+
+class AdmissionState:
+    """
+    Token buckets of the clients and the requests in progress of every
+    process, in a file all the workers map into memory. Changes are made
+    under an exclusive flock of the file, taken together with a thread
+    lock as flock does not keep threads of one process apart.
+
+    The file starts with a (pid, requests in progress) slot per process,
+    followed by an open addressing table of (client hash, tokens, last
+    update) buckets.
+    """
+
+    def __init__(self, path, slots=BUCKET_SLOTS):
+        self.path = path
+        self.slots = slots
+        self.size = PROCESS_SLOTS * _PROCESS.size + slots * _BUCKET.size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._process_slot = None
+
+    def _open(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # An open file description is shared with the fork it came
+            # from, and so would be its flock, so every process opens its own
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size < self.size:
+                    os.ftruncate(self._fd, self.size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(self._fd, self.size)
+            self._process_slot = None
+            self._pid = pid
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _processes(self):
+        for slot in range(PROCESS_SLOTS):
+            yield slot, _PROCESS.unpack_from(self._map, slot * _PROCESS.size)
+
+    def _own_slot(self):
+        if self._process_slot is None:
+            free = None
+            for slot, (pid, _) in self._processes():
+                if pid == self._pid:
+                    self._process_slot = slot
+                    break
+                if free is None and (pid == 0 or not process_alive(pid)):
+                    free = slot
+            else:
+                if free is None:
+                    return None
+                _PROCESS.pack_into(self._map, free * _PROCESS.size, self._pid, 0)
+                self._process_slot = free
+        return self._process_slot
+
+    def _in_progress(self, purge=False):
+        total = 0
+        for slot, (pid, requests) in self._processes():
+            if pid and purge and not process_alive(pid):
+                # A worker that died mid-request never gave its slots back
+                _PROCESS.pack_into(self._map, slot * _PROCESS.size, 0, 0)
+                continue
+            total += requests
+        return total
+
+    def enter(self, limit):
+        """
+        Counts a request of this process as in progress unless ``limit``
+        requests already are. Call with the lock held.
+        """
+        slot = self._own_slot()
+        if slot is None:
+            return True
+        if self._in_progress() >= limit and self._in_progress(purge=True) >= limit:
+            return False
+        pid, requests = _PROCESS.unpack_from(self._map, slot * _PROCESS.size)
+        _PROCESS.pack_into(self._map, slot * _PROCESS.size, pid, requests + 1)
+        return True
+
+    def leave(self):
+        with self.locked():
+            slot = self._own_slot()
+            if slot is None:
+                return
+            pid, requests = _PROCESS.unpack_from(self._map, slot * _PROCESS.size)
+            _PROCESS.pack_into(self._map, slot * _PROCESS.size, pid, max(requests - 1, 0))
+
+    def _bucket_position(self, client):
+        start = PROCESS_SLOTS * _PROCESS.size
+        oldest, oldest_update = None, None
+        for probe in range(PROBE):
+            position = start + ((client + probe) % self.slots) * _BUCKET.size
+            key, _, updated = _BUCKET.unpack_from(self._map, position)
+            if key == client or key == 0:
+                return position
+            if oldest is None or updated < oldest_update:
+                oldest, oldest_update = position, updated
+        return oldest
+
+    def take(self, client, cost, rate, burst, now):
+        """
+        Takes ``cost`` tokens from the bucket of ``client`` (a non-zero 64
+        bit hash). Returns 0 when they were there, or else the seconds
+        until they will be. Call with the lock held.
+
+        Only an unused slot starts out full. A client that takes over the
+        least recently used bucket of another also takes over its tokens,
+        so pushing others out of the table does not reset any bucket.
+        """
+        position = self._bucket_position(client)
+        key, tokens, updated = _BUCKET.unpack_from(self._map, position)
+        if key == 0:
+            tokens = burst
+        else:
+            tokens = min(burst, tokens + max(now - updated, 0.0) * rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        _BUCKET.pack_into(self._map, position, client, tokens, now)
+        return wait
+
+
+def client_key(environ, api_keys=()):
+    """
+    The client a request counts against: its API key if it sent one of
+    ``api_keys``, otherwise its address. Unknown keys are ignored, or a
+    client could get a fresh bucket with every new key it makes up.
+    """
+    api_key = environ.get("HTTP_X_API_KEY")
+    if api_key and api_key in api_keys:
+        key = "key:" + api_key
+    else:
+        key = "address:" + (environ.get("REMOTE_ADDR") or "-")
+    digest = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+    return digest or 1
+
+def admission_map(url_map):
+    """
+    A copy of ``url_map`` that tells the endpoint of a path without
+    running the app's converters, which query the database.
+    """
+    rules = []
+    for rule in url_map.iter_rules():
+        path = _CONVERTER.sub(
+            lambda match: match.group(0) if match.group(1) in Map.default_converters else "<",
+            rule.rule
+        )
+        rules.append(Rule(path, endpoint=rule.endpoint, methods=rule.methods))
+    return Map(rules)
+
+
+class AdmissionControl:
+    """
+    WSGI middleware in front of the app. It turns a request away with 429
+    when its client has run out of tokens, or with 503 when MAX_CONCURRENT
+    requests are already in progress. Either way it happens before routing,
+    so no converter or handler touches the database.
+    """
+
+    def __init__(self, app, wsgi_app, state):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.state = state
+        self.costs = {**ENDPOINT_COSTS, **app.config.get("ADMISSION_COSTS", {})}
+        self.rate = app.config.get("ADMISSION_RATE", RATE)
+        self.burst = app.config.get("ADMISSION_BURST", BURST)
+        self.limit = app.config.get("ADMISSION_MAX_CONCURRENT", MAX_CONCURRENT)
+        self.api_keys = frozenset(app.config.get("ADMISSION_API_KEYS", ()))
+        self._map = None
+
+    def endpoint(self, environ):
+        if self._map is None:
+            # Built on first use, once every resource has been added
+            self._map = admission_map(self.app.url_map)
+        try:
+            endpoint, _ = self._map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        return endpoint
+
+    def reject(self, environ, status_code, title, message, retry_after, endpoint, reason):
+        with self.app.app_context():
+            get_metrics().inc("cookbook_admission_rejected_total", (
+                ("endpoint", endpoint or "none"), ("reason", reason)
+            ))
+        data = MasonBuilder(resource_url=Request(environ).path)
+        data.add_error(title, message)
+        data.add_control("profile", href=ERROR_PROFILE)
+        return Response(
+            dumps(data), status_code, mimetype=MASON, headers={"Retry-After": str(retry_after)}
+        )
+
+    def __call__(self, environ, start_response):
+        endpoint = self.endpoint(environ)
+        cost = min(self.costs.get(endpoint, DEFAULT_COST), self.burst)
+        with self.state.locked():
+            if not self.state.enter(self.limit):
+                response = self.reject(
+                    environ, 503, "Service unavailable", "The server is busy, try again shortly",
+                    OVERLOAD_RETRY_AFTER, endpoint, "overload"
+                )
+                return response(environ, start_response)
+            wait = 0.0
+            if cost > 0:
+                wait = self.state.take(client_key(environ, self.api_keys), cost, self.rate, self.burst, time.time())
+        if wait:
+            self.state.leave()
+            response = self.reject(
+                environ, 429, "Too many requests", "Request rate limit exceeded",
+                math.ceil(wait), endpoint, "rate"
+            )
+            return response(environ, start_response)
+        try:
+            return ClosingIterator(self.wsgi_app(environ, start_response), [self.state.leave])
+        except BaseException:
+            self.state.leave()
+            raise
+
+
+def init_admission(app):
+    """
+    Puts admission control in front of ``app`` when ADMISSION_CONTROL is
+    set. The state file, ADMISSION_FILE, must be shared by every worker;
+    by default it goes to the metrics directory, which already is. Call
+    within an app context.
+    """
+    if not app.config.get("ADMISSION_CONTROL", False):
+        return
+    path = app.config.get("ADMISSION_FILE") or os.path.join(get_metrics().directory, "admission.db")
+    state = app.extensions[_EXTENSION] = AdmissionState(path, app.config.get("ADMISSION_SLOTS", BUCKET_SLOTS))
+    app.wsgi_app = AdmissionControl(app, app.wsgi_app, state)
@@ -0,0 +1,278 @@
+from flask import Response, request
+from flask_restful import Resource
+from sqlalchemy.exc import IntegrityError
+
+from ..models import Ingredient, Recipe, Recipeingredient, Unit, db
+from ..identity import find_by_name
+from ..validation import compile_schema, validation_error
+from ..timing import dumps
+from ..builders.builders import ERROR_PROFILE, MASON, MasonBuilder, create_error_response
+
+MAX_BATCH_OPERATIONS = 100
+
+RECIPEINGREDIENT_KEY = {
+    "type": "object",
+    "required": ["id", "ingredient_id", "unit_id"],
+    "properties": {
+        "id": {"type": ["integer", "string"]},
+        "ingredient_id": {"type": ["integer", "string"]},
+        "unit_id": {"type": "integer"},
+    },
+    "additionalProperties": False,
+}
+
+BATCH_SCHEMA = {
+    "type": "object",
+    "required": ["operations"],
+    "properties": {
+        "operations": {
+            "type": "array",
+            "minItems": 1,
+            "maxItems": MAX_BATCH_OPERATIONS,
+            "items": {
+                "type": "object",
+                "required": ["op", "type"],
+                "properties": {
+                    "op": {"enum": ["create", "update", "delete"]},
+                    "type": {"enum": ["recipe", "ingredient", "recipeingredient"]},
+                    "target": {
+                        "description": "Name of the recipe or ingredient, or the id, ingredient_id "
+                                       "and unit_id of the recipe ingredient to update or delete",
+                        "type": ["string", "object"],
+                    },
+                    "data": {
+                        "description": "The document a create or update would send to the "
+                                       "resource on its own",
+                        "type": "object",
+                    },
+                },
+                "additionalProperties": False,
+            },
+        },
+    },
+    "additionalProperties": False,
+}
+
+MODELS = {
+    "recipe": Recipe,
+    "ingredient": Ingredient,
+    "recipeingredient": Recipeingredient,
+}
+
+# Recipe ingredient fields that may name the row created by an earlier
+# operation as "$<index>", with the type that operation has to create
+REFERENCES = {"id": "recipe", "ingredient_id": "ingredient"}
+
+_validator = compile_schema(BATCH_SCHEMA)
+_key_validator = compile_schema(RECIPEINGREDIENT_KEY)
+
+
+class OperationError(Exception):
+    """
+    Raised when an operation of a batch cannot be carried out. The whole
+    batch is rolled back and the client is told which operation failed.
+    """
+
+    def __init__(self, status_code, title, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.title = title
+        self.message = message
+        self.index = None
+
+
+def _reference(value, index):
+    """
+    The operation index a "$<index>" string refers to, or None for values
+    that are not references. Raises ValueError for strings that do not
+    name an earlier operation.
+    """
+    if not isinstance(value, str):
+        return None
+    if not value.startswith("$") or not value[1:].isdigit() or int(value[1:]) >= index:
+        raise ValueError
+    return int(value[1:])
+
+def check_operation(operations, index):
+    """
+    Validates operation ``index`` of the batch without touching the
+    database. Returns an error message, or None.
+    """
+    operation = operations[index]
+    kind, model = operation["op"], MODELS[operation["type"]]
+    if kind == "create" and "target" in operation:
+        return "create takes no target"
+    if kind != "create" and "target" not in operation:
+        return "{} needs a target".format(kind)
+    if kind == "delete" and "data" in operation:
+        return "delete takes no data"
+    if kind != "delete" and "data" not in operation:
+        return "{} needs data".format(kind)
+
+    documents = [operation.get("data", {})]
+    if "target" in operation:
+        if model is Recipeingredient:
+            error = next(_key_validator.iter_errors(operation["target"]), None)
+            if error is not None:
+                return "target: " + error.message
+            documents.append(operation["target"])
+        elif not isinstance(operation["target"], str):
+            return "target must be the name of the {}".format(operation["type"])
+    if model is Recipeingredient:
+        for document in documents:
+            for field, referenced in REFERENCES.items():
+                try:
+                    position = _reference(document.get(field), index)
+                except ValueError:
+                    return "{} must be an id or an earlier operation as $<index>".format(field)
+                if position is None:
+                    continue
+                if operations[position]["op"] != "create" or operations[position]["type"] != referenced:
+                    return "{} of operation {} does not create a {}".format(field, position, referenced)
+    if "data" in operation:
+        data = dict(operation["data"])
+        if model is Recipeingredient:
+            # Stands in for the id the referenced create will get
+            data.update({field: 0 for field in REFERENCES if isinstance(data.get(field), str)})
+        error = validation_error(model, data)
+        if error is not None:
+            return "data: " + error.message
+    return None
+
+
+class BatchRunner:
+    """
+    Carries out the operations of one batch in the request's session. Every
+    operation is flushed on its own, so constraint violations are pinned on
+    the operation that caused them, but only the caller commits.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.created = {}
+
+    def _resolve(self, document):
+        return {
+            field: self.created[int(value[1:])].id if field in REFERENCES and isinstance(value, str) else value
+            for field, value in document.items()
+        }
+
+    def _find(self, kind, target):
+        if kind == "recipe":
+            found = find_by_name(Recipe, target)
+        elif kind == "ingredient":
+            found = self.session.query(Ingredient).filter_by(name=target).first()
+        else:
+            target = self._resolve(target)
+            found = self.session.get(
+                Recipeingredient, (target["id"], target["ingredient_id"], target["unit_id"])
+            )
+        if found is None:
+            raise OperationError(404, "Not found", "No {} {}".format(kind, target))
+        return found
+
+    def _check_references(self, data):
+        for model, key in ((Recipe, "id"), (Ingredient, "ingredient_id"), (Unit, "unit_id")):
+            if self.session.get(model, data[key]) is None:
+                raise OperationError(
+                    409, "Unknown reference", "No {} with id {}".format(model.__tablename__, data[key])
+                )
+
+    def _apply(self, index, operation):
+        kind, op = operation["type"], operation["op"]
+        data = operation.get("data")
+        if kind == "recipeingredient" and data is not None:
+            data = self._resolve(data)
+            self._check_references(data)
+
+        if op == "create":
+            if kind == "recipe":
+                row = Recipe(name=data["name"], description=data["description"])
+            elif kind == "ingredient":
+                row = Ingredient(name=data["name"])
+            else:
+                row = Recipeingredient(
+                    id=data["id"], ingredient_id=data["ingredient_id"],
+                    unit_id=data["unit_id"], amount=data.get("amount"),
+                )
+            self.session.add(row)
+            self.created[index] = row
+        else:
+            row = self._find(kind, operation["target"])
+            if op == "delete":
+                self.session.delete(row)
+            elif kind == "recipeingredient":
+                row.id, row.ingredient_id = data["id"], data["ingredient_id"]
+                row.unit_id, row.amount = data["unit_id"], data.get("amount")
+            else:
+                row.name = data["name"]
+                if kind == "recipe":
+                    row.description = data["description"]
+        try:
+            self.session.flush()
+        except IntegrityError:
+            raise OperationError(409, "Conflict", "The {} already exists".format(kind))
+
+        result = {"status": 201 if op == "create" else 204}
+        if op == "create":
+            result["id"] = row.id
+        if kind == "recipe" and op != "delete":
+            result["location"] = MasonBuilder.href("recipeitem", recipe=row.name)
+        return result
+
+    def run(self, operations):
+        """
+        Applies ``operations`` in order and returns a result for each. An
+        OperationError carries the index of the operation that failed.
+        """
+        results = []
+        for index, operation in enumerate(operations):
+            try:
+                results.append(self._apply(index, operation))
+            except OperationError as e:
+                e.index = index
+                raise
+        return results
+
+
+def batch_error(status_code, index, title, message):
+    data = MasonBuilder(resource_url=request.path, index=index)
+    data.add_error(title, message)
+    data.add_control("profile", href=ERROR_PROFILE)
+    return Response(dumps(data), status_code, mimetype=MASON)
+
+
+class Batch(Resource):
+
+    def post(self):
+        """
+        Carries out a list of creates, updates and deletes of recipes,
+        ingredients and recipe ingredients in order and in one transaction.
+        If one fails nothing is written and the error names its index.
+        """
+        body = request.get_json(silent=True)
+        if body is None:
+            return create_error_response(415, "Unsupported media type", "Requests must be JSON")
+        error = next(_validator.iter_errors(body), None)
+        if error is not None:
+            return create_error_response(400, "Invalid JSON document", error.message)
+        operations = body["operations"]
+        for index in range(len(operations)):
+            message = check_operation(operations, index)
+            if message is not None:
+                return batch_error(400, index, "Invalid operation", message)
+
+        try:
+            results = BatchRunner(db.session).run(operations)
+            db.session.commit()
+        except OperationError as e:
+            db.session.rollback()
+            return batch_error(e.status_code, e.index, e.title, e.message)
+        except IntegrityError:
+            db.session.rollback()
+            return batch_error(409, None, "Conflict", "The batch conflicts with the stored data")
+
+        data = MasonBuilder(results=results)
+        data.add_control("self", data.href("batch"))
+        data.add_control_post("storage:batch", "Run operations in one transaction", data.href("batch"), BATCH_SCHEMA)
+        return Response(dumps(data), status=200, mimetype=MASON)
@@ -0,0 +1,21 @@
+from flask import Response, current_app, request, stream_with_context
+from flask_restful import Resource
+
+from ..models import db
+from ..exporter import EXPORT_FORMATS, chunked
+from ..builders.builders import create_error_response
+
+class RecipeExport(Resource):
+
+    def get(self):
+        export_format = request.args.get("format", "ndjson")
+        if export_format not in EXPORT_FORMATS:
+            return create_error_response(400, "Unknown format", "Use one of: " + ", ".join(EXPORT_FORMATS))
+        lines, mimetype = EXPORT_FORMATS[export_format]
+        batch_size = current_app.config.get("EXPORT_BATCH_SIZE", 1000)
+        return Response(
+            stream_with_context(chunked(lines(db.session, batch_size))),
+            status=200,
+            mimetype=mimetype,
+            headers={"Content-Disposition": "attachment; filename=cookbook." + export_format}
+        )
@@ -0,0 +1,56 @@
+import os
+import uuid
+
+from flask import Response, current_app, request
+from flask_restful import Resource
+
+from ..models import db
+from ..importer import RecipeImporter
+from ..jobs import get_job_runner
+from ..matching import get_ingredient_index
+from ..timing import dumps
+from ..builders.builders import MASON, MasonBuilder, create_error_response
+from .job_route import prefers_async, start_job
+
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl", "application/json-lines")
+# Bodies larger than this, or of unknown length, are imported by a
+# background job, override with IMPORT_INLINE_MAX_BYTES
+IMPORT_INLINE_MAX_BYTES = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+class RecipeImport(Resource):
+
+    def post(self):
+        if request.mimetype not in NDJSON_TYPES:
+            return create_error_response(415, "Wrong content", "Send recipes as application/x-ndjson")
+        inline_max = current_app.config.get("IMPORT_INLINE_MAX_BYTES", IMPORT_INLINE_MAX_BYTES)
+        # A chunked body does not say how large it is, so it counts as large
+        length = request.content_length
+        if prefers_async() or length is None or length > inline_max:
+            return start_job("import", upload=self._save_upload())
+
+        importer = RecipeImporter(
+            db.session,
+            ingredient_index=get_ingredient_index(),
+            batch_size=current_app.config.get("IMPORT_BATCH_SIZE", 1000)
+        )
+        result = importer.run(request.stream)
+
+        data = MasonBuilder(**result.to_dict())
+        data.add_control("collection", data.href("recipecollection"))
+        return Response(dumps(data), status=200, mimetype=MASON)
+
+    @staticmethod
+    def _save_upload():
+        """
+        Copies the request body to the job directory for the import job,
+        which deletes it when done. Returns the file name.
+        """
+        name = "upload-{}.ndjson".format(uuid.uuid4().hex)
+        with open(os.path.join(get_job_runner().directory, name), "wb") as f:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+        return name
@@ -1,7 +1,9 @@
 from flask import current_app as app, request
 from flask_restful import Resource
+from sqlalchemy.exc import IntegrityError
 
 from ..models import db, Ingredient
+from ..builders.builders import validate_json
 
 class Ingredients(Resource):
 
@@ -20,21 +22,22 @@ class Ingredients(Resource):
             emt = "EI VITTU LÖYDY MITÄÄN!!!"
         return emt
 
+    @validate_json(Ingredient, allow_many=True)
     def post(self):
         if request.method != "POST":
             return "POST method required", 405
-        if request.json == None:
-            return "Request content type must be JSON", 415
+        documents = request.json if isinstance(request.json, list) else [request.json]
+        names = [document["name"] for document in documents]
+        if len(set(names)) != len(names):
+            return "Ingredient listed twice", 409
+        recipe_exists = db.session.query(Ingredient).filter(Ingredient.name.in_(names)).first()
+        if recipe_exists:
+            return "Ingredient already exists", 409
+        db.session.add_all([Ingredient(name=name) for name in names])
         try:
-            name_ingredient = request.json["name"]
-            recipe_exists = db.session.query(Ingredient).filter_by(name=name_ingredient).first()
-            if recipe_exists:
-                return "Ingredient already exists", 409
-        except KeyError:
-            return "Incomplete request - missing fields", 400
-        new_recipe = Ingredient(
-            name=name_ingredient
-        )
-        db.session.add(new_recipe)
-        db.session.commit()
+            db.session.commit()
+        except IntegrityError:
+            # Another request added one of the names since the check above
+            db.session.rollback()
+            return "Ingredient already exists", 409
         return " ", 201
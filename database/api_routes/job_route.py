@@ -0,0 +1,163 @@
+import json
+import os
+from datetime import datetime, timezone
+
+from flask import Response, request, send_file, url_for
+from flask_restful import Resource
+
+from ..models import Job, db
+from ..exporter import EXPORT_FORMATS
+from ..jobs import UNFINISHED, get_job_runner, interrupted, read_progress
+from ..validation import compile_schema
+from ..timing import dumps
+from ..builders.builders import MASON, MasonBuilder, create_error_response, parse_page_args
+
+# Job types that can be started with a POST to /api/jobs and their
+# parameters. Imports and generated data are started from /api/import and
+# /api/populate, which take the same input as when they run inline.
+SUBMIT_SCHEMA = {
+    "type": "object",
+    "required": ["type"],
+    "properties": {
+        "type": {"enum": ["export", "rebuild-search", "refresh"]},
+        "format": {"enum": ["ndjson", "csv"]},
+    },
+    "additionalProperties": False,
+}
+# Seconds a client polling an unfinished job is asked to wait
+POLL_INTERVAL = 1
+
+_validator = compile_schema(SUBMIT_SCHEMA)
+
+
+def prefers_async():
+    """
+    Whether the client asked for the work to be done in the background
+    with a Prefer: respond-async header (RFC 7240).
+    """
+    return any(
+        preference.strip().lower() == "respond-async"
+        for preference in request.headers.get("Prefer", "").split(",")
+    )
+
+def _timestamp(value):
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+def job_document(job):
+    """
+    Mason representation of a job. The progress of a running job comes
+    from its progress file, which is fresher than the job table.
+    """
+    status, error = job.status, job.error
+    done, total = job.done, job.total
+    if interrupted(job):
+        # Recorded as failed by the next refresh job or app start, GET
+        # requests only read
+        status, error = "failed", "Interrupted"
+    elif status in UNFINISHED:
+        done, total = read_progress(get_job_runner().directory, job.id) or (done, total)
+    data = MasonBuilder(
+        id=job.id,
+        type=job.kind,
+        status=status,
+        parameters=json.loads(job.params),
+        progress={
+            "done": done,
+            "total": total,
+            "percent": round(100.0 * done / total, 1) if total else None,
+        },
+        created=_timestamp(job.created),
+        started=_timestamp(job.started),
+        finished=_timestamp(job.finished),
+    )
+    if job.result is not None:
+        data["result"] = json.loads(job.result)
+    if error is not None:
+        data["error"] = error
+    data.add_control("self", url_for("jobitem", job=job.id))
+    data.add_control("collection", data.href("jobcollection"))
+    if job.kind == "export" and job.status == "succeeded":
+        data.add_control("result", url_for("jobresult", job=job.id), title="Download the export")
+    return data
+
+def job_response(job, status=200):
+    headers = {}
+    if job.status in UNFINISHED and not interrupted(job):
+        headers["Retry-After"] = str(POLL_INTERVAL)
+    if status == 202:
+        headers["Location"] = url_for("jobitem", job=job.id)
+        headers["Preference-Applied"] = "respond-async"
+    return Response(dumps(job_document(job)), status=status, mimetype=MASON, headers=headers)
+
+def start_job(kind, **params):
+    """
+    Queues a job and answers 202 Accepted with the job's status document.
+    """
+    job_id = get_job_runner().submit(kind, **params)
+    return job_response(db.session.get(Job, job_id), status=202)
+
+
+class JobCollection(Resource):
+
+    def get(self):
+        try:
+            limit, cursor = parse_page_args()
+        except ValueError:
+            return create_error_response(400, "Invalid pagination", "limit and cursor must be positive integers")
+        query = db.session.query(Job)
+        status = request.args.get("status")
+        if status:
+            query = query.filter_by(status=status)
+        # Newest first, the cursor is the id of the last job seen
+        if cursor:
+            query = query.filter(Job.id < cursor)
+        jobs = query.order_by(Job.id.desc()).limit(limit + 1).all()
+
+        data = MasonBuilder(items=[job_document(job) for job in jobs[:limit]])
+        data.add_control("self", url_for("jobcollection", limit=limit, status=status or None))
+        if len(jobs) > limit:
+            data.add_control("next", url_for(
+                "jobcollection", limit=limit, cursor=jobs[limit - 1].id, status=status or None
+            ))
+        data.add_control_post("storage:add-job", "Start a background job", data.href("jobcollection"), SUBMIT_SCHEMA)
+        return Response(dumps(data), status=200, mimetype=MASON)
+
+    def post(self):
+        body = request.get_json(silent=True)
+        if body is None:
+            return create_error_response(415, "Unsupported media type", "Requests must be JSON")
+        error = next(_validator.iter_errors(body), None)
+        if error is not None:
+            return create_error_response(400, "Invalid JSON document", error.message)
+        params = dict(body)
+        kind = params.pop("type")
+        if "format" in params and kind != "export":
+            return create_error_response(400, "Invalid JSON document", "Only exports take a format")
+        return start_job(kind, **params)
+
+
+class JobItem(Resource):
+
+    def get(self, job):
+        item = db.session.get(Job, job)
+        if item is None:
+            return create_error_response(404, "Not found", "No job with id {}".format(job))
+        return job_response(item)
+
+
+class JobResult(Resource):
+
+    def get(self, job):
+        item = db.session.get(Job, job)
+        if item is None or item.kind != "export" or item.status != "succeeded":
+            return create_error_response(404, "Not found", "Job {} has no file to download".format(job))
+        result = json.loads(item.result)
+        path = os.path.join(get_job_runner().directory, result["file"])
+        if not os.path.exists(path):
+            return create_error_response(404, "Not found", "The export of job {} has been deleted".format(job))
+        _, mimetype = EXPORT_FORMATS[result["format"]]
+        return send_file(
+            path, mimetype=mimetype, as_attachment=True, download_name="cookbook." + result["format"]
+        )
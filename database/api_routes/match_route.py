@@ -0,0 +1,70 @@
+from flask import Response, request, url_for
+from flask_restful import Resource
+
+from ..models import Ingredient, Recipe, db
+from ..matching import get_ingredient_index
+from ..timing import dumps
+from ..builders.builders import (
+    INVALID_FIELDS, MASON, PAGE_SIZE, MAX_PAGE_SIZE, RecipeBuilder, create_error_response, load_summary,
+    parse_summary_args, recipe_summary, representation_args
+)
+
+class RecipeMatch(Resource):
+
+    def get(self):
+        names = [name.strip() for name in request.args.get("ingredients", "").split(",") if name.strip()]
+        if not names:
+            return create_error_response(400, "Missing ingredients", "Give a comma separated ingredients list")
+        try:
+            missing = int(request.args.get("missing", 0))
+            limit = int(request.args.get("limit", PAGE_SIZE))
+            offset = int(request.args.get("offset", 0))
+            if missing < 0 or limit < 1 or offset < 0:
+                raise ValueError
+        except ValueError:
+            return create_error_response(
+                400, "Invalid parameters", "missing, limit and offset must be positive integers"
+            )
+        limit = min(limit, MAX_PAGE_SIZE)
+        try:
+            fields, controls = parse_summary_args()
+        except ValueError:
+            return create_error_response(400, "Invalid fields", INVALID_FIELDS)
+
+        available = db.session.query(Ingredient.id).filter(Ingredient.name.in_(names))
+        index = get_ingredient_index(db.session)
+        matches = index.match([row.id for row in available], missing)[offset:offset + limit + 1]
+        has_next = len(matches) > limit
+        matches = matches[:limit]
+
+        recipes = {
+            item.id: item for item in
+            load_summary(db.session.query(Recipe), fields, controls).filter(
+                Recipe.id.in_([recipe_id for recipe_id, _ in matches])
+            )
+        }
+        missing_ids = {ingredient_id for _, absent in matches for ingredient_id in absent}
+        missing_names = dict(
+            db.session.query(Ingredient.id, Ingredient.name).filter(Ingredient.id.in_(missing_ids))
+        ) if missing_ids else {}
+
+        build = RecipeBuilder(items=[])
+        for recipe_id, absent in matches:
+            if recipe_id not in recipes:
+                continue
+            build["items"].append(recipe_summary(
+                recipes[recipe_id], fields, controls,
+                missing=[missing_names.get(ingredient_id) for ingredient_id in absent]
+            ))
+        shape = dict(ingredients=",".join(names), missing=missing, limit=limit, **representation_args())
+        build.add_control("self", url_for("recipematch", offset=offset, **shape))
+        if offset > 0:
+            build.add_control("prev", url_for("recipematch", offset=max(offset - limit, 0), **shape))
+        if has_next:
+            build.add_control("next", url_for("recipematch", offset=offset + limit, **shape))
+        build.add_control("collection", build.href("recipecollection"))
+
+        return Response(
+            status=200,
+            response=dumps(build),
+            mimetype=MASON)
@@ -0,0 +1,11 @@
+from flask import Response
+from flask_restful import Resource
+
+from ..metrics import get_metrics
+
+PROMETHEUS_TEXT = "text/plain; version=0.0.4; charset=utf-8"
+
+class Metrics(Resource):
+
+    def get(self):
+        return Response(get_metrics().render(), status=200, content_type=PROMETHEUS_TEXT)
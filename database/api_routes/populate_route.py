@@ -1,20 +1,65 @@
-from flask import current_app as app, request
+from flask import Response, current_app as app, request
 from flask_restful import Resource
+from sqlalchemy.exc import IntegrityError
 
 from ..models import db, Recipe
-from ..db_creator_V2 import populate_db, get_db
+from ..db_creator_V2 import populate_db, populate_synthetic
+from ..builders.builders import MASON, MasonBuilder, create_error_response
+from ..validation import compile_schema
+from ..timing import dumps
+from .job_route import prefers_async, start_job
+
+POPULATE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "scale": {"type": "number", "exclusiveMinimum": 0},
+        "seed": {"type": "integer"},
+    },
+    "additionalProperties": False,
+}
+
+# Larger scales are generated by a background job, override with
+# POPULATE_INLINE_MAX_SCALE
+POPULATE_INLINE_MAX_SCALE = 1
+
+_validator = compile_schema(POPULATE_SCHEMA)
 
 class Populate(Resource):
 
     def __init__(self) -> None:
         super().__init__()
 
-    def get(self):
-        get_db()
-
     def post(self):
-        db_exists = db.session.query(Recipe).first()
-        if db_exists:
-            return "Database is already populated", 409
-        populate_db()
-        return " ", 201
\ No newline at end of file
+        """
+        Without a body adds the fixed test data to an empty database. With
+        {"scale": ..., "seed": ...} adds a generated cookbook instead, in the
+        background for large scales or when the client prefers
+        respond-async.
+        """
+        options = request.get_json(silent=True) or {}
+        error = next(_validator.iter_errors(options), None)
+        if error is not None:
+            return create_error_response(400, "Invalid JSON document", error.message)
+
+        if "scale" not in options:
+            db_exists = db.session.query(Recipe).first()
+            if db_exists:
+                return "Database is already populated", 409
+            populate_db()
+            return " ", 201
+
+        max_scale = app.config.get("POPULATE_MAX_SCALE", 100)
+        if options["scale"] > max_scale:
+            return create_error_response(400, "Scale too large", "Use at most {}".format(max_scale))
+        seed = options.get("seed", 0)
+        inline_max = app.config.get("POPULATE_INLINE_MAX_SCALE", POPULATE_INLINE_MAX_SCALE)
+        if prefers_async() or options["scale"] > inline_max:
+            return start_job("populate", scale=options["scale"], seed=seed)
+        try:
+            counts = populate_synthetic(options["scale"], seed)
+        except IntegrityError:
+            return create_error_response(409, "Already populated", "Seed {} has already been used".format(seed))
+
+        data = MasonBuilder(rows=counts)
+        data.add_control("collection", data.href("recipecollection"))
+        return Response(dumps(data), status=201, mimetype=MASON)
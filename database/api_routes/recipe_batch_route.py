@@ -0,0 +1,95 @@
+from flask import Response, request, url_for
+from flask_restful import Resource
+
+from ..models import Recipe, db
+from ..caching import conditional_get
+from ..engine import read_only
+from ..queries import ingredient_rows, with_ingredients
+from ..validation import compile_schema
+from ..timing import dumps
+from ..builders.builders import MASON, RecipeBuilder, create_error_response
+
+MAX_BATCH_SIZE = 100
+
+BATCH_SCHEMA = {
+    "type": "object",
+    "required": ["names"],
+    "properties": {
+        "names": {
+            "type": "array",
+            "items": {"type": "string", "minLength": 1},
+            "minItems": 1,
+            "maxItems": MAX_BATCH_SIZE,
+        },
+    },
+    "additionalProperties": False,
+}
+
+_validator = compile_schema(BATCH_SCHEMA)
+
+
+def batch_document(names):
+    """
+    The recipes called ``names`` in the order asked for, each shaped like a
+    RecipeItem with its own self control. Names that match no recipe get
+    an inline @error entry instead. The recipes and all their ingredient
+    rows are loaded with two queries however many names there are.
+    """
+    recipes = {
+        item.name: item for item in
+        with_ingredients(db.session.query(Recipe)).filter(Recipe.name.in_(set(names)))
+    }
+    items = []
+    for name in names:
+        recipe = recipes.get(name)
+        if recipe is None:
+            items.append({
+                "name": name,
+                "@error": {"@message": "Not found", "@messages": ["No recipe named {}".format(name)]},
+            })
+            continue
+        items.append({
+            "name": recipe.name,
+            "description": recipe.description,
+            "ingredients": ingredient_rows(recipe),
+            "@controls": {"self": {"href": RecipeBuilder.href("recipeitem", recipe=recipe.name)}},
+        })
+    build = RecipeBuilder(items=items, found=len(names) - sum("@error" in item for item in items))
+    build.add_control("collection", build.href("recipecollection"))
+    build.add_control_post("storage:batch", "Fetch recipes by name", build.href("recipebatch"), BATCH_SCHEMA)
+    return build
+
+
+class RecipeBatch(Resource):
+
+    @conditional_get(lambda: ["recipes", "recipeingredients", "ingredients"])
+    def get(self):
+        names = [
+            name.strip() for value in request.args.getlist("names")
+            for name in value.split(",") if name.strip()
+        ]
+        if not names:
+            return create_error_response(400, "Missing names", "Give a comma separated names list")
+        if len(names) > MAX_BATCH_SIZE:
+            return create_error_response(
+                400, "Too many recipes", "Fetch at most {} recipes per request".format(MAX_BATCH_SIZE)
+            )
+        build = batch_document(names)
+        build.add_control("self", url_for("recipebatch", names=",".join(names)))
+        return Response(dumps(build), status=200, mimetype=MASON)
+
+    @read_only
+    def post(self):
+        """
+        Same as GET for lists of names too long for a URL. Only reads, so it
+        runs on the read pool like the GET.
+        """
+        body = request.get_json(silent=True)
+        if body is None:
+            return create_error_response(415, "Unsupported media type", "Requests must be JSON")
+        error = next(_validator.iter_errors(body), None)
+        if error is not None:
+            return create_error_response(400, "Invalid JSON document", error.message)
+        build = batch_document(body["names"])
+        build.add_control("self", build.href("recipebatch"))
+        return Response(dumps(build), status=200, mimetype=MASON)
@@ -1,45 +1,58 @@
-from flask import current_app as app, request
+from flask import Response, current_app as app, request
 from flask_restful import Resource
+from sqlalchemy.exc import IntegrityError
 
-from ..models import Recipe, db, Ingredient, Recipeingredient
+from ..models import Recipe, db, Ingredient, Recipeingredient, Unit
+from ..caching import conditional_get
+from ..queries import recipes_with_ingredients, ingredient_rows
+from ..timing import output_json
+from ..builders.builders import MASON, MasonBuilder, create_error_response, validate_json
 
 class Recipeingredients(Resource):
 
     def __init__(self) -> None:
         super().__init__()
 
+    @conditional_get(lambda: ["recipes", "recipeingredients", "ingredients"])
     def get(self):
         if request.method != "GET":
             return "GET method required", 405
-        inventory = db.session.query(Recipe).all()
+        inventory = recipes_with_ingredients().all()
         emt = [
         {
             "name": item.name,
-            "Ingredients": [
-                [
-                    ingredient.name,
-#                    recipe.amount_id,
-#                    recipe.unit_id
-                ] for ingredient in db.session.query(Ingredient).filter(Recipeingredient.ingredient_id==Ingredient.id).order_by(Recipeingredient.id).all()]
+            "Ingredients": ingredient_rows(item)
         } for item in inventory]
         if emt == []:
             emt = "EI VITTU LÖYDY MITÄÄN!!!"
-        return emt
+        return output_json(emt, 200)
    
+    @validate_json(Recipeingredient)
     def post(self):
         if request.method != "POST":
             return "POST method required", 405
-        if request.json == None:
-            return "Request content type must be JSON", 415
+        # SQLite does not enforce the foreign keys, so an unknown id would
+        # be stored as an orphan row
+        for model, key in ((Recipe, "id"), (Ingredient, "ingredient_id"), (Unit, "unit_id")):
+            if db.session.get(model, request.json[key]) is None:
+                return create_error_response(
+                    409, "Unknown reference", "No {} with id {}".format(model.__tablename__, request.json[key])
+                )
+        recipe_name = db.session.get(Recipe, request.json["id"]).name
+        new_row = Recipeingredient(
+            id=request.json["id"],
+            ingredient_id=request.json["ingredient_id"],
+            unit_id=request.json["unit_id"],
+            amount=request.json.get("amount"),
+        )
+        db.session.add(new_row)
         try:
-            user_mail = request.json["id"]
-            user_name = request.json["ingredient_id"]
-        except KeyError:
-            return "Incomplete request - missing fields", 400
-        new_user = Recipeingredient(
-            id=user_name,
-            ingredient_id=user_mail,
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return "Ingredient already in recipe", 409
+        return Response(
+            status=201,
+            mimetype=MASON,
+            headers={"Location": MasonBuilder.href("recipeitem", recipe=recipe_name)}
         )
-        db.session.add(new_user)
-        db.session.commit()
-        return " ", 201
\ No newline at end of file
@@ -0,0 +1,50 @@
+from flask import Response, request, url_for
+from flask_restful import Resource
+
+from ..models import Recipe, db
+from ..recommend import get_recommender
+from ..timing import dumps
+from ..builders.builders import (
+    INVALID_FIELDS, MASON, RecipeBuilder, create_error_response, load_summary, parse_summary_args,
+    recipe_summary, representation_args
+)
+
+DEFAULT_RECOMMENDATIONS = 10
+MAX_RECOMMENDATIONS = 100
+
+class UserRecommendations(Resource):
+
+    def get(self, user):
+        try:
+            limit = int(request.args.get("limit", DEFAULT_RECOMMENDATIONS))
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            return create_error_response(400, "Invalid limit", "limit must be a positive integer")
+        limit = min(limit, MAX_RECOMMENDATIONS)
+        try:
+            fields, controls = parse_summary_args()
+        except ValueError:
+            return create_error_response(400, "Invalid fields", INVALID_FIELDS)
+
+        recommended = get_recommender(db.session).recommend(user.id, limit)
+        recipes = {
+            item.id: item for item in
+            load_summary(db.session.query(Recipe), fields, controls).filter(
+                Recipe.id.in_([recipe_id for recipe_id, _ in recommended])
+            )
+        }
+
+        build = RecipeBuilder(items=[
+            recipe_summary(recipes[recipe_id], fields, controls, score=round(score, 4))
+            for recipe_id, score in recommended if recipe_id in recipes
+        ])
+        build.add_control("self", url_for(
+            "userrecommendations", user=user.name, limit=limit, **representation_args()
+        ))
+        build.add_control("up", build.href("userrecipecollection", user=user.name))
+
+        return Response(
+            status=200,
+            response=dumps(build),
+            mimetype=MASON)
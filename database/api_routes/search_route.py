@@ -0,0 +1,52 @@
+from flask import Response, request, url_for
+from flask_restful import Resource
+
+from ..models import Recipe, db
+from ..search import search_recipe_ids
+from ..timing import dumps
+from ..builders.builders import (
+    INVALID_FIELDS, MASON, PAGE_SIZE, MAX_PAGE_SIZE, RecipeBuilder, create_error_response, load_summary,
+    parse_summary_args, recipe_summary, representation_args
+)
+
+class RecipeSearch(Resource):
+
+    def get(self):
+        query = request.args.get("q", "").strip()
+        if not query:
+            return create_error_response(400, "Missing query", "Search needs a non-empty q parameter")
+        try:
+            limit = int(request.args.get("limit", PAGE_SIZE))
+            offset = int(request.args.get("offset", 0))
+            if limit < 1 or offset < 0:
+                raise ValueError
+        except ValueError:
+            return create_error_response(400, "Invalid pagination", "limit and offset must be positive integers")
+        limit = min(limit, MAX_PAGE_SIZE)
+        try:
+            fields, controls = parse_summary_args()
+        except ValueError:
+            return create_error_response(400, "Invalid fields", INVALID_FIELDS)
+
+        ids = search_recipe_ids(db.session, query, limit + 1, offset)
+        has_next = len(ids) > limit
+        ids = ids[:limit]
+        recipes = {
+            item.id: item for item in
+            load_summary(db.session.query(Recipe), fields, controls).filter(Recipe.id.in_(ids))
+        }
+        build = RecipeBuilder(items=[recipe_summary(recipes[i], fields, controls) for i in ids if i in recipes])
+        shape = representation_args()
+        build.add_control("self", url_for("recipesearch", q=query, limit=limit, offset=offset, **shape))
+        if offset > 0:
+            build.add_control("prev", url_for(
+                "recipesearch", q=query, limit=limit, offset=max(offset - limit, 0), **shape
+            ))
+        if has_next:
+            build.add_control("next", url_for("recipesearch", q=query, limit=limit, offset=offset + limit, **shape))
+        build.add_control("collection", build.href("recipecollection"))
+
+        return Response(
+            status=200,
+            response=dumps(build),
+            mimetype=MASON)
@@ -0,0 +1,80 @@
+from flask import Response, request, url_for
+from flask_restful import Resource
+
+from ..models import Recipe, db
+from ..caching import conditional_get, user_key
+from ..shopping import shopping_list
+from ..timing import dumps
+from ..builders.builders import MASON, MasonBuilder, create_error_response
+
+MAX_SHOPPING_RECIPES = 100
+
+
+def parse_servings(count):
+    """
+    The servings of ``count`` recipes from the query string: one number for
+    every recipe in the same order, or a single number for all of them.
+    Raises ValueError for malformed values.
+    """
+    values = [float(value) for value in request.args.get("servings", "1").split(",")]
+    if len(values) == 1:
+        values = values * count
+    if len(values) != count or not all(0 < value < float("inf") for value in values):
+        raise ValueError
+    return values
+
+
+class ShoppingList(Resource):
+
+    @conditional_get(lambda user: ["recipes", "recipeingredients", "ingredients", user_key(user.id)])
+    def get(self, user):
+        names = [name.strip() for name in request.args.get("recipes", "").split(",") if name.strip()]
+        if names:
+            recipes = {
+                item.name: item for item in db.session.query(Recipe).filter(Recipe.name.in_(names))
+            }
+            unknown = [name for name in names if name not in recipes]
+            if unknown:
+                return create_error_response(404, "Recipe not found", "No recipes named " + ", ".join(unknown))
+            chosen = [recipes[name] for name in names]
+        else:
+            # Without a recipes parameter the list covers the user's own
+            chosen = db.session.query(Recipe).filter_by(user_id=user.id).order_by(Recipe.id).limit(
+                MAX_SHOPPING_RECIPES + 1
+            ).all()
+        if len(chosen) > MAX_SHOPPING_RECIPES:
+            return create_error_response(
+                400, "Too many recipes", "A shopping list takes at most {} recipes".format(MAX_SHOPPING_RECIPES)
+            )
+        try:
+            servings = parse_servings(len(chosen))
+        except ValueError:
+            return create_error_response(
+                400, "Invalid servings", "Give one positive number, or one for every recipe"
+            )
+
+        # The same recipe twice is cooked twice
+        factors = {}
+        for recipe, factor in zip(chosen, servings):
+            factors[recipe.id] = factors.get(recipe.id, 0.0) + factor
+        build = MasonBuilder(
+            recipes=[
+                {
+                    "name": recipe.name,
+                    "servings": int(factor) if factor.is_integer() else factor,
+                    "@controls": {"self": {"href": MasonBuilder.href("recipeitem", recipe=recipe.name)}},
+                }
+                for recipe, factor in zip(chosen, servings)
+            ],
+            items=shopping_list(db.session, factors) if factors else [],
+        )
+        build.add_control("self", url_for(
+            "shoppinglist", user=user.name,
+            recipes=request.args.get("recipes"), servings=request.args.get("servings")
+        ))
+        build.add_control("up", build.href("userrecipecollection", user=user.name))
+
+        return Response(
+            status=200,
+            response=dumps(build),
+            mimetype=MASON)
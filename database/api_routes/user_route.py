@@ -1,17 +1,22 @@
 from flask import current_app as app, request
 from flask_restful import Resource
 
-from ..models import User, Recipe, db
+from ..models import User, db
+from ..caching import conditional_get
+from ..queries import users_with_recipes
+from ..timing import output_json
+from ..builders.builders import validate_json
 
 class UserCollection(Resource):
 
     def __init__(self) -> None:
         super().__init__()
 
+    @conditional_get(lambda: ["users", "recipes"])
     def get(self):
         if request.method != "GET":
             return "GET method required", 405
-        inventory = db.session.query(User).join(Recipe).all()
+        inventory = users_with_recipes().all()
         emt = [
         {
             "name": item.name,
@@ -21,26 +26,22 @@ class UserCollection(Resource):
             "recipes": [
                 [
                     recipe.name
-                ] for recipe in Recipe.query.filter_by(user_id=item.id).all()]
+                ] for recipe in item.user]
         } for item in inventory]
         if emt == []:
             emt = "EI VITTU LÖYDY MITÄÄN!!!"
-        return emt
+        return output_json(emt, 200)
 
+    @validate_json(User)
     def post(self):
         if request.method != "POST":
             return "POST method required", 405
-        if request.json == None:
-            return "Request content type must be JSON", 415
-        try:
-            user_mail = request.json["email"]
-            product_handle = db.session.query(User).filter_by(email=user_mail).first()
-            if product_handle:
-                return "Name already exists", 409
-            user_name = request.json["name"]
-            user_password = request.json["password"]
-        except KeyError:
-            return "Incomplete request - missing fields", 400
+        user_mail = request.json["email"]
+        product_handle = db.session.query(User).filter_by(email=user_mail).first()
+        if product_handle:
+            return "Name already exists", 409
+        user_name = request.json["name"]
+        user_password = request.json["password"]
         new_user = User(
             name=user_name,
             email=user_mail,
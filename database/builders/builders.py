@@ -1,13 +1,17 @@
-import json
-from sqlite3 import IntegrityError
-from flask import url_for, Response, request
+from functools import wraps
+from sqlalchemy.exc import IntegrityError
+from flask import current_app, url_for, Response, request
 from flask_restful import Api, Resource
 from sqlalchemy import null
+from sqlalchemy.orm import load_only
 from database.models import Ingredient, Recipe, Recipeingredient, Unit, User
 from .. import db
+from ..caching import conditional_get, recipe_key, user_key
+from ..identity import find_by_name
+from ..validation import frozen_schema, validation_error, validation_errors_many
+from ..timing import dumps
 from werkzeug.exceptions import NotFound
 from werkzeug.routing import BaseConverter
-from jsonschema import validate, ValidationError, draft7_format_checker
 
 
 MASON = "application/vnd.mason+json"
@@ -15,10 +19,22 @@ ERROR_PROFILE = "/profiles/error-profile/"
 LINK_RELATIONS_URL = "/storage/link-relations/"
 PRODUCT_PROFILE_URL = "/profiles/product/"
 JSON = "application/json"
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+URL_TEMPLATES = "cookbook_url_templates"
+URL_PLACEHOLDER = "__cookbook_{}__"
+# Recipe columns that list views can be limited to with ?fields=
+SUMMARY_FIELDS = {
+    "name": Recipe.name,
+    "description": Recipe.description,
+    "difficulty": Recipe.difficulty,
+    "user_id": Recipe.user_id,
+}
+INVALID_FIELDS = "fields must list some of {}, and controls must be all or none".format(", ".join(SUMMARY_FIELDS))
 
 class RecipeConverter(BaseConverter):
     def to_python(self, recipe):
-        db_recipe = db.session.query(Recipe).filter_by(name=recipe).first()
+        db_recipe = find_by_name(Recipe, recipe)
         if db_recipe is None:
             raise NotFound
         return db_recipe
@@ -30,6 +46,26 @@ class MasonBuilder(dict):
 
     DELETE_RELATION = ""
 
+    @staticmethod
+    def href(endpoint, **values):
+        """
+        Same result as url_for(endpoint, **values) for the recipe and user
+        routes, whose converters put values into the path as they are. The
+        route is only built once per app, into a format string that later
+        calls fill in.
+        """
+        templates = current_app.extensions.setdefault(URL_TEMPLATES, {})
+        key = (request.script_root, endpoint, tuple(sorted(values)))
+        template = templates.get(key)
+        if template is None:
+            template = url_for(endpoint, **{
+                name: URL_PLACEHOLDER.format(name) for name in values
+            }).replace("{", "{{").replace("}", "}}")
+            for name in values:
+                template = template.replace(URL_PLACEHOLDER.format(name), "{" + name + "}")
+            templates[key] = template
+        return template.format(**values)
+
     def add_error(self, title, details):
 
         self["@error"] = {
@@ -90,31 +126,40 @@ class RecipeBuilder(MasonBuilder):
     def add_control_recipes_all(self):
         self.add_control(
             ctrl_name="storage:recipes-all",
-            href=url_for("recipecollection"),
+            href=self.href("recipecollection"),
             title="All recipes",
             method="GET",
             encoding="JSON"
         )
 
+    def add_control_search_recipes(self):
+        self.add_control(
+            ctrl_name="storage:search-recipes",
+            href=self.href("recipesearch") + "?q={query}",
+            title="Search recipes by name, description or ingredient",
+            method="GET",
+            isHrefTemplate=True
+        )
+
     def add_control_add_recipe(self):
         self.add_control_post(
             ctrl_name="storage:add-recipe",
             title="Add a new recipe",
-            href=url_for("recipecollection"),
-            schema=Recipe.json_schema()
+            href=self.href("recipecollection"),
+            schema=frozen_schema(Recipe)
         )
 
     def add_control_delete_recipe(self, recipe_name):
         self.add_control_delete(
             "storage:delete",
-            url_for("recipeitem", recipe=recipe_name.name)
+            self.href("recipeitem", recipe=recipe_name.name)
         )
 
     def add_control_edit_recipe(self, recipe_name):
         self.add_control_put(
             "Edit this recipe",
-            url_for("recipeitem", recipe=recipe_name.name),
-            Recipe.json_schema()
+            self.href("recipeitem", recipe=recipe_name.name),
+            frozen_schema(Recipe)
         )
 
 class UserBuilder(MasonBuilder):
@@ -122,7 +167,7 @@ class UserBuilder(MasonBuilder):
     def add_control_users_all(self):
         self.add_control(
             ctrl_name="storage:users-all",
-            href=url_for("usercollection"),
+            href=self.href("usercollection"),
             title="All users",
             method="GET",
             encoding="JSON"
@@ -132,79 +177,190 @@ class UserBuilder(MasonBuilder):
         self.add_control_post(
             ctrl_name="storage:add-user",
             title="Add a new user",
-            href=url_for("usercollection"),
-            schema=User.json_schema()
+            href=self.href("usercollection"),
+            schema=frozen_schema(User)
         )
 
     def add_control_delete_user(self, user):
         self.add_control_delete(
             "storage:delete",
-            url_for("user", user=user.name)
+            self.href("user", user=user.name)
         )
 
     def add_control_edit_user(self, user):
         self.add_control_put(
             "Edit this user",
-            url_for("user", user=user.name),
-            User.json_schema()
+            self.href("user", user=user.name),
+            frozen_schema(User)
         )
 
+def parse_page_args():
+    """
+    Reads the keyset pagination parameters from the query string.
+    ``cursor`` is the id of the last recipe the client has already seen,
+    so every page is an index range scan on the primary key no matter how
+    deep the client walks. Raises ValueError for malformed values.
+    """
+    limit = int(request.args.get("limit", PAGE_SIZE))
+    cursor = int(request.args.get("cursor", 0))
+    if limit < 1 or cursor < 0:
+        raise ValueError
+    return min(limit, MAX_PAGE_SIZE), cursor
+
+def paginate(query, limit, cursor):
+    """
+    Returns one keyset page of ``query`` plus the cursors for the previous
+    and next pages (None when there is no such page).
+    """
+    rows = query.filter(Recipe.id > cursor).order_by(Recipe.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    prev_cursor = None
+    if cursor > 0:
+        before = query.with_entities(Recipe.id).filter(
+            Recipe.id <= cursor
+        ).order_by(Recipe.id.desc()).limit(limit + 1).all()
+        if len(before) > limit:
+            prev_cursor = before[-1].id
+        elif before:
+            prev_cursor = 0
+    return rows, prev_cursor, next_cursor
+
+def add_page_controls(build, endpoint, limit, prev_cursor, next_cursor, **values):
+    values.update(representation_args())
+    if prev_cursor is not None:
+        build.add_control("prev", url_for(endpoint, limit=limit, cursor=prev_cursor, **values))
+    if next_cursor is not None:
+        build.add_control("next", url_for(endpoint, limit=limit, cursor=next_cursor, **values))
+
+def parse_summary_args():
+    """
+    Reads ``fields``, a comma separated sparse fieldset of SUMMARY_FIELDS,
+    and ``controls=none`` from the query string. Returns the fields to
+    include, all of them by default, and whether items get their self
+    control. Raises ValueError for unknown values.
+    """
+    fields = tuple(SUMMARY_FIELDS)
+    if "fields" in request.args:
+        fields = tuple(field.strip() for field in request.args["fields"].split(",") if field.strip())
+        if not fields or any(field not in SUMMARY_FIELDS for field in fields):
+            raise ValueError
+    controls = request.args.get("controls", "all")
+    if controls not in ("all", "none"):
+        raise ValueError
+    return fields, controls == "all"
+
+def representation_args():
+    """
+    The query parameters that shape the representation, to be carried over
+    to the prev and next links.
+    """
+    return {
+        name: request.args[name] for name in ("fields", "controls", "pretty") if name in request.args
+    }
+
+def load_summary(query, fields, controls=True):
+    """
+    Limits a Recipe query to the columns that recipe_summary needs for
+    ``fields``: the id is always loaded for paging, the name for the self
+    control. The other columns are not read from the database at all.
+    """
+    columns = [Recipe.id] + [SUMMARY_FIELDS[field] for field in fields]
+    if controls and "name" not in fields:
+        columns.append(Recipe.name)
+    return query.options(load_only(*columns))
+
+def recipe_summary(item, fields=None, controls=True, **extra):
+    """
+    Collection entry for a single recipe with the given ``fields``, all of
+    them by default, and unless ``controls`` is false its own self control.
+    """
+    data = {}
+    for field in fields or SUMMARY_FIELDS:
+        value = getattr(item, field)
+        if field == "difficulty" and value is None:
+            value = 'No difficulty rating'
+        data[field] = value
+    if controls:
+        data["@controls"] = {"self": {"href": MasonBuilder.href("recipeitem", recipe=item.name)}}
+    data.update(extra)
+    return data
+
 def create_error_response(status_code, title, message=None):
     resource_url = request.path
     data = MasonBuilder(resource_url=resource_url)
     data.add_error(title, message)
     data.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(data), status_code, mimetype=MASON)
+    return Response(dumps(data), status_code, mimetype=MASON)
+
+def validate_json(model, allow_many=False):
+    """
+    Decorator for write handlers. Rejects bodies that are not JSON with 415
+    and bodies that do not match the model's compiled schema with 400
+    before the handler runs. With ``allow_many`` a non-empty JSON array of
+    documents is also accepted and validated in a single pass.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            body = request.get_json(silent=True)
+            if body is None:
+                return create_error_response(415, "Unsupported media type", "Requests must be JSON")
+            if allow_many and isinstance(body, list):
+                if not body:
+                    return create_error_response(400, "Invalid JSON", "The list has no documents")
+                errors = validation_errors_many(model, body)
+                if errors:
+                    data = MasonBuilder(resource_url=request.path, errors=errors)
+                    data.add_error("Invalid JSON", "{} documents are invalid".format(len(errors)))
+                    data.add_control("profile", href=ERROR_PROFILE)
+                    return Response(dumps(data), 400, mimetype=MASON)
+            else:
+                error = validation_error(model, body)
+                if error is not None:
+                    return create_error_response(400, "Invalid JSON", str(error))
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 class RecipeCollection(Resource):
 
+    @conditional_get(lambda: ["recipes"])
     def get(self):
+        try:
+            limit, cursor = parse_page_args()
+        except ValueError:
+            return create_error_response(400, "Invalid pagination", "limit and cursor must be positive integers")
+        try:
+            fields, controls = parse_summary_args()
+        except ValueError:
+            return create_error_response(400, "Invalid fields", INVALID_FIELDS)
         build = RecipeBuilder(items=[])
-        inventory = db.session.query(Recipe).all()
+        inventory, prev_cursor, next_cursor = paginate(
+            load_summary(db.session.query(Recipe), fields, controls), limit, cursor
+        )
         for item in inventory:
-            if item.difficulty == None:
-                item.difficulty = 'No difficulty rating'
-            data = RecipeBuilder(
-                name=item.name,
-                description=item.description,
-                difficulty=item.difficulty,
-                user_id=item.user_id,
-
-            )
-            data.add_control("self", url_for("recipeitem", recipe=item.name))
-            build["items"].append(data)
-        build.add_control("self", href=url_for("recipecollection"))
-        build.add_control_add_recipe()
+            build["items"].append(recipe_summary(item, fields, controls))
+        build.add_control("self", href=build.href("recipecollection"))
+        add_page_controls(build, "recipecollection", limit, prev_cursor, next_cursor)
+        if controls:
+            build.add_control_search_recipes()
+            build.add_control_add_recipe()
 
         return Response(
             status=200,
-            response=json.dumps(build, indent=4, separators=(',', ': '), sort_keys=True),
+            response=dumps(build),
             mimetype=MASON)
 
+    @validate_json(Recipe)
     def post(self):
-        if request.json == None:
-            return create_error_response(415, "BAD CONTENT", "MUST BE JSON")
-        try:
-            validate(
-                request.json,
-                Recipe.json_schema(),
-                format_checker=draft7_format_checker
-            )
-        except ValidationError as e:
-            return create_error_response(
-                400,
-                "Invalid JSON",
-                str(e))
-        try:
-            p_name = request.json["name"]
-            recipe_name = Recipe.query.filter_by(name=p_name).first()
-            if recipe_name:
-                return create_error_response(409, "ON JO", "Duplicate 🥝")
-            p_weight = request.json["description"]
-            if not isinstance(p_weight, str):
-                return create_error_response(400, "Invalid values")
-        except KeyError:
-            return create_error_response(400, "KeyError")
+        p_name = request.json["name"]
+        recipe_name = Recipe.query.filter_by(name=p_name).first()
+        if recipe_name:
+            return create_error_response(409, "ON JO", "Duplicate 🥝")
+        p_weight = request.json["description"]
         try:
             new_recipe = Recipe(
             name=p_name,
@@ -213,47 +369,47 @@ class RecipeCollection(Resource):
             db.session.add(new_recipe)
             db.session.commit()
         except IntegrityError:
+            db.session.rollback()
             return create_error_response(409, "Duplicate", "Database error")
 
         return Response(
             status=201,
             mimetype=MASON,
-            headers={"Location": url_for("recipeitem", recipe=new_recipe.name)}
+            headers={"Location": MasonBuilder.href("recipeitem", recipe=new_recipe.name)}
         )
 
 class UserRecipeCollection(Resource):
 
+    @conditional_get(lambda user: [user_key(user.id)])
     def get(self, user):
+        try:
+            limit, cursor = parse_page_args()
+        except ValueError:
+            return create_error_response(400, "Invalid pagination", "limit and cursor must be positive integers")
+        try:
+            fields, controls = parse_summary_args()
+        except ValueError:
+            return create_error_response(400, "Invalid fields", INVALID_FIELDS)
         build = RecipeBuilder(items=[])
-        inventory = db.session.query(Recipe
-        ).filter_by(user_id=user.id
-        ).all()
+        inventory, prev_cursor, next_cursor = paginate(
+            load_summary(db.session.query(Recipe).filter_by(user_id=user.id), fields, controls), limit, cursor
+        )
         for item in inventory:
-            if item.difficulty == None:
-                item.difficulty = 'No difficulty rating'
-            data = RecipeBuilder(
-                name=item.name,
-                description=item.description,
-                difficulty=item.difficulty,
-                owner=user.name,
-                user_id=item.user_id,
-
-            )
-            data.add_control("self", url_for("recipeitem", recipe=item.name))
-            build["items"].append(data)
-        build.add_control("self", href=url_for("recipecollection"))
-        build.add_control_add_recipe()
+            build["items"].append(recipe_summary(item, fields, controls, owner=user.name))
+        build.add_control("self", href=build.href("recipecollection"))
+        add_page_controls(build, "userrecipecollection", limit, prev_cursor, next_cursor, user=user.name)
+        if controls:
+            build.add_control_add_recipe()
 
         return Response(
             status=200,
-            response=json.dumps(build, indent=4, separators=(',', ': '), sort_keys=True),
+            response=dumps(build),
             mimetype=MASON)
 
 class RecipeItem(Resource):
-    
+
+    @conditional_get(lambda recipe: [recipe_key(recipe.id), "ingredients"])
     def get(self, recipe):
-        recipe_name = db.session.query(Recipe).filter_by(name=recipe.name).first()
-        print(recipe_name.name)
         recipe_item = db.session.query(Ingredient.name, Recipeingredient.amount, Unit.unit).filter(Recipeingredient.ingredient_id == Ingredient.id
         ).filter(
             Recipeingredient.id == recipe.id
@@ -266,37 +422,26 @@ class RecipeItem(Resource):
         ings_all = []
         for row in recipe_item:
             ingredients.append(list(row))
-        print(ingredients)
         data = RecipeBuilder(
-            name=recipe_name.name,
-            description=recipe_name.description,
+            name=recipe.name,
+            description=recipe.description,
             ingredients=ingredients,
 
         )
         data.add_namespace("storage", LINK_RELATIONS_URL)
-        data.add_control("self", url_for("recipeitem", recipe=recipe.name))
-        data.add_control("collection", url_for("recipecollection"))
+        data.add_control("self", data.href("recipeitem", recipe=recipe.name))
+        data.add_control("collection", data.href("recipecollection"))
         data.add_control("profile", href=PRODUCT_PROFILE_URL)
         data.add_control_edit_recipe(recipe)
         data.add_control_delete_recipe(recipe)
 
-        return Response(json.dumps(data), status=200, mimetype=JSON)
+        return Response(dumps(data), status=200, mimetype=JSON)
     
+    @validate_json(Recipe)
     def put(self, recipe):
-        recipe_item = db.session.query(Recipe).filter_by(name=recipe.name).first()
-        if not recipe_item:
-            return create_error_response(404, "recipe not found")
-        try:
-            recipe_item.name = request.json["name"]
-            recipe_item.description = request.json["description"]
+        recipe.name = request.json["name"]
+        recipe.description = request.json["description"]
 
-        except TypeError:
-            return create_error_response(415, "Wrong content", "Should be JSON")
-        except KeyError:
-            return create_error_response(400, "Invalid content", "Validation fails")
-        except ValueError:
-            return create_error_response(400, "Invalid content", "Validation fails")
-        
         try:
             db.session.commit()
         except IntegrityError:
@@ -305,17 +450,13 @@ class RecipeItem(Resource):
         return Response(status=204, mimetype=MASON)
     
     def delete(self, recipe):
-        recipe_h = db.session.query(Recipe).filter_by(name=recipe.name).first()
-        if not recipe_h:
-            return create_error_response(404, "Not Found", "recipe not found")
-        
-        db.session.delete(recipe_h)
+        db.session.delete(recipe)
         db.session.commit()
         return Response(status=204, mimetype=MASON)
 
 class UserConverter(BaseConverter):
     def to_python(self, name):
-        db_user = db.session.query(User).filter_by(name=name).first()
+        db_user = find_by_name(User, name)
         if db_user is None:
             raise NotFound
         return db_user
@@ -326,10 +467,7 @@ class UserConverter(BaseConverter):
 class UserRecipe(Resource):
     
     def get(self, user, recipe):
-        recipe_item = db.session.query(Recipe
-        ).filter_by(user_id=user.id
-        ).filter_by(name=recipe.name
-        ).first()
+        recipe_item = recipe if recipe.user_id == user.id else None
         if recipe_item == None:
             return create_error_response(404, "Ei oo tollasta useria", "No such user")
         data = RecipeBuilder(
@@ -340,20 +478,16 @@ class UserRecipe(Resource):
         data.add_control_edit_recipe(recipe)
         data.add_control_delete_recipe(recipe)
 
-        return Response(json.dumps(data), status=200, mimetype=JSON)
+        return Response(dumps(data), status=200, mimetype=JSON)
     
-    def put(self, recipe):
-        recipe_item = db.session.query(Recipe).filter_by(name=recipe.name).first()
+    @validate_json(Recipe)
+    def put(self, user, recipe):
+        recipe_item = recipe if recipe.user_id == user.id else None
         if not recipe_item:
             return create_error_response(404, "recipe not found")
-        try:
-            recipe_item.name = request.json["name"]
-            recipe_item.description = request.json["description"]
-        except TypeError:
-            return create_error_response(415, "Wrong content", "Should be JSON")
-        except KeyError:
-            return create_error_response(400, "Invalid content", "Validation fails")
-        
+        recipe_item.name = request.json["name"]
+        recipe_item.description = request.json["description"]
+
         try:
             db.session.commit()
         except IntegrityError:
@@ -361,8 +495,8 @@ class UserRecipe(Resource):
             return create_error_response(status_code=409, title="Taken")
         return Response(status=204, mimetype=MASON)
     
-    def delete(self, recipe):
-        recipe_h = db.session.query(Recipe).filter_by(name=recipe.name).first()
+    def delete(self, user, recipe):
+        recipe_h = recipe if recipe.user_id == user.id else None
         if not recipe_h:
             return create_error_response(404, "Not Found", "recipe not found")
         
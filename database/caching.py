@@ -0,0 +1,205 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, request
+from sqlalchemy import event, inspect, select, text
+
+from . import db
+from .metrics import count
+from .models import Ingredient, Recipe, Recipeingredient, ResourceVersion, Unit, User
+
+_EXTENSION = "cookbook_response_cache"
+_FLUSHED = "flushed_resource_versions"
+
+_BUMP = text(
+    "INSERT INTO resource_version (key, version) VALUES (:key, 1) "
+    "ON CONFLICT (key) DO UPDATE SET version = version + 1"
+)
+
+
+class ResponseCache:
+    """
+    Bounded LRU of serialized response bodies keyed by their ETag. Since an
+    ETag changes whenever one of the versions it was derived from does,
+    entries never have to be invalidated, only evicted.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, etag):
+        with self._lock:
+            entry = self._entries.get(etag)
+            if entry is not None:
+                self._entries.move_to_end(etag)
+            return entry
+
+    def put(self, etag, body, mimetype):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[etag] = (body, mimetype)
+            self._entries.move_to_end(etag)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+def recipe_key(recipe_id):
+    return "recipe:{}".format(recipe_id)
+
+def user_key(user_id):
+    return "user:{}".format(user_id)
+
+def _old_value(obj, attribute):
+    deleted = inspect(obj).attrs[attribute].history.deleted
+    return deleted[0] if deleted else getattr(obj, attribute)
+
+def changed_keys(obj):
+    """
+    Version keys whose representation changes when ``obj`` is written.
+    """
+    if isinstance(obj, Recipe):
+        return {
+            "recipes",
+            recipe_key(obj.id),
+            user_key(obj.user_id),
+            user_key(_old_value(obj, "user_id")),
+        }
+    if isinstance(obj, Recipeingredient):
+        return {
+            "recipeingredients",
+            recipe_key(obj.id),
+            recipe_key(_old_value(obj, "id")),
+        }
+    if isinstance(obj, User):
+        return {"users", user_key(obj.id)}
+    if isinstance(obj, (Ingredient, Unit)):
+        return {"ingredients"}
+    return set()
+
+def bump_versions(connection, keys):
+    """
+    Increments the version counters of ``keys`` inside the transaction of
+    ``connection``, so they commit or roll back together with the data.
+    Returns the new version of each key.
+    """
+    keys = sorted(key for key in keys if not key.endswith(":None"))
+    if not keys:
+        return {}
+    connection.execute(_BUMP, [{"key": key} for key in keys])
+    return dict(connection.execute(
+        select(ResourceVersion.key, ResourceVersion.version).where(ResourceVersion.key.in_(keys))
+    ).all())
+
+def current_version(session, key):
+    return session.query(ResourceVersion.version).filter_by(key=key).scalar() or 0
+
+def current_versions(session, keys):
+    versions = dict(session.query(ResourceVersion.key, ResourceVersion.version).filter(
+        ResourceVersion.key.in_(keys)
+    ))
+    return {key: versions.get(key, 0) for key in keys}
+
+def flushed_versions(session):
+    """
+    The versions the current transaction moved, as {key: (version before
+    the transaction, version after it)}. Still available in after_commit
+    listeners; forgotten when the transaction ends.
+    """
+    return session.info.get(_FLUSHED, {})
+
+def _bump_flushed(session, flush_context):
+    keys = set()
+    for obj in session.new:
+        keys |= changed_keys(obj)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            keys |= changed_keys(obj)
+    for obj in session.deleted:
+        keys |= changed_keys(obj)
+    flushed = session.info.setdefault(_FLUSHED, {})
+    for key, version in bump_versions(session.connection(), keys).items():
+        before = flushed[key][0] if key in flushed else version - 1
+        flushed[key] = (before, version)
+
+def _forget_flushed(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_FLUSHED, None)
+
+def resource_etag(keys):
+    """
+    Strong ETag for the current request URL at the current versions of
+    ``keys``. Costs one primary key lookup instead of rebuilding the body.
+    """
+    versions = dict(
+        db.session.query(ResourceVersion.key, ResourceVersion.version).filter(
+            ResourceVersion.key.in_(keys)
+        )
+    )
+    digest = hashlib.sha1(request.full_path.encode("utf-8"))
+    for key in sorted(keys):
+        digest.update("|{}={}".format(key, versions.get(key, 0)).encode("utf-8"))
+    return digest.hexdigest()
+
+def encoded_etag(etag, encoding):
+    """
+    ETag of the body coded with ``encoding``. Different content codings of
+    a body are different representations and need different strong ETags.
+    """
+    return "{}-{}".format(etag, encoding)
+
+def etag_matches(etags, etag):
+    """
+    Whether the If-None-Match ``etags`` name ``etag`` in any coding.
+    """
+    return etags.contains_weak(etag) or any(
+        tag.rpartition("-")[0] == etag for tag in etags.as_set(include_weak=True)
+    )
+
+def conditional_get(version_keys):
+    """
+    Decorator for GET handlers whose representation only depends on the
+    version counters returned by ``version_keys(**kwargs)``. Answers
+    If-None-Match with 304 and serves repeated requests from the response
+    cache without running the handler.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            etag = resource_etag(version_keys(**kwargs))
+            if etag_matches(request.if_none_match, etag):
+                count("cookbook_cache_requests_total", cache="response", result="not_modified")
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            cache = current_app.extensions[_EXTENSION]
+            cached = cache.get(etag)
+            count("cookbook_cache_requests_total", cache="response",
+                  result="miss" if cached is None else "hit")
+            if cached is not None:
+                body, mimetype = cached
+                response = Response(body, status=200, mimetype=mimetype)
+            else:
+                response = func(self, *args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200:
+                    return response
+                cache.put(etag, response.get_data(), response.mimetype)
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+
+def init_response_cache(app, session):
+    """
+    Gives ``app`` its own response cache and bumps resource versions on
+    every flush of ``session``.
+    """
+    app.extensions[_EXTENSION] = ResponseCache(app.config.get("RESPONSE_CACHE_SIZE", 256))
+    if not event.contains(session, "after_flush", _bump_flushed):
+        event.listen(session, "after_flush", _bump_flushed)
+        event.listen(session, "after_transaction_end", _forget_flushed)
@@ -0,0 +1,76 @@
+import time
+
+import click
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .db_creator_V2 import RECIPES_PER_TRANSACTION, populate_db, populate_synthetic
+from .exporter import EXPORT_FORMATS
+from .migrations import LATEST_VERSION, run_migrations, schema_version
+from .models import Recipe
+
+
+def register_commands(app):
+
+    @app.cli.command("export")
+    @click.option("--format", "export_format", type=click.Choice(sorted(EXPORT_FORMATS)), default="ndjson")
+    @click.option("--output", type=click.File("w"), default="-", help="File to write, stdout by default.")
+    @click.option("--batch-size", type=int, default=1000)
+    def export_command(export_format, output, batch_size):
+        """Stream every recipe with its owner and ingredients."""
+        lines, _ = EXPORT_FORMATS[export_format]
+        for line in lines(db.session, batch_size):
+            output.write(line)
+
+    @app.cli.command("migrate")
+    def migrate_command():
+        """Apply pending schema migrations to the database."""
+        applied = run_migrations(db.engine)
+        with db.engine.connect() as conn:
+            version = schema_version(conn)
+        click.echo("Applied migrations: {}".format(applied or "none"))
+        click.echo("Schema version {} (latest {})".format(version, LATEST_VERSION))
+
+    @app.cli.command("serve")
+    @click.option("--bind", default="127.0.0.1:8000", help="Address to listen on.")
+    @click.option("--workers", type=int, default=None, help="Worker processes, one per CPU by default.")
+    @click.option("--threads", type=int, default=1, help="Threads per worker.")
+    @click.option("--preload/--no-preload", default=True,
+                  help="Load and warm up the app once before forking the workers.")
+    @click.option("--timeout", type=int, default=30)
+    def serve_command(bind, workers, threads, preload, timeout):
+        """Serve the API with pre-forked gunicorn workers."""
+        from .serve import CookbookServer, serve_options
+
+        options = serve_options(bind, workers, threads, preload, timeout)
+        # The workers create their own app, the one the CLI made is not used
+        db.session.remove()
+        db.engine.dispose()
+        CookbookServer(options, {
+            "SQLALCHEMY_DATABASE_URI": app.config["SQLALCHEMY_DATABASE_URI"],
+        }).run()
+
+    @app.cli.command("populate")
+    @click.option("--scale", type=float, default=None,
+                  help="Generate 1000 recipes per unit of scale instead of the test data.")
+    @click.option("--seed", type=int, default=0, help="Seed of the generated data.")
+    @click.option("--recipes-per-transaction", type=int, default=RECIPES_PER_TRANSACTION)
+    def populate_command(scale, seed, recipes_per_transaction):
+        """Fill the database with test or generated data."""
+        if scale is None:
+            if db.session.query(Recipe).first():
+                raise click.ClickException("Database is already populated")
+            populate_db()
+            click.echo("Added the test data")
+            return
+        if scale <= 0:
+            raise click.BadParameter("must be positive", param_hint="--scale")
+        start = time.perf_counter()
+        try:
+            counts = populate_synthetic(scale, seed, recipes_per_transaction)
+        except IntegrityError:
+            raise click.ClickException("Seed {} has already been used".format(seed))
+        click.echo("Added {} in {:.1f} s".format(
+            ", ".join("{} {} rows".format(rows, table) for table, rows in counts.items()),
+            time.perf_counter() - start
+        ))
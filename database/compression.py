@@ -0,0 +1,148 @@
+import zlib
+
+from flask import current_app, request
+from werkzeug.wsgi import ClosingIterator
+
+from .caching import ResponseCache, encoded_etag
+from .metrics import count
+
+try:
+    import brotli
+except ImportError:  # optional, br is only offered when installed
+    brotli = None
+
+_EXTENSION = "cookbook_compressed_cache"
+
+# Bodies smaller than this many bytes are sent as they are, compressing
+# them costs more than the bytes it saves. Override with the
+# COMPRESSION_MIN_SIZE config value.
+COMPRESSION_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Content codings in order of preference when the client rates them equal
+ENCODINGS = ("br", "gzip", "deflate") if brotli is not None else ("gzip", "deflate")
+
+
+def _compressible(response):
+    mimetype = response.mimetype or ""
+    return mimetype.startswith("text/") or mimetype.endswith("json")
+
+def negotiate():
+    """
+    The content coding to use for the current request, or None for the
+    body as it is.
+    """
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+class _Compressor:
+    """
+    Incremental compressor with the same interface for every coding.
+    """
+
+    def __init__(self, encoding):
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._zlib = None
+        else:
+            # wbits 31 writes a gzip container, 15 the zlib format HTTP
+            # calls deflate
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+            self._brotli = None
+
+    def compress(self, data):
+        if self._brotli is not None:
+            return self._brotli.process(data)
+        return self._zlib.compress(data)
+
+    def flush(self):
+        if self._brotli is not None:
+            return self._brotli.flush()
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self._brotli is not None:
+            return self._brotli.finish()
+        return self._zlib.flush(zlib.Z_FINISH)
+
+
+def compress(data, encoding):
+    compressor = _Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+def compress_stream(chunks, encoding, charset="utf-8"):
+    """
+    Compresses the ``chunks`` of a streamed response, encoding text with
+    ``charset``. Every chunk is flushed, so the client can decode what it
+    has received so far instead of waiting for the compressor's buffer to
+    fill. Closing the result closes ``chunks`` as well, even when the
+    client went away before the first chunk.
+    """
+    compressor = _Compressor(encoding)
+
+    def generate():
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = compressor.compress(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+
+    close = getattr(chunks, "close", None)
+    return ClosingIterator(generate(), [close] if close is not None else [])
+
+
+def _compress_response(response):
+    if "Content-Encoding" in response.headers or response.direct_passthrough or not _compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    etag, weak = response.get_etag()
+    if response.status_code == 304:
+        # Small bodies went out uncoded, name the variant the client has
+        if etag is not None and request.if_none_match.contains(encoded_etag(etag, encoding)):
+            response.set_etag(encoded_etag(etag, encoding))
+        return response
+    if response.status_code != 200:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, response.charset)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config.get("COMPRESSION_MIN_SIZE", COMPRESSION_MIN_SIZE):
+            return response
+        if etag is not None and not weak:
+            # ETags of cached resources change with their versions, so the
+            # coded body is computed once per version and coding
+            cache = current_app.extensions[_EXTENSION]
+            key = encoded_etag(etag, encoding)
+            cached = cache.get(key)
+            count("cookbook_cache_requests_total", cache="compressed", result="miss" if cached is None else "hit")
+            if cached is None:
+                cached = (compress(data, encoding), response.mimetype)
+                cache.put(key, *cached)
+            response.set_data(cached[0])
+            response.set_etag(key)
+        else:
+            response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    """
+    Compresses the JSON and text responses of ``app`` with the best coding
+    the client accepts: br when the brotli package is installed, gzip or
+    deflate. Bodies with an ETag are compressed once per ETag and kept in
+    a cache of COMPRESSION_CACHE_SIZE entries. COMPRESSION = False leaves
+    it to a proxy in front of the app.
+    """
+    if not app.config.get("COMPRESSION", True):
+        return
+    app.extensions[_EXTENSION] = ResponseCache(app.config.get("COMPRESSION_CACHE_SIZE", 256))
+    app.after_request(_compress_response)
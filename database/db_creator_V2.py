@@ -1,6 +1,11 @@
 from . import models
 from . import db
-from sqlite3 import IntegrityError
+from .synthetic import SyntheticCookbook
+
+# Recipes written per transaction by populate_synthetic. Each transaction
+# holds SQLite's write lock, so this bounds how long other writers wait.
+RECIPES_PER_TRANSACTION = 100000
+
 
 def populate_db():
     new_user = models.User(
@@ -9,12 +14,6 @@ def populate_db():
                 password="EeppinenPassuJokaonTurvallinen"
             )
 
-    try:
-        db.session.add(new_user)
-        db.session.commit()
-    except IntegrityError:
-        print("Database already has user added for this test")
-
     ing1 = models.Ingredient(name="Egg")
     ing2 = models.Ingredient(name="Salt")
     ing3 = models.Ingredient(name="Sugar")
@@ -22,91 +21,57 @@ def populate_db():
     ing5 = models.Ingredient(name="Flour")
     ing6 = models.Ingredient(name="Water")
 
-    db.session.add_all([ing1, ing2, ing3, ing4, ing5, ing6])
-    db.session.commit()
-
     meas1 = models.Unit(unit="Cup")
     meas2 = models.Unit(unit="Teaspoon")
     meas3 = models.Unit(unit="pcs")
 
-    db.session.add_all([meas1, meas2, meas3])
-    db.session.commit()
-
     recipe1 = models.Recipe(
                 name = "Cake-Recipe",
                 description = "Lisaa vahan jauhoja eheheh",
-                user_id=new_user.id)
+                user=new_user)
 
     recipe2 = models.Recipe(
                 name = "Water-Recipe",
                 description = "Avaa hana ja laita lasi alle",
-                user_id=new_user.id)
+                user=new_user)
 
     ingredients_1 = [[ing1, 2, meas3], [ing2, 1, meas2], [ing6, 1, meas1], [ing3, 4, meas2]]
     ingredients_2 = [[ing6, 1, meas1]]
 
-    db.session.add_all([recipe1, recipe2])
-    db.session.commit()
-
-    for ingredient in ingredients_1:
-        new_ingredients = models.Recipeingredient(
-            id = recipe1.id,
-            ingredient_id = ingredient[0].id,
-            amount = ingredient[1],
-            unit_id = ingredient[2].id
-        )
-        db.session.add(new_ingredients)
-        db.session.commit()
+    db.session.add_all([new_user, ing1, ing2, ing3, ing4, ing5, ing6, meas1, meas2, meas3, recipe1, recipe2])
 
-    for ingredient in ingredients_2:
-        new_ingredients = models.Recipeingredient(
-            id = recipe2.id,
-            ingredient_id = ingredient[0].id,
-            amount = ingredient[1],
-            unit_id = ingredient[2].id
-        )
-        db.session.add(new_ingredients)
-        db.session.commit()
-    
-def get_db():    
+    for recipe, ingredients in [(recipe1, ingredients_1), (recipe2, ingredients_2)]:
+        for ingredient in ingredients:
+            db.session.add(models.Recipeingredient(
+                recipe_rel = recipe,
+                ingredient = ingredient[0],
+                amount = ingredient[1],
+                unit = ingredient[2]
+            ))
 
-    resepti = db.session.query(
-            models.Recipe.name,
-            models.Ingredient.name,
-            models.Recipeingredient.amount,
-            models.Unit.unit
-            ).filter(
-                models.Ingredient.id == models.Recipeingredient.ingredient_id
-            ).filter(
-                models.Recipeingredient.id == models.Recipe.id
-            ).filter(
-                models.Unit.id == models.Recipeingredient.unit_id
-            ).all()
-
-    for row in resepti:
-        print(row)
-
-    print()
-    print("Recipes: ")
-
-    for row in db.session.query(models.Recipe.name, models.Recipe.description).all():
-        print(row)
-    print()
-
-    print("Ingredients: ")
-
-    for row in db.session.query(models.Ingredient.name).all():
-        print(row)
-    print()
-
-    print("Users: ")
-
-    for row in db.session.query(models.User.name).all():
-        print(row)
-    print()
-
-    print("Units: ")
+    # Everything goes in with a single commit
+    db.session.commit()
 
-    for row in db.session.query(models.Unit.unit).all():
-        print(row)
-    print()
\ No newline at end of file
+def populate_synthetic(scale, seed=0, recipes_per_transaction=RECIPES_PER_TRANSACTION, progress=None):
+    """
+    Adds a generated cookbook of the given ``scale`` to the database, see
+    SyntheticCookbook.scaled. Users and ingredients are written in one
+    transaction and recipes in transactions of ``recipes_per_transaction``.
+    Raises IntegrityError if the ``seed`` has already been used.
+    ``progress`` is called with the recipes written so far and in total
+    after every transaction. Returns the number of rows written per table.
+    """
+    book = SyntheticCookbook.scaled(scale, seed)
+    # A read transaction left open by the session would keep the commits
+    # below waiting for SQLite's exclusive lock
+    db.session.close()
+    with db.engine.begin() as connection:
+        counts = book.write_catalog(connection)
+    for start in range(0, book.recipes, recipes_per_transaction):
+        with db.engine.begin() as connection:
+            written = book.write_recipes(connection, start, start + recipes_per_transaction)
+        for table, rows in written.items():
+            counts[table] = counts.get(table, 0) + rows
+        if progress is not None:
+            progress(min(start + recipes_per_transaction, book.recipes), book.recipes)
+    return counts
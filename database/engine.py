@@ -0,0 +1,148 @@
+from functools import wraps
+from urllib.parse import quote
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.pool import QueuePool
+
+READ_ENGINE = "cookbook_read_engine"
+READ_METHODS = ("GET", "HEAD")
+
+# Settings for the SQLite engine, selected with the DATABASE_PROFILE config
+# value. Any single setting can still be overridden through the config key
+# of the same name, e.g. DATABASE_POOL_SIZE.
+ENGINE_PROFILES = {
+    "default": {},
+    "production": {
+        "DATABASE_PRAGMAS": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,
+            "busy_timeout": 5000,
+            "temp_store": "MEMORY",
+        },
+        "DATABASE_POOL_SIZE": 4,
+        "DATABASE_MAX_OVERFLOW": 4,
+        "DATABASE_POOL_TIMEOUT": 30,
+        "DATABASE_READ_POOL_SIZE": 16,
+        "DATABASE_IMMEDIATE_WRITES": True,
+    },
+}
+
+# Pragmas that only make sense on a connection that writes
+WRITE_PRAGMAS = ("journal_mode", "synchronous")
+
+
+def read_only(func):
+    """
+    Marks a handler that only reads even though its method is not GET or
+    HEAD, such as a POST that carries a long query, so its statements go
+    to the read-only pool instead of taking the write lock.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return func(*args, **kwargs)
+    return wrapper
+
+def request_reads_only():
+    return has_request_context() and (request.method in READ_METHODS or g.get("read_only", False))
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends the statements of GET and HEAD requests, and of handlers marked
+    read_only, to the read-only pool when the app has one, everything else
+    to the primary engine.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        reader = self.app.extensions.get(READ_ENGINE)
+        if reader is not None and not self._flushing and request_reads_only():
+            return reader
+        return super().get_bind(mapper, clause)
+
+
+class CookbookSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def profile_setting(app, name, default=None):
+    profile = ENGINE_PROFILES[app.config.get("DATABASE_PROFILE", "default")]
+    return app.config.get(name, profile.get(name, default))
+
+def apply_engine_profile(app):
+    """
+    Fills SQLALCHEMY_ENGINE_OPTIONS from the selected profile. Has to run
+    before db.init_app() reads the config.
+    """
+    if app.config.get("DATABASE_PROFILE", "default") not in ENGINE_PROFILES:
+        raise ValueError("Unknown DATABASE_PROFILE {}".format(app.config["DATABASE_PROFILE"]))
+    pool_size = profile_setting(app, "DATABASE_POOL_SIZE")
+    if pool_size is None:
+        return
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    options.setdefault("poolclass", QueuePool)
+    options.setdefault("pool_size", pool_size)
+    options.setdefault("max_overflow", profile_setting(app, "DATABASE_MAX_OVERFLOW", 0))
+    options.setdefault("pool_timeout", profile_setting(app, "DATABASE_POOL_TIMEOUT", 30))
+    options.setdefault("pool_pre_ping", False)
+    options.setdefault("connect_args", {}).setdefault("check_same_thread", False)
+
+def _pragma_listener(pragmas, autocommit):
+    def set_pragmas(dbapi_connection, connection_record):
+        if autocommit:
+            # Let SQLAlchemy's begin event open the transactions instead of
+            # the sqlite3 module, see _begin_immediate
+            dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+    return set_pragmas
+
+def _begin_immediate(conn):
+    # Take the write lock up front. A deferred transaction that reads first
+    # and then writes fails with "database is locked" instead of waiting
+    # for busy_timeout when another writer got there in between.
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+def configure_engines(app, engine):
+    """
+    Installs the profile's connect-time pragmas on the primary engine and
+    creates the read-only pool. Must run before the first connection.
+    """
+    pragmas = profile_setting(app, "DATABASE_PRAGMAS", {})
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+    immediate = profile_setting(app, "DATABASE_IMMEDIATE_WRITES", False)
+    event.listen(engine, "connect", _pragma_listener(pragmas, immediate))
+    if immediate:
+        event.listen(engine, "begin", _begin_immediate)
+
+    read_pool_size = profile_setting(app, "DATABASE_READ_POOL_SIZE")
+    path = engine.url.database
+    if not read_pool_size or not path or path == ":memory:":
+        return
+    reader = create_engine(
+        # SQLite reads the path as a URI, where ?, # and % have a meaning
+        "sqlite:///file:{}?mode=ro&uri=true".format(quote(path)),
+        poolclass=QueuePool,
+        pool_size=read_pool_size,
+        max_overflow=read_pool_size,
+        pool_timeout=profile_setting(app, "DATABASE_POOL_TIMEOUT", 30),
+        connect_args={"check_same_thread": False},
+    )
+    read_pragmas = {
+        name: value for name, value in pragmas.items() if name not in WRITE_PRAGMAS
+    }
+    read_pragmas["query_only"] = "ON"
+    event.listen(reader, "connect", _pragma_listener(read_pragmas, True))
+    app.extensions[READ_ENGINE] = reader
+
+def read_engine():
+    return current_app.extensions.get(READ_ENGINE)
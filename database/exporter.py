@@ -0,0 +1,106 @@
+import csv
+import io
+import json
+from itertools import groupby
+
+from .models import Ingredient, Recipe, Recipeingredient, Unit, User
+
+EXPORT_BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+CSV_FIELDS = ["name", "description", "difficulty", "owner", "ingredient", "amount", "unit"]
+
+
+def export_rows(session, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Every recipe row joined with its owner and ingredient rows, in recipe id
+    order. Rows are fetched ``batch_size`` at a time from a streaming
+    cursor so memory does not grow with the size of the cookbook.
+    """
+    return session.query(
+        Recipe.id,
+        Recipe.name,
+        Recipe.description,
+        Recipe.difficulty,
+        User.name.label("owner"),
+        Ingredient.name.label("ingredient"),
+        Recipeingredient.amount,
+        Unit.unit,
+    ).outerjoin(
+        User, User.id == Recipe.user_id
+    ).outerjoin(
+        Recipeingredient, Recipeingredient.id == Recipe.id
+    ).outerjoin(
+        Ingredient, Ingredient.id == Recipeingredient.ingredient_id
+    ).outerjoin(
+        Unit, Unit.id == Recipeingredient.unit_id
+    ).order_by(
+        Recipe.id
+    ).execution_options(stream_results=True).yield_per(batch_size)
+
+def export_recipes(session, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields one dict per recipe in the format RecipeImporter reads back.
+    """
+    for _, rows in groupby(export_rows(session, batch_size), key=lambda row: row.id):
+        first = next(rows)
+        recipe = {
+            "name": first.name,
+            "description": first.description,
+            "difficulty": first.difficulty,
+            "owner": first.owner,
+            "ingredients": [],
+        }
+        for row in [first, *rows]:
+            if row.ingredient is not None:
+                recipe["ingredients"].append([row.ingredient, row.amount, row.unit])
+        yield recipe
+
+def ndjson_lines(session, batch_size=EXPORT_BATCH_SIZE):
+    for recipe in export_recipes(session, batch_size):
+        yield json.dumps(recipe) + "\n"
+
+def csv_lines(session, batch_size=EXPORT_BATCH_SIZE):
+    """
+    CSV with one line per recipe ingredient. Recipes without ingredients
+    get a single line with the ingredient columns left empty.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELDS)
+    # On its own, so an empty cookbook still exports the header
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for row in export_rows(session, batch_size):
+        writer.writerow([
+            row.name, row.description, row.difficulty, row.owner,
+            row.ingredient, row.amount, row.unit
+        ])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def chunked(lines, size=CHUNK_SIZE):
+    """
+    Joins ``lines`` into chunks of about ``size`` characters. The first line
+    goes out on its own so the client starts receiving data right away.
+    """
+    pending = []
+    pending_size = 0
+    for number, line in enumerate(lines):
+        if number == 0:
+            yield line
+            continue
+        pending.append(line)
+        pending_size += len(line)
+        if pending_size >= size:
+            yield "".join(pending)
+            pending = []
+            pending_size = 0
+    if pending:
+        yield "".join(pending)
+
+EXPORT_FORMATS = {
+    "ndjson": (ndjson_lines, "application/x-ndjson"),
+    "csv": (csv_lines, "text/csv"),
+}
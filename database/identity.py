@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, inspect
+
+from . import db
+from .metrics import count
+from .models import Recipe, User
+
+_EXTENSION = "cookbook_name_cache"
+NAMED_MODELS = (Recipe, User)
+
+
+class NameCache:
+    """
+    Small process-wide LRU from (model, name) to primary key. A hit turns the
+    converters' name lookup into a primary key get, which the session can
+    answer from its identity map.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._ids = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            row_id = self._ids.get(key)
+            if row_id is not None:
+                self._ids.move_to_end(key)
+            return row_id
+
+    def put(self, key, row_id):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._ids[key] = row_id
+            self._ids.move_to_end(key)
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._ids.pop(key, None)
+
+
+def find_by_name(model, name):
+    """
+    Returns the ``model`` row called ``name``, or None. Within one request
+    the same name is looked up at most once, and converters and handlers
+    get the same object back.
+    """
+    identities = g.setdefault("identity_map", {})
+    key = (model.__name__, name)
+    if key in identities:
+        return identities[key]
+
+    names = current_app.extensions[_EXTENSION]
+    found = None
+    row_id = names.get(key)
+    if row_id is not None:
+        found = db.session.get(model, row_id)
+        # Another process may have renamed or deleted the row
+        if found is None or found.name != name:
+            names.discard(key)
+            found = None
+    count("cookbook_cache_requests_total", cache="names", result="miss" if found is None else "hit")
+    if found is None:
+        found = db.session.query(model).filter_by(name=name).first()
+    if found is not None:
+        names.put(key, found.id)
+    identities[key] = found
+    return found
+
+def forget(model, name):
+    """
+    Drops ``name`` from the request and process caches after a write.
+    """
+    key = (model.__name__, name)
+    names = current_app.extensions.get(_EXTENSION)
+    if names is not None:
+        names.discard(key)
+    identities = g.get("identity_map")
+    if identities is not None:
+        identities.pop(key, None)
+
+def _forget_flushed(session, flush_context):
+    if not has_app_context():
+        return
+    for obj in session.dirty:
+        if isinstance(obj, NAMED_MODELS):
+            for name in inspect(obj).attrs.name.history.deleted:
+                forget(type(obj), name)
+    for obj in session.deleted:
+        if isinstance(obj, NAMED_MODELS):
+            forget(type(obj), obj.name)
+
+
+def init_identity_cache(app, session):
+    """
+    Gives ``app`` its own name cache and evicts renamed and deleted rows on
+    every flush of ``session``.
+    """
+    app.extensions[_EXTENSION] = NameCache(app.config.get("NAME_CACHE_SIZE", 1024))
+    if not event.contains(session, "after_flush", _forget_flushed):
+        event.listen(session, "after_flush", _forget_flushed)
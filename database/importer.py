@@ -0,0 +1,231 @@
+import json
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+
+from .caching import bump_versions, recipe_key, user_key
+from .models import Ingredient, Recipe, Recipeingredient, Unit, User
+from .validation import compile_schema
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+RECIPE_LINE_SCHEMA = {
+    "type": "object",
+    "required": ["name", "description"],
+    "properties": {
+        "name": {"type": "string", "minLength": 1, "maxLength": 64},
+        "description": {"type": "string", "maxLength": 2000},
+        "difficulty": {"type": ["string", "null"], "maxLength": 20},
+        "owner": {"type": ["string", "null"]},
+        "ingredients": {
+            "type": "array",
+            "items": {
+                "type": "array",
+                "items": [
+                    {"type": "string", "minLength": 1, "maxLength": 100},
+                    {"type": ["integer", "null"]},
+                    {"type": "string", "minLength": 1, "maxLength": 30},
+                ],
+                "minItems": 3,
+                "maxItems": 3,
+            },
+        },
+    },
+}
+
+_validator = compile_schema(RECIPE_LINE_SCHEMA)
+
+
+class ImportResult:
+
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def fail(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "message": message})
+
+    def to_dict(self):
+        return {
+            "imported": self.imported,
+            "failed": self.failed,
+            "errors": sorted(self.errors, key=lambda error: error["line"]),
+        }
+
+
+class RecipeImporter:
+    """
+    Imports recipes, one JSON document per line, in the same shape that
+    RecipeItem returns them:
+
+        {"name": ..., "description": ..., "difficulty": ..., "owner": ...,
+         "ingredients": [[ingredient, amount, unit], ...]}
+
+    Lines are parsed one at a time and written in batches of ``batch_size``
+    with Core executemany inserts, one transaction per batch. Ingredients
+    and units are resolved through in-memory maps and created on first
+    use. A batch that hits a constraint is retried line by line so only
+    the offending lines are reported.
+
+    Core inserts bypass the ORM events, so the importer bumps the resource
+    versions itself and feeds the committed rows to ``ingredient_index``.
+    """
+
+    def __init__(self, session, ingredient_index=None, batch_size=BATCH_SIZE):
+        self.session = session
+        self.ingredient_index = ingredient_index
+        self.batch_size = batch_size
+        self.result = ImportResult()
+        self._load_lookups()
+
+    def _load_lookups(self):
+        self.ingredients = dict(self.session.query(Ingredient.name, Ingredient.id))
+        self.units = {}
+        for unit_id, name in self.session.query(Unit.id, Unit.unit).order_by(Unit.id.desc()):
+            self.units[name] = unit_id
+        self.users = {}
+
+    def run(self, lines, on_batch=None):
+        """
+        Imports ``lines``, calling ``on_batch`` without arguments after
+        every batch written.
+        """
+        batch = []
+        for number, line in enumerate(lines, start=1):
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", errors="replace")
+            if not line.strip():
+                continue
+            entry = self._parse(number, line)
+            if entry is None:
+                continue
+            batch.append(entry)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+                if on_batch is not None:
+                    on_batch()
+        if batch:
+            self._write(batch)
+        return self.result
+
+    def _parse(self, number, line):
+        try:
+            document = json.loads(line)
+        except ValueError as e:
+            self.result.fail(number, "Invalid JSON: {}".format(e))
+            return None
+        error = next(_validator.iter_errors(document), None)
+        if error is not None:
+            self.result.fail(number, "Invalid recipe: {}".format(error.message))
+            return None
+        return number, document
+
+    def _write(self, batch):
+        batch = self._check_batch(batch)
+        if not batch:
+            return
+        try:
+            pairs, versions = self._insert(batch)
+            self.session.commit()
+        except IntegrityError as e:
+            self.session.rollback()
+            self._load_lookups()
+            if len(batch) == 1:
+                self.result.fail(batch[0][0], "Database error: {}".format(e.orig))
+                return
+            for entry in batch:
+                self._write([entry])
+            return
+        self.result.imported += len(batch)
+        if self.ingredient_index is not None:
+            version = versions["recipeingredients"]
+            self.ingredient_index.advance((version - 1, version), added=pairs)
+
+    def _check_batch(self, batch):
+        """
+        Drops the lines whose recipe already exists or whose owner is not
+        known, with one query each for the whole batch.
+        """
+        names = [document["name"] for _, document in batch]
+        existing = {
+            row.name for row in self.session.query(Recipe.name).filter(Recipe.name.in_(names))
+        }
+        owners = {document.get("owner") for _, document in batch} - set(self.users) - {None}
+        if owners:
+            for user_id, name in self.session.query(User.id, User.name).filter(
+                User.name.in_(owners)
+            ).order_by(User.id.desc()):
+                self.users[name] = user_id
+
+        accepted = []
+        seen = set()
+        for number, document in batch:
+            name = document["name"]
+            owner = document.get("owner")
+            if name in existing or name in seen:
+                self.result.fail(number, "Recipe {} already exists".format(name))
+            elif owner is not None and owner not in self.users:
+                self.result.fail(number, "Unknown owner {}".format(owner))
+            else:
+                seen.add(name)
+                accepted.append((number, document))
+        return accepted
+
+    def _resolve(self, lookup, model, column, names):
+        """
+        Creates the ``names`` missing from ``lookup`` and reads their ids
+        back, one statement each.
+        """
+        missing = sorted(set(names) - set(lookup))
+        if not missing:
+            return False
+        self.session.execute(insert(model.__table__), [{column.key: name} for name in missing])
+        for row_id, name in self.session.query(model.id, column).filter(column.in_(missing)):
+            lookup.setdefault(name, row_id)
+        return True
+
+    def _insert(self, batch):
+        rows = [row for _, document in batch for row in document.get("ingredients", [])]
+        created = self._resolve(self.ingredients, Ingredient, Ingredient.name, [row[0] for row in rows])
+        created |= self._resolve(self.units, Unit, Unit.unit, [row[2] for row in rows])
+
+        self.session.execute(insert(Recipe.__table__), [
+            {
+                "name": document["name"],
+                "description": document["description"],
+                "difficulty": document.get("difficulty"),
+                "user_id": self.users.get(document.get("owner")),
+            } for _, document in batch
+        ])
+        recipe_ids = dict(self.session.query(Recipe.name, Recipe.id).filter(
+            Recipe.name.in_([document["name"] for _, document in batch])
+        ))
+
+        amounts = {}
+        for _, document in batch:
+            recipe_id = recipe_ids[document["name"]]
+            for name, amount, unit in document.get("ingredients", []):
+                key = (recipe_id, self.ingredients[name], self.units[unit])
+                # The same ingredient and unit twice in a recipe share a row
+                if key not in amounts:
+                    amounts[key] = amount
+                elif amount is not None:
+                    amounts[key] = (amounts[key] or 0) + amount
+        if amounts:
+            self.session.execute(insert(Recipeingredient.__table__), [
+                {"id": recipe_id, "ingredient_id": ingredient_id, "unit_id": unit_id, "amount": amount}
+                for (recipe_id, ingredient_id, unit_id), amount in amounts.items()
+            ])
+
+        keys = {"recipes", "recipeingredients"}
+        if created:
+            keys.add("ingredients")
+        keys.update(recipe_key(recipe_id) for recipe_id in recipe_ids.values())
+        keys.update(user_key(self.users.get(document.get("owner"))) for _, document in batch)
+        versions = bump_versions(self.session.connection(), keys)
+        return [(recipe_id, ingredient_id) for recipe_id, ingredient_id, _ in amounts], versions
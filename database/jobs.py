@@ -0,0 +1,298 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from . import db
+from .metrics import process_alive
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+_EXTENSION = "cookbook_jobs"
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+UNFINISHED = (QUEUED, RUNNING)
+
+# Threads per process that run jobs, override with JOB_WORKERS
+JOB_WORKERS = 2
+# Progress goes to the job's progress file at most this often, in seconds
+PROGRESS_INTERVAL = 0.5
+# Finished jobs and their files are deleted by the refresh job after this
+# many seconds, override with JOB_RETENTION
+JOB_RETENTION = 7 * 24 * 3600
+
+# name: function(context, **params) returning the JSON result of the job.
+# Registered with the job_type decorator, see database/tasks.py.
+JOB_TYPES = {}
+
+
+def job_type(name):
+    def register(function):
+        JOB_TYPES[name] = function
+        return function
+    return register
+
+
+def _progress_path(directory, job_id):
+    return os.path.join(directory, "job-{}.progress".format(job_id))
+
+def read_progress(directory, job_id):
+    """
+    The (done, total) a running job last reported, or None.
+    """
+    try:
+        with open(_progress_path(directory, job_id)) as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return progress["done"], progress["total"]
+
+
+class JobContext:
+    """
+    Handed to a running job. Progress goes to a small file next to the
+    job's other files rather than to the job table, so reporting it never
+    waits for the database lock the job itself may be holding, and any
+    worker process can read it.
+    """
+
+    def __init__(self, directory, job_id):
+        self.directory = directory
+        self.job_id = job_id
+        self.done = 0
+        self.total = None
+        self._reported = 0.0
+
+    def path(self, name):
+        """
+        Path of a file that belongs to this job and is deleted with it.
+        """
+        return os.path.join(self.directory, "job-{}-{}".format(self.job_id, name))
+
+    def progress(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if now - self._reported < PROGRESS_INTERVAL:
+            return
+        self._reported = now
+        path = _progress_path(self.directory, self.job_id)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"done": self.done, "total": self.total}, f)
+        os.replace(path + ".tmp", path)
+
+
+class JobRunner:
+    """
+    Runs jobs of the JOB_TYPES on a thread pool of the current process and
+    keeps their state in the job table, where every worker process can see
+    it. The pool and the scheduler of periodic jobs are started on first
+    use in each process, as threads do not survive a fork.
+    """
+
+    def __init__(self, app, directory, workers=JOB_WORKERS, schedule=None):
+        self.app = app
+        self.directory = directory
+        self.workers = workers
+        self.schedule = dict(schedule or {})
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._futures = {}
+        self._stop = None
+
+    def start(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="cookbook-job")
+            self._futures = {}
+            self._stop = threading.Event()
+            if self.schedule:
+                threading.Thread(
+                    target=self._run_schedule, args=(self._stop,), name="cookbook-job-schedule", daemon=True
+                ).start()
+            self._pid = pid
+
+    def stop(self, wait=True):
+        """
+        Stops the scheduler and the pool of this process; the next use
+        starts new ones.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._stop.set()
+            self._executor.shutdown(wait=wait)
+            self._pid = None
+
+    def submit(self, kind, **params):
+        """
+        Records a job of type ``kind`` and queues it. Returns its id.
+        """
+        if kind not in JOB_TYPES:
+            raise ValueError("Unknown job type {}".format(kind))
+        self.start()
+        job = Job(kind=kind, status=QUEUED, params=json.dumps(params), pid=os.getpid(), created=time.time())
+        db.session.add(job)
+        db.session.commit()
+        future = self._executor.submit(self._run, job.id, kind, params)
+        self._futures[job.id] = future
+        future.add_done_callback(lambda _, job_id=job.id: self._futures.pop(job_id, None))
+        return job.id
+
+    def wait(self, job_id, timeout=None):
+        """
+        Blocks until job ``job_id`` of this process has finished.
+        """
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.result(timeout)
+
+    def running(self, job_id):
+        return job_id in self._futures
+
+    def _run(self, job_id, kind, params):
+        with self.app.app_context():
+            context = JobContext(self.directory, job_id)
+            try:
+                self._update(job_id, status=RUNNING, started=time.time())
+                result = JOB_TYPES[kind](context, **params)
+            except Exception as e:
+                logger.exception("Job %s (%s) failed", job_id, kind)
+                db.session.rollback()
+                self._update(job_id, status=FAILED, error=str(e) or type(e).__name__,
+                             done=context.done, total=context.total, finished=time.time())
+            else:
+                self._update(job_id, status=SUCCEEDED, result=json.dumps(result),
+                             done=context.done, total=context.total, finished=time.time())
+            finally:
+                db.session.remove()
+                try:
+                    os.remove(_progress_path(self.directory, job_id))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _update(job_id, **values):
+        db.session.query(Job).filter_by(id=job_id).update(values, synchronize_session=False)
+        db.session.commit()
+
+    def _run_schedule(self, stop):
+        due = {kind: time.monotonic() + interval for kind, interval in self.schedule.items()}
+        latest = {}
+        while True:
+            kind = min(due, key=due.get)
+            if stop.wait(max(due[kind] - time.monotonic(), 0)):
+                return
+            due[kind] += self.schedule[kind]
+            # A run that has not finished yet is not queued again
+            if self.running(latest.get(kind)):
+                continue
+            with self.app.app_context():
+                try:
+                    latest[kind] = self.submit(kind)
+                except Exception:
+                    logger.exception("Could not queue scheduled %s job", kind)
+                finally:
+                    db.session.remove()
+
+
+def interrupted(job):
+    """
+    Whether ``job`` is recorded as unfinished but its process has died.
+    """
+    return job.status in UNFINISHED and not (job.pid == os.getpid() or process_alive(job.pid))
+
+def fail_interrupted(session, jobs):
+    """
+    Marks the interrupted ``jobs`` as failed.
+    """
+    changed = False
+    for job in jobs:
+        if interrupted(job):
+            job.status = FAILED
+            job.error = "Interrupted"
+            job.finished = time.time()
+            changed = True
+    if changed:
+        session.commit()
+
+def job_files(directory, job):
+    """
+    The files in ``directory`` that belong to ``job``, including an import
+    upload it has not consumed.
+    """
+    if not os.path.isdir(directory):
+        return []
+    prefix = "job-{}-".format(job.id)
+    paths = [
+        os.path.join(directory, filename) for filename in os.listdir(directory)
+        if filename.startswith(prefix)
+    ]
+    upload = json.loads(job.params).get("upload")
+    if upload and os.path.exists(os.path.join(directory, upload)):
+        paths.append(os.path.join(directory, upload))
+    return paths
+
+def delete_old_jobs(session, directory, retention):
+    """
+    Deletes the jobs that finished more than ``retention`` seconds ago,
+    with their files. Returns how many were deleted.
+    """
+    old = session.query(Job).filter(
+        Job.status.notin_(UNFINISHED), Job.finished < time.time() - retention
+    ).all()
+    for job in old:
+        for path in job_files(directory, job):
+            os.remove(path)
+        session.delete(job)
+    session.commit()
+    return len(old)
+
+
+def get_job_runner():
+    return current_app.extensions[_EXTENSION]
+
+def _start_jobs():
+    current_app.extensions[_EXTENSION].start()
+
+def _default_directory(engine):
+    path = engine.url.database
+    if not path or path == ":memory:":
+        return tempfile.mkdtemp(prefix="cookbook-jobs-")
+    return os.path.join(os.path.dirname(os.path.abspath(path)), "jobs")
+
+
+def init_jobs(app, session):
+    """
+    Gives ``app`` a JobRunner. Job files such as exports go to JOBS_DIR,
+    by default a jobs directory next to the database, which all worker
+    processes must share. JOB_SCHEDULE maps job types to the interval in
+    seconds they are run at in every process.
+    """
+    from . import tasks  # noqa: F401, registers the job types
+
+    directory = app.config.get("JOBS_DIR") or _default_directory(db.engine)
+    app.extensions[_EXTENSION] = JobRunner(
+        app,
+        directory,
+        workers=app.config.get("JOB_WORKERS", JOB_WORKERS),
+        schedule=app.config.get("JOB_SCHEDULE"),
+    )
+    fail_interrupted(session, session.query(Job).filter(Job.status.in_(UNFINISHED)))
+    app.before_request(_start_jobs)
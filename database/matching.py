@@ -0,0 +1,237 @@
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+
+from .caching import current_version, flushed_versions
+from .models import Recipe, Recipeingredient
+
+VERSION_KEY = "recipeingredients"
+
+
+class IngredientIndex:
+    """
+    In-memory inverted index from ingredient id to the sorted ids of the
+    recipes using it, plus the forward recipe -> ingredients mapping that
+    tells how many ingredients each recipe needs.
+
+    Posting lists are kept as sorted ``array('l')`` so a large catalogue
+    costs a machine word per (recipe, ingredient) pair instead of a Python
+    object. Only the rare pairs stored in more than one row, one per unit,
+    have an entry in ``_extra`` counting the additional rows. The index is
+    built once from the recipeingredient table and
+    then patched from the rows the ORM inserts and deletes on commit.
+
+    ``version`` is the recipeingredients resource version the index
+    reflects. Commits of this process move it forward together with their
+    changes; a version moved by another process forces a reload.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = {}
+        self._recipes = {}
+        self._extra = {}
+        self.loaded = False
+        self.version = None
+
+    def load(self, session):
+        version = current_version(session, VERSION_KEY)
+        rows = session.query(Recipeingredient.id, Recipeingredient.ingredient_id).order_by(
+            Recipeingredient.ingredient_id, Recipeingredient.id
+        )
+        with self._lock:
+            self._postings = {}
+            self._recipes = {}
+            self._extra = {}
+            for recipe_id, ingredient_id in rows:
+                self._add(recipe_id, ingredient_id)
+            self.loaded = True
+            self.version = version
+
+    def invalidate(self):
+        with self._lock:
+            self.loaded = False
+
+    def ensure_current(self, session):
+        if not self.loaded or current_version(session, VERSION_KEY) != self.version:
+            self.load(session)
+
+    def advance(self, versions, added=(), removed=(), recipes=()):
+        """
+        Applies changes committed by this process. ``versions`` is the
+        (before, after) pair of the recipeingredients version for the
+        transaction. If the index was not at ``before`` it has missed
+        someone else's write and is dropped instead.
+        """
+        before, after = versions
+        with self._lock:
+            if not self.loaded or self.version != before:
+                self.loaded = False
+                return
+            self.remove(removed)
+            self.remove_recipes(recipes)
+            self.add(added)
+            self.version = after
+
+    def add(self, pairs):
+        with self._lock:
+            for recipe_id, ingredient_id in pairs:
+                self._add(recipe_id, ingredient_id)
+
+    def remove(self, pairs):
+        with self._lock:
+            for recipe_id, ingredient_id in pairs:
+                self._remove(recipe_id, ingredient_id)
+
+    def remove_recipes(self, recipe_ids):
+        with self._lock:
+            for recipe_id in recipe_ids:
+                for ingredient_id in list(self._recipes.get(recipe_id, ())):
+                    self._drop(recipe_id, ingredient_id)
+
+    def _add(self, recipe_id, ingredient_id):
+        # The same ingredient can appear once per unit, count the rows so
+        # deleting one of them does not drop the pair.
+        if _contains(self._recipes.get(recipe_id), ingredient_id):
+            key = (recipe_id, ingredient_id)
+            self._extra[key] = self._extra.get(key, 0) + 1
+            return
+        postings = self._postings.setdefault(ingredient_id, array("l"))
+        if not postings or postings[-1] < recipe_id:
+            postings.append(recipe_id)
+        else:
+            insort(postings, recipe_id)
+        ingredients = self._recipes.setdefault(recipe_id, array("l"))
+        insort(ingredients, ingredient_id)
+
+    def _remove(self, recipe_id, ingredient_id):
+        key = (recipe_id, ingredient_id)
+        extra = self._extra.get(key)
+        if extra:
+            if extra > 1:
+                self._extra[key] = extra - 1
+            else:
+                del self._extra[key]
+        elif _contains(self._recipes.get(recipe_id), ingredient_id):
+            self._drop(recipe_id, ingredient_id)
+
+    def _drop(self, recipe_id, ingredient_id):
+        self._extra.pop((recipe_id, ingredient_id), None)
+        _discard(self._postings.get(ingredient_id), recipe_id)
+        if not self._postings.get(ingredient_id):
+            self._postings.pop(ingredient_id, None)
+        _discard(self._recipes.get(recipe_id), ingredient_id)
+        if not self._recipes.get(recipe_id):
+            self._recipes.pop(recipe_id, None)
+
+    def match(self, ingredient_ids, missing=0):
+        """
+        Returns (recipe_id, missing ingredient ids) for every recipe that uses
+        at least one of ``ingredient_ids`` and needs at most ``missing``
+        ingredients outside of them, fewest missing first.
+        """
+        available = set(ingredient_ids)
+        with self._lock:
+            covered = Counter()
+            for ingredient_id in available:
+                for recipe_id in self._postings.get(ingredient_id, ()):
+                    covered[recipe_id] += 1
+            result = []
+            for recipe_id, count in covered.items():
+                needed = self._recipes[recipe_id]
+                if len(needed) - count <= missing:
+                    result.append((recipe_id, [i for i in needed if i not in available]))
+        result.sort(key=lambda match: (len(match[1]), match[0]))
+        return result
+
+
+def _contains(values, value):
+    if values is None:
+        return False
+    position = bisect_left(values, value)
+    return position < len(values) and values[position] == value
+
+def _discard(values, value):
+    if values is None:
+        return
+    position = bisect_left(values, value)
+    if position < len(values) and values[position] == value:
+        del values[position]
+
+
+_EXTENSION = "cookbook_ingredient_index"
+_PENDING = "ingredient_index_changes"
+
+
+def get_ingredient_index(session=None):
+    """
+    The ingredient index of the current app. Passing ``session`` (re)builds
+    it first if it is not loaded or out of date.
+    """
+    index = current_app.extensions[_EXTENSION]
+    if session is not None:
+        index.ensure_current(session)
+    return index
+
+
+def committed_pair(row):
+    attrs = inspect(row).attrs
+    recipe_id = attrs.id.history.deleted or [row.id]
+    ingredient_id = attrs.ingredient_id.history.deleted or [row.ingredient_id]
+    return recipe_id[0], ingredient_id[0]
+
+def _collect_changes(session, flush_context):
+    added, removed, recipes = [], [], []
+    for obj in session.new:
+        if isinstance(obj, Recipeingredient):
+            added.append((obj.id, obj.ingredient_id))
+    for obj in session.dirty:
+        if isinstance(obj, Recipeingredient) and session.is_modified(obj):
+            removed.append(committed_pair(obj))
+            added.append((obj.id, obj.ingredient_id))
+    for obj in session.deleted:
+        if isinstance(obj, Recipeingredient):
+            removed.append(committed_pair(obj))
+        elif isinstance(obj, Recipe):
+            recipes.append(obj.id)
+    if added or removed or recipes:
+        session.info.setdefault(_PENDING, []).append((added, removed, recipes))
+
+def _apply_changes(session):
+    changes = session.info.pop(_PENDING, [])
+    versions = flushed_versions(session).get(VERSION_KEY)
+    if not changes or versions is None or not has_app_context():
+        return
+    index = current_app.extensions.get(_EXTENSION)
+    if index is None:
+        return
+    added, removed, recipes = [], [], []
+    for flush_added, flush_removed, flush_recipes in changes:
+        added.extend(flush_added)
+        removed.extend(flush_removed)
+        recipes.extend(flush_recipes)
+    index.advance(versions, added, removed, recipes)
+
+def _discard_changes(session):
+    session.info.pop(_PENDING, None)
+
+
+def _discard_on_rollback(session, previous_transaction):
+    _discard_changes(session)
+
+
+def init_ingredient_index(app, session):
+    """
+    Gives ``app`` its own ingredient index and keeps it in step with the
+    rows committed through ``session``. Changes are only applied once the
+    transaction commits.
+    """
+    app.extensions[_EXTENSION] = IngredientIndex()
+    if not event.contains(session, "after_flush", _collect_changes):
+        event.listen(session, "after_flush", _collect_changes)
+        event.listen(session, "after_commit", _apply_changes)
+        event.listen(session, "after_soft_rollback", _discard_on_rollback)
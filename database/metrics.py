@@ -0,0 +1,369 @@
+import atexit
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+from flask import current_app, has_app_context, request
+from sqlalchemy import event
+
+_EXTENSION = "cookbook_metrics"
+_default_directory = None
+_default_directory_lock = threading.Lock()
+_instances = {}
+
+# Upper bounds of the request latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# name: (type, help). Values of gauges are summed over the live processes
+# only, everything else over every process that ever wrote a file.
+FAMILIES = {
+    "cookbook_requests_total": ("counter", "Requests handled, by endpoint, method and status."),
+    "cookbook_request_duration_seconds": ("histogram", "Request latency, by endpoint and status."),
+    "cookbook_db_queries_total": ("counter", "SQL statements run by requests, by endpoint."),
+    "cookbook_db_seconds_total": ("counter", "Time spent in SQL statements by requests, by endpoint."),
+    "cookbook_db_pool_checked_out": ("gauge", "Database connections in use, by pool."),
+    "cookbook_db_pool_size": ("gauge", "Database connections kept open by the pools, by pool."),
+    "cookbook_cache_requests_total": ("counter", "Cache lookups, by cache and result."),
+    "cookbook_admission_rejected_total": ("counter", "Requests turned away before routing, by endpoint and reason."),
+}
+GAUGES = {name for name, (kind, _) in FAMILIES.items() if kind == "gauge"}
+# Cache lookup results that count towards the hit ratio
+HIT_RESULTS = ("hit", "not_modified")
+
+_HEADER = struct.Struct("<Q")
+_LENGTH = struct.Struct("<I")
+_VALUE = struct.Struct("<d")
+INITIAL_FILE_SIZE = 64 * 1024
+
+
+class MetricFile:
+    """
+    Map from (name, labels) to a float in a memory mapped file that only
+    the process that created it writes to. Entries are appended as
+    [key length][JSON key, padded][8 byte value] and the header holds the
+    number of bytes in use, written after the entry, so other processes
+    can read the file at any time without locking.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "w+b")
+        self._file.truncate(INITIAL_FILE_SIZE)
+        self._map = mmap.mmap(self._file.fileno(), INITIAL_FILE_SIZE)
+        self._used = _HEADER.size
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, amount):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            _VALUE.pack_into(self._map, position, _VALUE.unpack_from(self._map, position)[0] + amount)
+
+    def set(self, key, value):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            _VALUE.pack_into(self._map, position, value)
+
+    def _append(self, key):
+        encoded = json.dumps(key).encode("utf-8")
+        padded = len(encoded) + (-(_LENGTH.size + len(encoded)) % 8)
+        needed = _LENGTH.size + padded + _VALUE.size
+        if self._used + needed > len(self._map):
+            self._grow(self._used + needed)
+        _LENGTH.pack_into(self._map, self._used, len(encoded))
+        start = self._used + _LENGTH.size
+        self._map[start:start + padded] = encoded.ljust(padded, b"\0")
+        position = start + padded
+        _VALUE.pack_into(self._map, position, 0.0)
+        self._used += needed
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def _grow(self, needed):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+
+def read_metric_file(path):
+    """
+    Yields the ((name, labels), value) entries of a MetricFile.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        return
+    used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+    position = _HEADER.size
+    while position + _LENGTH.size <= used:
+        length = _LENGTH.unpack_from(data, position)[0]
+        start = position + _LENGTH.size
+        padded = length + (-(_LENGTH.size + length) % 8)
+        name, labels = json.loads(data[start:start + length])
+        value = _VALUE.unpack_from(data, start + padded)[0]
+        yield (name, tuple(tuple(label) for label in labels)), value
+        position = start + padded + _VALUE.size
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    ) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metrics:
+    """
+    Metrics of all the processes serving one app. Each process writes to
+    its own MetricFile in ``directory``, so recording a value only takes
+    that process's lock. A scrape reads and adds up every file.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+
+    def _values(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # First use in this process, which may be a fork of the one
+            # that created the app
+            with self._lock:
+                if self._pid != pid:
+                    claimed = self._claim_dead(pid)
+                    self._file = MetricFile(os.path.join(self.directory, "metrics-{}.db".format(pid)))
+                    self._fold(claimed)
+                    self._pid = pid
+        return self._file
+
+    def _claim_dead(self, pid):
+        """
+        Renames the files of processes that have exited out of the way,
+        including one left by an earlier process with this pid. The rename
+        makes sure only one new process folds each file.
+        """
+        claimed = []
+        for filename in os.listdir(self.directory):
+            if not filename.startswith("metrics-"):
+                continue
+            owner = int(filename[len("metrics-"):-len(".db")])
+            if owner != pid and process_alive(owner):
+                continue
+            path = os.path.join(self.directory, "folding-{}-{}".format(pid, filename))
+            try:
+                os.rename(os.path.join(self.directory, filename), path)
+            except FileNotFoundError:
+                continue
+            claimed.append(path)
+        return claimed
+
+    def _fold(self, paths):
+        # Counters of exited processes carry on in this one's file, their
+        # gauges end with them
+        for path in paths:
+            for key, value in read_metric_file(path):
+                if key[0] not in GAUGES:
+                    self._file.add(key, value)
+            os.remove(path)
+
+    def inc(self, name, labels=(), amount=1.0):
+        self._values().add((name, labels), amount)
+
+    def set(self, name, labels=(), value=0.0):
+        self._values().set((name, labels), value)
+
+    def observe(self, name, labels, value):
+        values = self._values()
+        le = BUCKETS[bisect_left(BUCKETS, value)]
+        values.add((name + "_bucket", labels + (("le", le),)), 1)
+        values.add((name + "_sum", labels), value)
+        values.add((name + "_count", labels), 1)
+
+    def collect(self):
+        """
+        The values of every process added up, as {(name, labels): value}.
+        """
+        totals = {}
+        for filename in os.listdir(self.directory):
+            if not filename.startswith("metrics-"):
+                continue
+            alive = process_alive(int(filename[len("metrics-"):-len(".db")]))
+            for key, value in read_metric_file(os.path.join(self.directory, filename)):
+                if key[0] in GAUGES and not alive:
+                    continue
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    def render(self):
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        totals = self.collect()
+        families = {}
+        for (name, labels), value in totals.items():
+            for suffix in ("_bucket", "_sum", "_count", ""):
+                family = name[:len(name) - len(suffix)] if suffix else name
+                if name.endswith(suffix) and family in FAMILIES:
+                    families.setdefault(family, []).append((name, labels, value))
+                    break
+
+        hits = {}
+        for (name, labels), value in totals.items():
+            if name == "cookbook_cache_requests_total":
+                labels = dict(labels)
+                counts = hits.setdefault(labels["cache"], [0.0, 0.0])
+                counts[0 if labels["result"] in HIT_RESULTS else 1] += value
+
+        lines = []
+        for family in sorted(families):
+            kind, help_text = FAMILIES[family]
+            lines.append("# HELP {} {}".format(family, help_text))
+            lines.append("# TYPE {} {}".format(family, kind))
+            if kind == "histogram":
+                samples = self._cumulative(families[family])
+            else:
+                samples = sorted(families[family], key=lambda sample: str(sample[1]))
+            for name, labels, value in samples:
+                lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+        if hits:
+            lines.append("# HELP cookbook_cache_hit_ratio Share of cache lookups that were hits, by cache.")
+            lines.append("# TYPE cookbook_cache_hit_ratio gauge")
+            for cache, (hit, miss) in sorted(hits.items()):
+                ratio = hit / (hit + miss) if hit + miss else 0.0
+                lines.append('cookbook_cache_hit_ratio{{cache="{}"}} {}'.format(cache, _format_value(ratio)))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _cumulative(samples):
+        buckets = {}
+        others = []
+        for name, labels, value in samples:
+            if name.endswith("_bucket"):
+                le = dict(labels)["le"]
+                rest = tuple(label for label in labels if label[0] != "le")
+                buckets.setdefault((name, rest), {})[le] = value
+            else:
+                others.append((name, labels, value))
+        cumulative = []
+        for (name, rest), counts in buckets.items():
+            running = 0.0
+            for le in BUCKETS:
+                running += counts.get(le, 0.0)
+                cumulative.append((name, rest + (("le", _format_value(le)),), running))
+        # Keep the buckets in le order rather than sorting them as text
+        order = {_format_value(le): number for number, le in enumerate(BUCKETS)}
+        cumulative.sort(key=lambda sample: (str(sample[1][:-1]), order[sample[1][-1][1]]))
+        return cumulative + others
+
+
+def count(name, **labels):
+    """
+    Increments counter ``name`` of the current app, if it keeps metrics.
+    """
+    metrics = current_app.extensions.get(_EXTENSION) if has_app_context() else None
+    if metrics is not None:
+        metrics.inc(name, tuple(sorted(labels.items())))
+
+def _record_request(response):
+    from .timing import request_timing
+
+    metrics = current_app.extensions[_EXTENSION]
+    timing = request_timing()
+    endpoint = request.endpoint or "none"
+    status = str(response.status_code)
+    metrics.inc("cookbook_requests_total", (
+        ("endpoint", endpoint), ("method", request.method), ("status", status)
+    ))
+    metrics.observe(
+        "cookbook_request_duration_seconds",
+        (("endpoint", endpoint), ("status", status)),
+        time.perf_counter() - timing.start
+    )
+    if timing.queries:
+        labels = (("endpoint", endpoint),)
+        metrics.inc("cookbook_db_queries_total", labels, timing.queries)
+        metrics.inc("cookbook_db_seconds_total", labels, timing.db)
+    return response
+
+def _pool_listeners(metrics, pool_name, engine):
+    labels = (("pool", pool_name),)
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        # NullPool, the default for SQLite files, keeps nothing open
+        size = engine.pool.size() if hasattr(engine.pool, "size") else 0
+        metrics.set("cookbook_db_pool_size", labels, size)
+        metrics.inc("cookbook_db_pool_checked_out", labels)
+
+    def checkin(dbapi_connection, connection_record):
+        metrics.inc("cookbook_db_pool_checked_out", labels, -1)
+
+    return checkout, checkin
+
+
+def default_metrics_directory():
+    """
+    A temporary directory shared by every app of this process and the
+    processes forked from it, removed when this process exits.
+    """
+    global _default_directory
+    with _default_directory_lock:
+        if _default_directory is None:
+            _default_directory = tempfile.mkdtemp(prefix="cookbook-metrics-")
+            owner, directory = os.getpid(), _default_directory
+            atexit.register(lambda: os.getpid() == owner and shutil.rmtree(directory, ignore_errors=True))
+        return _default_directory
+
+def init_metrics(app, engines):
+    """
+    Records request, query, pool and cache metrics for ``app``. The files
+    go to METRICS_DIR, which all worker processes must share; by default
+    a temporary directory of this process is used, which works when the
+    workers are forked after the app is created.
+    """
+    directory = app.config.get("METRICS_DIR") or default_metrics_directory()
+    os.makedirs(directory, exist_ok=True)
+    with _default_directory_lock:
+        # One Metrics per directory and process, which owns the process's file
+        metrics = _instances.setdefault(os.path.abspath(directory), Metrics(directory))
+    app.extensions[_EXTENSION] = metrics
+    for pool_name, engine in engines.items():
+        if engine is None:
+            continue
+        checkout, checkin = _pool_listeners(metrics, pool_name, engine)
+        event.listen(engine, "checkout", checkout)
+        event.listen(engine, "checkin", checkin)
+    app.after_request(_record_request)
+
+def get_metrics():
+    return current_app.extensions[_EXTENSION]
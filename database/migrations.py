@@ -0,0 +1,48 @@
+import logging
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Ordered list of (version, description, statements). db.create_all() only
+# creates missing tables, so every change to an existing table has to be
+# added here as well. Statements must be safe to run on a database that
+# create_all() has just built with the current models.
+MIGRATIONS = [
+    (1, "Secondary indexes for user name, recipe owner and ingredient lookups", [
+        "CREATE INDEX IF NOT EXISTS ix_user_name ON user (name)",
+        "CREATE INDEX IF NOT EXISTS ix_recipe_user_id ON recipe (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_recipeingredient_ingredient_id ON recipeingredient (ingredient_id)",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+def run_migrations(engine):
+    """
+    Applies the migrations newer than the database's PRAGMA user_version,
+    each in its own transaction together with the version bump, so a
+    running cookbook.db can be upgraded in place at startup.
+    """
+    if engine.dialect.name != "sqlite":
+        return []
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        with engine.begin() as conn:
+            # pysqlite only opens a transaction implicitly before DML, not
+            # before CREATE INDEX or PRAGMA. The production profile's
+            # begin event has already opened one.
+            if not conn.connection.dbapi_connection.in_transaction:
+                conn.exec_driver_sql("BEGIN")
+            if schema_version(conn) >= version:
+                continue
+            logger.info("Applying schema migration %s: %s", version, description)
+            for statement in statements:
+                conn.execute(text(statement))
+            conn.execute(text("PRAGMA user_version = {:d}".format(version)))
+        applied.append(version)
+    return applied
@@ -1,11 +1,11 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, Text
 from sqlalchemy.orm import relationship, backref
 from . import db
 
 class Recipeingredient(db.Model):
     __tablename__ = 'recipeingredient'
     id = Column(Integer, ForeignKey('recipe.id'), primary_key=True)
-    ingredient_id = Column(Integer, ForeignKey('ingredient.id'), primary_key=True)
+    ingredient_id = Column(Integer, ForeignKey('ingredient.id'), primary_key=True, index=True)
     amount = Column(Integer)
     unit_id = Column(Integer, ForeignKey('unit.id'), primary_key=True)
 
@@ -13,10 +13,35 @@ class Recipeingredient(db.Model):
     ingredient = relationship("Ingredient", backref=backref("recipeingredients", cascade="all, delete-orphan" ))
     unit = relationship("Unit", backref=backref("recipeingredients", cascade="all, delete-orphan" ))
 
+    @staticmethod
+    def json_schema():
+        schema = {
+            "type": "object",
+            "required": ["id", "ingredient_id", "unit_id"]
+        }
+        props = schema["properties"] = {}
+        props["id"] = {
+            "description": "Id of the recipe",
+            "type": "integer"
+        }
+        props["ingredient_id"] = {
+            "description": "Id of the ingredient",
+            "type": "integer"
+        }
+        props["unit_id"] = {
+            "description": "Id of the unit the amount is in",
+            "type": "integer"
+        }
+        props["amount"] = {
+            "description": "Amount of the ingredient",
+            "type": ["integer", "null"]
+        }
+        return schema
+
 class Recipe(db.Model):
     __tablename__ = 'recipe'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("user.id"))
+    user_id = Column(Integer, ForeignKey("user.id"), index=True)
     name = Column(String(64), unique=True, nullable=False)
     difficulty = Column(String(20), nullable=True)
     description = Column(String(2000), nullable=False)
@@ -32,18 +57,20 @@ class Recipe(db.Model):
         props = schema["properties"] = {}
         props["name"] = {
             "description": "Name of the recipe",
-            "type": "string"
+            "type": "string",
+            "maxLength": 64
         }
         props["description"] = {
             "description": "Description of the recipe",
-            "type": "string"
+            "type": "string",
+            "maxLength": 2000
         }
         return schema
 
 class User(db.Model):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True)
-    name = Column(String(100), unique=False, nullable=False)
+    name = Column(String(100), unique=False, nullable=False, index=True)
     address = Column(String(100), nullable=True)
     email = Column(String(100), nullable=False, unique=True)
     password = Column(String(100), nullable=False)
@@ -77,9 +104,46 @@ class Ingredient(db.Model):
     id = Column(Integer, primary_key=True)
     name = Column(String(100), unique=True, nullable=False)
 
+    @staticmethod
+    def json_schema():
+        schema = {
+            "type": "object",
+            "required": ["name"]
+        }
+        props = schema["properties"] = {}
+        props["name"] = {
+            "description": "Name of the ingredient",
+            "type": "string",
+            "maxLength": 100
+        }
+        return schema
+
     
 class Unit(db.Model):
     __tablename__ = "unit"
     id = Column(Integer, primary_key=True)
     unit = Column(String(30), nullable=False)
 
+class ResourceVersion(db.Model):
+    __tablename__ = "resource_version"
+    key = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class Job(db.Model):
+    """
+    A background job, see database/jobs.py. ``params`` and ``result`` are
+    JSON documents and the times are Unix timestamps.
+    """
+    __tablename__ = "job"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(32), nullable=False)
+    status = Column(String(16), nullable=False, index=True)
+    params = Column(Text, nullable=False, default="{}")
+    result = Column(Text)
+    error = Column(Text)
+    done = Column(Integer, nullable=False, default=0)
+    total = Column(Integer)
+    pid = Column(Integer)
+    created = Column(Float, nullable=False)
+    started = Column(Float)
+    finished = Column(Float)
@@ -0,0 +1,38 @@
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+
+from . import db
+from .models import Recipe, Recipeingredient, User
+
+
+def users_with_recipes():
+    """
+    Users owning at least one recipe, with their recipes loaded by the same
+    JOIN so listing them is a single round-trip.
+    """
+    return db.session.query(User).join(User.user).options(
+        contains_eager(User.user)
+    ).order_by(User.id, Recipe.id)
+
+def with_ingredients(query):
+    """
+    Adds eager loading of the recipeingredient rows, their ingredient and
+    their unit to a Recipe query. The rows for the whole result set come
+    back in one extra SELECT ... WHERE id IN (...) instead of one per recipe.
+    """
+    return query.options(
+        selectinload(Recipe.recipeingredients).joinedload(Recipeingredient.ingredient),
+        selectinload(Recipe.recipeingredients).joinedload(Recipeingredient.unit),
+    )
+
+def recipes_with_ingredients():
+    return with_ingredients(db.session.query(Recipe)).order_by(Recipe.id)
+
+def ingredient_rows(recipe):
+    """
+    Ingredients of an eagerly loaded recipe as [name, amount, unit] lists,
+    the same shape RecipeItem has always returned.
+    """
+    return [
+        [row.ingredient.name, row.amount, row.unit.unit]
+        for row in recipe.recipeingredients
+    ]
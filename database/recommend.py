@@ -0,0 +1,322 @@
+import heapq
+import threading
+from collections import Counter
+from itertools import chain
+
+import numpy as np
+from flask import current_app, has_app_context
+from scipy import sparse
+from sqlalchemy import event, inspect, select
+
+from .caching import current_versions, flushed_versions
+from .matching import committed_pair
+from .models import Recipe, Recipeingredient
+
+VERSION_KEYS = ("recipes", "recipeingredients")
+# The overlay of changed recipes is folded into the matrices once it holds
+# more than this many recipes, or this share of the catalogue
+COMPACT_MIN = 1000
+COMPACT_SHARE = 0.05
+
+
+class RecipeRecommender:
+    """
+    Recommends recipes that use the ingredients a user has cooked with.
+
+    The catalogue is a sparse recipe x ingredient count matrix. Recipe
+    vectors are its rows with idf weights, normalised to unit length, and a
+    user's taste is the precomputed user x ingredient row that sums the
+    counts of the recipes they wrote. Scoring every recipe against a user
+    is one sparse matrix-vector product.
+
+    Recipes committed since the matrices were built live in a small
+    overlay: they are left out of the matrix product, scored one by one
+    and merged with the best matrix results through a heap. When the
+    overlay grows past COMPACT_MIN or COMPACT_SHARE it is folded back into
+    the matrices in memory. Like IngredientIndex, ``versions`` tells which
+    resource versions the model reflects, and writes of other processes
+    force a reload.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self.versions = None
+
+    def load(self, session):
+        versions = current_versions(session, VERSION_KEYS)
+        # Flattening plain rows is much faster than letting numpy or the
+        # ORM look at hundreds of thousands of Row objects
+        rows = session.connection().execute(select(Recipeingredient.id, Recipeingredient.ingredient_id))
+        pairs = np.fromiter(chain.from_iterable(rows), dtype=np.int64).reshape(-1, 2)
+        owners = dict(session.connection().execute(select(Recipe.id, Recipe.user_id)).all())
+        with self._lock:
+            self._build(pairs[:, 0], pairs[:, 1], owners)
+            self.versions = versions
+            self.loaded = True
+
+    def ensure_current(self, session):
+        if not self.loaded or current_versions(session, VERSION_KEYS) != self.versions:
+            self.load(session)
+
+    def _build(self, pair_recipes, pair_ingredients, owners):
+        """
+        Builds the matrices from one (recipe id, ingredient id) pair per
+        recipeingredient row and the {recipe id: user id} of every recipe.
+        """
+        recipe_ids = np.array(sorted(owners), dtype=np.int64)
+        ingredient_ids = np.unique(pair_ingredients)
+        known = np.isin(pair_recipes, recipe_ids)
+        rows = np.searchsorted(recipe_ids, pair_recipes[known])
+        cols = np.searchsorted(ingredient_ids, pair_ingredients[known])
+        shape = (len(recipe_ids), len(ingredient_ids))
+
+        counts = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+        counts.sum_duplicates()
+        present = counts.copy()
+        present.data[:] = 1.0
+        document_frequency = np.bincount(present.indices, minlength=shape[1])
+        idf = np.log((1.0 + shape[0]) / (1.0 + document_frequency)) + 1.0
+        weighted = present.multiply(idf).tocsr()
+        norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+
+        owner_of = np.array([
+            -1 if owners[recipe_id] is None else owners[recipe_id] for recipe_id in recipe_ids.tolist()
+        ], dtype=np.int64)
+        user_ids = np.unique(owner_of[owner_of >= 0])
+        owned = owner_of >= 0
+        authorship = sparse.csr_matrix(
+            (np.ones(owned.sum()), (np.searchsorted(user_ids, owner_of[owned]), np.flatnonzero(owned))),
+            shape=(len(user_ids), shape[0])
+        )
+
+        self._recipe_ids = recipe_ids
+        self._rows = dict(zip(recipe_ids.tolist(), range(shape[0])))
+        self._columns = dict(zip(ingredient_ids.tolist(), range(shape[1])))
+        self._idf = idf
+        self._new_idf = np.log((1.0 + shape[0]) / 2.0) + 1.0
+        self._counts = counts
+        self._vectors = sparse.diags(1.0 / norms) @ weighted
+        self._owner_of = owner_of
+        self._users = dict(zip(user_ids.tolist(), range(len(user_ids))))
+        self._profiles = (authorship @ counts).tocsr()
+        self._overlay = {}
+        self._in_overlay = np.zeros(shape[0], dtype=bool)
+
+    def _column(self, ingredient_id):
+        column = self._columns.get(ingredient_id)
+        if column is None:
+            # An ingredient the matrices have not seen, weighted as if it
+            # appeared in a single recipe until the next compaction
+            column = self._columns[ingredient_id] = len(self._idf)
+            self._idf = np.append(self._idf, self._new_idf)
+        return column
+
+    def _base_row(self, recipe_id):
+        row = self._rows.get(recipe_id)
+        if row is None:
+            return None, None
+        start, end = self._counts.indptr[row], self._counts.indptr[row + 1]
+        counts = Counter(dict(zip(
+            self._counts.indices[start:end].tolist(), self._counts.data[start:end].astype(int).tolist()
+        )))
+        owner = int(self._owner_of[row])
+        return (None if owner < 0 else owner), counts
+
+    def _touch(self, recipe_id):
+        """
+        The overlay entry of ``recipe_id``, created from the matrices on
+        first change: [owner, Counter of columns, owner and Counter in the
+        matrices]. Deleted recipes have None for the current Counter.
+        """
+        entry = self._overlay.get(recipe_id)
+        if entry is None:
+            owner, counts = self._base_row(recipe_id)
+            entry = self._overlay[recipe_id] = [owner, Counter(counts), owner, counts]
+            row = self._rows.get(recipe_id)
+            if row is not None:
+                self._in_overlay[row] = True
+        return entry
+
+    def advance(self, flushed, added=(), removed=(), owners=None, deleted=()):
+        """
+        Applies changes committed by this process. ``flushed`` are the
+        (before, after) versions of the transaction, see IngredientIndex.
+        """
+        with self._lock:
+            if not self.loaded:
+                return
+            moved = {key: flushed[key] for key in VERSION_KEYS if key in flushed}
+            if any(self.versions[key] != before for key, (before, _) in moved.items()):
+                self.loaded = False
+                return
+            for recipe_id, ingredient_id in added:
+                entry = self._touch(recipe_id)
+                if entry[1] is not None:
+                    entry[1][self._column(ingredient_id)] += 1
+            for recipe_id, ingredient_id in removed:
+                entry = self._touch(recipe_id)
+                column = self._column(ingredient_id)
+                if entry[1] is not None and entry[1][column] > 0:
+                    entry[1][column] -= 1
+                    if not entry[1][column]:
+                        del entry[1][column]
+            for recipe_id, user_id in (owners or {}).items():
+                self._touch(recipe_id)[0] = user_id
+            for recipe_id in deleted:
+                entry = self._touch(recipe_id)
+                entry[0] = entry[1] = None
+            for key, (_, after) in moved.items():
+                self.versions[key] = after
+            if len(self._overlay) > max(COMPACT_MIN, COMPACT_SHARE * len(self._recipe_ids)):
+                self._compact()
+
+    def compact(self):
+        """
+        Folds the overlay into the matrices now rather than when it is full.
+        """
+        with self._lock:
+            if self.loaded and self._overlay:
+                self._compact()
+
+    def _compact(self):
+        coo = self._counts.tocoo()
+        keep = ~self._in_overlay[coo.row]
+        recipes = [np.repeat(self._recipe_ids[coo.row[keep]], coo.data[keep].astype(np.int64))]
+        columns = [np.repeat(coo.col[keep], coo.data[keep].astype(np.int64))]
+        ingredient_of = np.empty(len(self._idf), dtype=np.int64)
+        for ingredient_id, column in self._columns.items():
+            ingredient_of[column] = ingredient_id
+
+        owners = {
+            recipe_id: (None if owner < 0 else owner)
+            for recipe_id, owner, changed in zip(
+                self._recipe_ids.tolist(), self._owner_of.tolist(), self._in_overlay.tolist()
+            ) if not changed
+        }
+        for recipe_id, (owner, counts, _, _) in self._overlay.items():
+            if counts is None:
+                continue
+            owners[recipe_id] = owner
+            for column, number in counts.items():
+                recipes.append(np.full(number, recipe_id, dtype=np.int64))
+                columns.append(np.full(number, column, dtype=np.int64))
+        self._build(np.concatenate(recipes), ingredient_of[np.concatenate(columns)], owners)
+
+    def _profile(self, user_id):
+        profile = np.zeros(len(self._idf))
+        position = self._users.get(user_id)
+        if position is not None:
+            row = self._profiles.getrow(position)
+            profile[row.indices] = row.data
+        for owner, counts, base_owner, base_counts in self._overlay.values():
+            if base_owner == user_id:
+                for column, number in base_counts.items():
+                    profile[column] -= number
+            if owner == user_id and counts is not None:
+                for column, number in counts.items():
+                    profile[column] += number
+        return profile
+
+    def recommend(self, user_id, limit=10):
+        """
+        Up to ``limit`` (recipe id, score) pairs for the user, best first,
+        leaving out the user's own recipes. Scores are cosine similarities
+        between the recipe and the user's taste.
+        """
+        with self._lock:
+            taste = self._profile(user_id) * self._idf
+            norm = np.linalg.norm(taste)
+            if norm == 0:
+                return []
+            taste /= norm
+
+            scores = self._vectors @ taste[:self._vectors.shape[1]]
+            scores[self._in_overlay | (self._owner_of == user_id)] = 0.0
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > limit:
+                best = np.argpartition(scores[candidates], -limit)[-limit:]
+                candidates = candidates[best]
+            from_matrix = zip(scores[candidates].tolist(), self._recipe_ids[candidates].tolist())
+
+            from_overlay = []
+            for recipe_id, (owner, counts, _, _) in self._overlay.items():
+                if counts and owner != user_id:
+                    columns = np.fromiter(counts, dtype=np.int64)
+                    weights = self._idf[columns]
+                    score = float(weights @ taste[columns] / np.linalg.norm(weights))
+                    if score > 0:
+                        from_overlay.append((score, recipe_id))
+
+            return [
+                (recipe_id, score)
+                for score, recipe_id in heapq.nlargest(limit, chain(from_matrix, from_overlay))
+            ]
+
+
+_EXTENSION = "cookbook_recommender"
+_PENDING = "recommender_changes"
+
+
+def get_recommender(session=None):
+    """
+    The recommender of the current app. Passing ``session`` (re)builds it
+    first if it is not loaded or out of date.
+    """
+    recommender = current_app.extensions[_EXTENSION]
+    if session is not None:
+        recommender.ensure_current(session)
+    return recommender
+
+
+def _collect_changes(session, flush_context):
+    added, removed, owners, deleted = [], [], {}, []
+    for obj in session.new:
+        if isinstance(obj, Recipeingredient):
+            added.append((obj.id, obj.ingredient_id))
+        elif isinstance(obj, Recipe):
+            owners[obj.id] = obj.user_id
+    for obj in session.dirty:
+        if isinstance(obj, Recipeingredient) and session.is_modified(obj):
+            removed.append(committed_pair(obj))
+            added.append((obj.id, obj.ingredient_id))
+        elif isinstance(obj, Recipe) and inspect(obj).attrs.user_id.history.has_changes():
+            owners[obj.id] = obj.user_id
+    for obj in session.deleted:
+        if isinstance(obj, Recipeingredient):
+            removed.append(committed_pair(obj))
+        elif isinstance(obj, Recipe):
+            deleted.append(obj.id)
+    if added or removed or owners or deleted:
+        session.info.setdefault(_PENDING, []).append((added, removed, owners, deleted))
+
+def _apply_changes(session):
+    changes = session.info.pop(_PENDING, [])
+    if not changes or not has_app_context():
+        return
+    recommender = current_app.extensions.get(_EXTENSION)
+    if recommender is None:
+        return
+    added, removed, owners, deleted = [], [], {}, []
+    for flush_added, flush_removed, flush_owners, flush_deleted in changes:
+        added.extend(flush_added)
+        removed.extend(flush_removed)
+        owners.update(flush_owners)
+        deleted.extend(flush_deleted)
+    recommender.advance(flushed_versions(session), added, removed, owners, deleted)
+
+def _discard_on_rollback(session, previous_transaction):
+    session.info.pop(_PENDING, None)
+
+
+def init_recommender(app, session):
+    """
+    Gives ``app`` its own recommender, built on first use and kept in step
+    with the recipes committed through ``session``.
+    """
+    app.extensions[_EXTENSION] = RecipeRecommender()
+    if not event.contains(session, "after_flush", _collect_changes):
+        event.listen(session, "after_flush", _collect_changes)
+        event.listen(session, "after_commit", _apply_changes)
+        event.listen(session, "after_soft_rollback", _discard_on_rollback)
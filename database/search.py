@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+
+from sqlalchemy import bindparam, text
+
+SEARCH_TABLE = "recipe_search"
+INSERT_TRIGGERS = ("recipe_search_insert", "recipe_search_ingredient_insert")
+
+_INGREDIENT_NAMES = (
+    "(SELECT group_concat(ingredient.name, ' ') FROM recipeingredient "
+    "JOIN ingredient ON ingredient.id = recipeingredient.ingredient_id "
+    "WHERE recipeingredient.id = {recipe_id})"
+)
+
+# The triggers keep the index in the same transaction as the write that
+# changed the recipe, whichever handler (or bulk insert) made it.
+_SCHEMA = [
+    "CREATE VIRTUAL TABLE recipe_search USING fts5("
+    "name, description, ingredients, tokenize = 'unicode61 remove_diacritics 2')",
+
+    "CREATE TRIGGER recipe_search_insert AFTER INSERT ON recipe BEGIN "
+    "INSERT INTO recipe_search (rowid, name, description, ingredients) "
+    "VALUES (new.id, new.name, new.description, ''); END",
+
+    "CREATE TRIGGER recipe_search_update AFTER UPDATE OF name, description ON recipe BEGIN "
+    "UPDATE recipe_search SET name = new.name, description = new.description "
+    "WHERE rowid = old.id; END",
+
+    "CREATE TRIGGER recipe_search_delete AFTER DELETE ON recipe BEGIN "
+    "DELETE FROM recipe_search WHERE rowid = old.id; END",
+
+    "CREATE TRIGGER recipe_search_ingredient_insert AFTER INSERT ON recipeingredient BEGIN "
+    "UPDATE recipe_search SET ingredients = " + _INGREDIENT_NAMES.format(recipe_id="new.id") +
+    " WHERE rowid = new.id; END",
+
+    "CREATE TRIGGER recipe_search_ingredient_delete AFTER DELETE ON recipeingredient BEGIN "
+    "UPDATE recipe_search SET ingredients = " + _INGREDIENT_NAMES.format(recipe_id="old.id") +
+    " WHERE rowid = old.id; END",
+
+    "CREATE TRIGGER recipe_search_ingredient_update AFTER UPDATE ON recipeingredient BEGIN "
+    "UPDATE recipe_search SET ingredients = " + _INGREDIENT_NAMES.format(recipe_id="recipe_search.rowid") +
+    " WHERE rowid IN (old.id, new.id); END",
+
+    "CREATE TRIGGER recipe_search_ingredient_rename AFTER UPDATE OF name ON ingredient BEGIN "
+    "UPDATE recipe_search SET ingredients = " + _INGREDIENT_NAMES.format(recipe_id="recipe_search.rowid") +
+    " WHERE rowid IN (SELECT id FROM recipeingredient WHERE ingredient_id = new.id); END",
+]
+
+
+def create_search_index(engine):
+    """
+    Creates the FTS5 index and its triggers if the database does not have
+    them yet, and fills it from the existing recipes.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+            {"name": SEARCH_TABLE}
+        ).first()
+        if exists:
+            return
+        for statement in _SCHEMA:
+            conn.execute(text(statement))
+        rebuild_search_index(conn)
+
+def rebuild_search_index(conn):
+    conn.execute(text("DELETE FROM recipe_search"))
+    conn.execute(text(
+        "INSERT INTO recipe_search (rowid, name, description, ingredients) "
+        "SELECT recipe.id, recipe.name, recipe.description, "
+        "coalesce(" + _INGREDIENT_NAMES.format(recipe_id="recipe.id") + ", '') FROM recipe"
+    ))
+
+@contextmanager
+def bulk_insert_recipes(conn, first_recipe_id):
+    """
+    For bulk inserts of new recipes with ids from ``first_recipe_id`` up,
+    inside the transaction of ``conn``. The insert triggers, which rewrite
+    the recipe's index entry for every ingredient row, are dropped while
+    the block runs and the new recipes are indexed in one statement at
+    the end. The triggers come back in the same transaction, so other
+    connections never see them missing.
+    """
+    triggers = []
+    if conn.dialect.name == "sqlite":
+        triggers = conn.execute(
+            text("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN :names")
+            .bindparams(bindparam("names", expanding=True)),
+            {"names": list(INSERT_TRIGGERS)}
+        ).all()
+    for name, _ in triggers:
+        conn.execute(text("DROP TRIGGER {}".format(name)))
+    yield
+    if not triggers:
+        return
+    conn.execute(text(
+        "INSERT INTO recipe_search (rowid, name, description, ingredients) "
+        "SELECT recipe.id, recipe.name, recipe.description, "
+        "coalesce(" + _INGREDIENT_NAMES.format(recipe_id="recipe.id") + ", '') "
+        "FROM recipe WHERE recipe.id >= :first"
+    ), {"first": first_recipe_id})
+    for _, sql in triggers:
+        conn.execute(text(sql))
+
+def match_expression(query):
+    """
+    Turns free text from the client into an FTS5 query: every word has to
+    match as a prefix, and FTS operators in the input are taken literally.
+    """
+    terms = ['"{}"*'.format(word.replace('"', '""')) for word in query.split()]
+    return " ".join(terms)
+
+def search_recipe_ids(session, query, limit, offset):
+    """
+    Ids of the recipes matching ``query``, best bm25 rank first.
+    """
+    rows = session.execute(
+        text(
+            "SELECT rowid FROM recipe_search WHERE recipe_search MATCH :query "
+            "ORDER BY rank LIMIT :limit OFFSET :offset"
+        ),
+        {"query": match_expression(query), "limit": limit, "offset": offset}
+    )
+    return [row[0] for row in rows]
@@ -0,0 +1,128 @@
+import multiprocessing
+
+from . import create_app, db
+from .admission import AdmissionControl
+from .engine import read_engine
+from .jobs import get_job_runner
+from .matching import get_ingredient_index
+from .metrics import default_metrics_directory
+from .recommend import get_recommender
+from .models import Ingredient, Recipe, Recipeingredient, User
+from .validation import compiled_validator
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # gunicorn does not run on Windows
+    BaseApplication = object
+
+# Requests sent through the app before it takes traffic, to fill the URL
+# template and response caches. Override with the WARMUP_PATHS config value.
+WARMUP_PATHS = ("/api/", "/api/recipes/", "/api/users")
+VALIDATED_MODELS = (Recipe, User, Ingredient, Recipeingredient)
+# Periodic jobs of every worker unless JOB_SCHEDULE is configured, see
+# database/tasks.py
+SERVE_JOB_SCHEDULE = {"refresh": 300}
+
+
+def warm_up(app):
+    """
+    Does the one-off work of the first requests ahead of time: compiles the
+    schema validators, builds the ingredient index and the recommender and
+    sends WARMUP_PATHS through the app. Closes every database connection
+    afterwards, as this runs in the gunicorn master and connections must
+    not cross a fork.
+    """
+    with app.app_context():
+        for model in VALIDATED_MODELS:
+            compiled_validator(model)
+        get_ingredient_index(db.session)
+        get_recommender(db.session)
+        db.session.remove()
+
+    # Warm-up requests go past admission control, they are no client's
+    wsgi_app = app.wsgi_app
+    if isinstance(wsgi_app, AdmissionControl):
+        app.wsgi_app = wsgi_app.wsgi_app
+    client = app.test_client()
+    try:
+        for path in app.config.get("WARMUP_PATHS", WARMUP_PATHS):
+            client.get(path).close()
+    finally:
+        app.wsgi_app = wsgi_app
+
+    with app.app_context():
+        # Jobs run in the workers, which start their own threads
+        get_job_runner().stop()
+        db.session.remove()
+        db.engine.dispose()
+        reader = read_engine()
+        if reader is not None:
+            reader.dispose()
+
+def warm_connections(app):
+    """
+    Opens the connections of the write and read pools of a fresh worker so
+    its first requests do not pay for connecting and running the pragmas.
+    """
+    with app.app_context():
+        for engine in (db.engine, read_engine()):
+            if engine is None:
+                continue
+            size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+            connections = [engine.connect() for _ in range(size)]
+            for connection in connections:
+                connection.exec_driver_sql("SELECT 1")
+                connection.close()
+
+def _post_fork(server, worker):
+    warm_connections(worker.app.wsgi())
+
+def serve_options(bind="127.0.0.1:8000", workers=None, threads=1, preload=True, timeout=30):
+    """
+    Gunicorn settings for the cookbook. With ``preload`` the app is created
+    and warmed up once in the master and shared by the forked workers; a
+    HUP then restarts the workers gracefully but keeps the loaded code.
+    Without it every worker loads the app itself and a HUP reloads code.
+    """
+    return {
+        "bind": bind,
+        "workers": workers or multiprocessing.cpu_count(),
+        "threads": threads,
+        "worker_class": "gthread" if threads > 1 else "sync",
+        "preload_app": preload,
+        "timeout": timeout,
+        "graceful_timeout": timeout,
+        "post_fork": _post_fork,
+    }
+
+
+class CookbookServer(BaseApplication):
+    """
+    Runs ``create_app(app_config)`` under gunicorn with the production
+    database profile and admission control unless ``app_config`` selects
+    otherwise.
+    """
+
+    def __init__(self, options, app_config=None):
+        if BaseApplication is object:
+            raise RuntimeError("gunicorn is required to serve the cookbook, see requirements.txt")
+        self.options = options
+        self.app_config = {
+            "DATABASE_PROFILE": "production", "JOB_SCHEDULE": SERVE_JOB_SCHEDULE,
+            "ADMISSION_CONTROL": True, **(app_config or {})
+        }
+        # Workers that load the app themselves must still share one
+        # metrics directory for /api/metrics to cover all of them. It
+        # belongs to the master and goes away when the master exits.
+        if "METRICS_DIR" not in self.app_config:
+            self.app_config["METRICS_DIR"] = default_metrics_directory()
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        app = create_app(self.app_config)
+        warm_up(app)
+        return app
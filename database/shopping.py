@@ -0,0 +1,120 @@
+import numpy as np
+from sqlalchemy import case, func, literal
+
+from .models import Ingredient, Recipeingredient, Unit
+
+# Unit name (lower case): (dimension, size in the dimension's base unit).
+# Amounts in units of the same dimension are added up; units missing from
+# the table are only combined with units of the same name.
+UNIT_CONVERSIONS = {
+    "ml": ("volume", 1.0),
+    "millilitre": ("volume", 1.0),
+    "cl": ("volume", 10.0),
+    "dl": ("volume", 100.0),
+    "l": ("volume", 1000.0),
+    "litre": ("volume", 1000.0),
+    "liter": ("volume", 1000.0),
+    "tsp": ("volume", 4.92892),
+    "teaspoon": ("volume", 4.92892),
+    "tbsp": ("volume", 14.7868),
+    "tablespoon": ("volume", 14.7868),
+    "fl oz": ("volume", 29.5735),
+    "cup": ("volume", 236.588),
+    "mg": ("mass", 0.001),
+    "g": ("mass", 1.0),
+    "gram": ("mass", 1.0),
+    "kg": ("mass", 1000.0),
+    "oz": ("mass", 28.3495),
+    "lb": ("mass", 453.592),
+    "pcs": ("count", 1.0),
+    "pc": ("count", 1.0),
+    "piece": ("count", 1.0),
+    "dozen": ("count", 12.0),
+}
+AMOUNT_DECIMALS = 2
+
+
+def conversion(unit):
+    """
+    The (dimension, size) of a unit name. Unknown units are a dimension of
+    their own.
+    """
+    name = unit.strip().lower()
+    return UNIT_CONVERSIONS.get(name, ("unit:" + name, 1.0))
+
+def display_unit(total, sizes):
+    """
+    Of the units ``sizes`` ({name: size}) the amounts were given in, the
+    largest that still gives ``total`` base units as at least one.
+    """
+    ordered = sorted(sizes.items(), key=lambda item: item[1])
+    for name, size in reversed(ordered):
+        if total >= size:
+            return name, size
+    return ordered[0]
+
+def _number(value):
+    value = round(float(value), AMOUNT_DECIMALS)
+    return int(value) if value.is_integer() else value
+
+
+def shopping_list(session, servings):
+    """
+    Adds up the ingredients of the recipes ``servings`` maps ({recipe id:
+    times the amounts as written}) into [{"ingredient", "amount",
+    "unit"}], sorted by ingredient.
+
+    One grouped query sums the amounts per ingredient and unit, separately
+    for every distinct servings value. Scaling by the servings and
+    converting to the base units are then array operations over those
+    sums, and np.bincount adds them up per ingredient and dimension.
+    """
+    factors = sorted(set(servings.values()))
+    grouping = [Recipeingredient.ingredient_id, Recipeingredient.unit_id, Ingredient.name, Unit.unit]
+    bucket = literal(0)
+    if len(factors) > 1:
+        bucket = case(
+            {recipe_id: factors.index(factor) for recipe_id, factor in servings.items()},
+            value=Recipeingredient.id
+        )
+        grouping.append(bucket)
+    rows = session.query(
+        Ingredient.name,
+        Unit.unit,
+        bucket,
+        func.sum(Recipeingredient.amount),
+        func.count(Recipeingredient.amount),
+    ).join(
+        Ingredient, Ingredient.id == Recipeingredient.ingredient_id
+    ).join(
+        Unit, Unit.id == Recipeingredient.unit_id
+    ).filter(
+        Recipeingredient.id.in_(list(servings))
+    ).group_by(*grouping).all()
+    if not rows:
+        return []
+
+    groups = {}
+    group_of = np.empty(len(rows), dtype=np.int64)
+    sizes = np.empty(len(rows))
+    for number, (ingredient, unit, _, _, _) in enumerate(rows):
+        dimension, size = conversion(unit)
+        group = groups.setdefault((ingredient, dimension), [len(groups), {}])
+        group[1][unit] = size
+        group_of[number] = group[0]
+        sizes[number] = size
+    sums = np.array([row[3] or 0 for row in rows], dtype=float)
+    scale = np.array(factors, dtype=float)[np.array([row[2] for row in rows], dtype=np.int64)]
+    measured = np.bincount(group_of, weights=[row[4] for row in rows], minlength=len(groups))
+    totals = np.bincount(group_of, weights=sums * scale * sizes, minlength=len(groups))
+
+    items = []
+    for (ingredient, _), (position, units) in groups.items():
+        if not measured[position]:
+            # Only "to taste" rows, which have no amount to add up
+            items.append({"ingredient": ingredient, "amount": None, "unit": min(units)})
+            continue
+        unit, size = display_unit(totals[position], units)
+        items.append({"ingredient": ingredient, "amount": _number(totals[position] / size), "unit": unit})
+    items.sort(key=lambda item: (item["ingredient"], item["unit"]))
+    return items
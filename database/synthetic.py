@@ -0,0 +1,196 @@
+import random
+from itertools import accumulate, islice
+
+from sqlalchemy import func, insert, select
+
+from .caching import bump_versions, user_key
+from .models import Ingredient, Recipe, Recipeingredient, Unit, User
+from .search import bulk_insert_recipes
+
+BATCH_SIZE = 10000
+UNITS = ["g", "kg", "ml", "dl", "l", "Cup", "Teaspoon", "Tablespoon", "pcs"]
+DIFFICULTIES = ["Easy", "Medium", "Hard", None]
+WORDS = [
+    "mix", "stir", "bake", "boil", "chop", "fry", "whisk", "simmer", "season",
+    "serve", "cool", "slice", "pour", "fold", "knead", "roast", "grill", "taste",
+    "the", "and", "with", "until", "golden", "soft", "hot", "warm", "bowl", "pan",
+]
+
+
+def zipf_weights(count, exponent=1.0):
+    """
+    Cumulative weights for ``random.choices`` where the item at rank r is
+    picked in proportion to 1 / r ** exponent. A few users write most of
+    the recipes and a few ingredients, like salt, appear in most of them.
+    """
+    return list(accumulate(1.0 / rank ** exponent for rank in range(1, count + 1)))
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def _next_id(connection, column):
+    return (connection.execute(select(func.max(column))).scalar() or 0) + 1
+
+
+class SyntheticCookbook:
+    """
+    Generates a cookbook of ``users`` users, ``recipes`` recipes and
+    ``ingredients`` ingredients with on average ``rows_per_recipe``
+    ingredient rows per recipe. Recipe owners and ingredient use follow a
+    Zipf distribution. The same ``seed`` always gives the same data, and
+    names include it so cookbooks with different seeds can coexist.
+
+    ``write`` inserts everything in the caller's transaction. For larger
+    cookbooks call ``write_catalog`` once and then ``write_recipes`` for
+    consecutive ranges of recipe numbers, each in its own transaction; the
+    result is the same.
+    """
+
+    def __init__(self, users=100, recipes=1000, ingredients=200, rows_per_recipe=8, seed=0):
+        self.users = users
+        self.recipes = recipes
+        self.ingredients = ingredients
+        self.rows_per_recipe = min(rows_per_recipe, ingredients)
+        self.seed = seed
+        self.first_user = None
+        self.first_ingredient = None
+
+    @classmethod
+    def scaled(cls, scale, seed=0):
+        """
+        A cookbook with 1000 recipes and 100 users per unit of ``scale``.
+        The number of distinct ingredients grows with its square root.
+        """
+        return cls(
+            users=max(1, round(100 * scale)),
+            recipes=max(1, round(1000 * scale)),
+            ingredients=max(10, round(200 * scale ** 0.5)),
+            seed=seed,
+        )
+
+    def user_name(self, number):
+        return "User-{}-{}".format(self.seed, number)
+
+    def recipe_name(self, number):
+        return "Recipe-{}-{}".format(self.seed, number)
+
+    def ingredient_name(self, number):
+        return "Ingredient-{}-{}".format(self.seed, number)
+
+    def write(self, connection, batch_size=BATCH_SIZE):
+        """
+        Inserts the whole cookbook through ``connection`` with Core
+        executemany statements of ``batch_size`` rows, inside the caller's
+        transaction. Returns the number of rows written per table.
+        """
+        counts = self.write_catalog(connection, batch_size)
+        counts.update(self.write_recipes(connection, 0, self.recipes, batch_size))
+        return counts
+
+    def write_catalog(self, connection, batch_size=BATCH_SIZE):
+        """
+        Inserts the users and ingredients, which the recipes refer to.
+        """
+        # Bumping the versions first takes SQLite's write lock, so the ids
+        # read below stay free until the transaction ends
+        bump_versions(connection, {"users", "ingredients"})
+        self.first_user = _next_id(connection, User.id)
+        self.first_ingredient = _next_id(connection, Ingredient.id)
+        # One generator per kind of value, so splitting the recipes into
+        # ranges does not change the numbers drawn for them
+        self._owner_rng = random.Random("{}-owners".format(self.seed))
+        self._text_rng = random.Random("{}-text".format(self.seed))
+        self._row_rng = random.Random("{}-rows".format(self.seed))
+
+        counts = {}
+        counts["user"] = self._insert(connection, User, batch_size, (
+            {
+                "id": self.first_user + number,
+                "name": self.user_name(number),
+                "email": "user-{}-{}@example.com".format(self.seed, number),
+                "password": "synthetic",
+            } for number in range(self.users)
+        ))
+        counts["ingredient"] = self._insert(connection, Ingredient, batch_size, (
+            {"id": self.first_ingredient + number, "name": self.ingredient_name(number)}
+            for number in range(self.ingredients)
+        ))
+        return counts
+
+    def write_recipes(self, connection, start, stop, batch_size=BATCH_SIZE):
+        """
+        Inserts recipes number ``start`` to ``stop`` - 1 with their
+        ingredient rows. Ranges have to be written in order, after
+        ``write_catalog``.
+        """
+        if self.first_user is None:
+            raise RuntimeError("write_catalog has to be called before write_recipes")
+        numbers = range(start, min(stop, self.recipes))
+        owners = [None] * len(numbers)
+        if self.users:
+            owners = self._owner_rng.choices(
+                range(self.first_user, self.first_user + self.users),
+                cum_weights=zipf_weights(self.users), k=len(numbers)
+            )
+        # The owners' recipe collections change too
+        keys = {"recipes", "recipeingredients", "ingredients"}
+        keys.update(user_key(owner) for owner in set(owners) if owner is not None)
+        bump_versions(connection, keys)
+        first_recipe = _next_id(connection, Recipe.id)
+        unit_ids = self._units(connection)
+        ingredient_weights = zipf_weights(self.ingredients)
+        text_rng = self._text_rng
+        row_rng = self._row_rng
+
+        counts = {}
+        with bulk_insert_recipes(connection, first_recipe):
+            counts["recipe"] = self._insert(connection, Recipe, batch_size, (
+                {
+                    "id": first_recipe + offset,
+                    "name": self.recipe_name(number),
+                    "description": " ".join(text_rng.choices(WORDS, k=text_rng.randint(5, 40))),
+                    "difficulty": text_rng.choice(DIFFICULTIES),
+                    "user_id": owners[offset],
+                } for offset, number in enumerate(numbers)
+            ))
+            counts["recipeingredient"] = self._insert(connection, Recipeingredient, batch_size, (
+                {
+                    "id": first_recipe + offset,
+                    "ingredient_id": self.first_ingredient + ingredient,
+                    "unit_id": row_rng.choice(unit_ids),
+                    "amount": row_rng.randint(1, 500) if row_rng.random() > 0.05 else None,
+                }
+                for offset in range(len(numbers))
+                for ingredient in self._recipe_ingredients(row_rng, ingredient_weights)
+            ))
+        return counts
+
+    def _recipe_ingredients(self, rng, weights):
+        wanted = round(rng.gauss(self.rows_per_recipe, self.rows_per_recipe / 3))
+        wanted = min(self.ingredients, max(1, wanted))
+        chosen = set()
+        while len(chosen) < wanted:
+            chosen.update(rng.choices(range(self.ingredients), cum_weights=weights, k=wanted - len(chosen)))
+        return sorted(chosen)
+
+    @staticmethod
+    def _units(connection):
+        units = dict(connection.execute(select(Unit.unit, Unit.id)).all())
+        missing = [unit for unit in UNITS if unit not in units]
+        if missing:
+            connection.execute(insert(Unit.__table__), [{"unit": unit} for unit in missing])
+            units = dict(connection.execute(select(Unit.unit, Unit.id)).all())
+        return sorted(units[unit] for unit in UNITS)
+
+    @staticmethod
+    def _insert(connection, model, batch_size, rows):
+        written = 0
+        for batch in _batches(rows, batch_size):
+            connection.execute(insert(model.__table__), batch)
+            written += len(batch)
+        return written
@@ -0,0 +1,140 @@
+import os
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import orm, text
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .db_creator_V2 import populate_synthetic
+from .engine import read_engine
+from .exporter import EXPORT_FORMATS
+from .importer import RecipeImporter
+from .jobs import JOB_RETENTION, UNFINISHED, delete_old_jobs, fail_interrupted, job_type
+from .matching import get_ingredient_index
+from .models import Job, Recipe, Recipeingredient
+from .recommend import get_recommender
+from .search import rebuild_search_index
+
+# Recipes written per transaction by populate jobs, small enough for the
+# progress to move and for other writers to get the lock in between
+POPULATE_JOB_TRANSACTION = 10000
+
+
+@contextmanager
+def read_session():
+    """
+    A session on the read-only pool when there is one. Outside requests
+    db.session uses the primary engine, which in the production profile
+    takes the write lock for every transaction.
+    """
+    session = orm.Session(bind=read_engine() or db.engine)
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@job_type("import")
+def import_recipes(context, upload):
+    """
+    Imports the newline delimited JSON file ``upload`` in the job directory,
+    which RecipeImport saved from the request body, and deletes it.
+    """
+    path = os.path.join(context.directory, upload)
+    size = os.path.getsize(path)
+    try:
+        with open(path, "rb") as f:
+            importer = RecipeImporter(
+                db.session,
+                ingredient_index=get_ingredient_index(),
+                batch_size=current_app.config.get("IMPORT_BATCH_SIZE", 1000)
+            )
+            result = importer.run(f, on_batch=lambda: context.progress(f.tell(), size))
+        context.progress(size, size)
+    finally:
+        os.remove(path)
+    return result.to_dict()
+
+@job_type("export")
+def export_recipes(context, format="ndjson"):
+    """
+    Writes the export in ``format`` to a file of the job, which is then
+    served by JobResult.
+    """
+    lines, _ = EXPORT_FORMATS[format]
+    filename = os.path.basename(context.path("export." + format))
+    # The CSV header line is not a record
+    written = -1 if format == "csv" else 0
+    with read_session() as session:
+        if format == "csv":
+            # A record per recipe ingredient, or per recipe that has none
+            total = session.query(Recipe.id).outerjoin(
+                Recipeingredient, Recipeingredient.id == Recipe.id
+            ).count()
+        else:
+            total = session.query(Recipe.id).count()
+        with open(os.path.join(context.directory, filename), "w", encoding="utf-8") as f:
+            for line in lines(session, current_app.config.get("EXPORT_BATCH_SIZE", 1000)):
+                f.write(line)
+                written += 1
+                context.progress(max(written, 0), total)
+    context.progress(written, total)
+    return {
+        "file": filename,
+        "format": format,
+        "records": written,
+        "size": os.path.getsize(os.path.join(context.directory, filename)),
+    }
+
+@job_type("populate")
+def populate(context, scale, seed=0):
+    try:
+        counts = populate_synthetic(scale, seed, POPULATE_JOB_TRANSACTION, progress=context.progress)
+    except IntegrityError:
+        raise ValueError("Seed {} has already been used".format(seed))
+    return {"rows": counts}
+
+@job_type("rebuild-search")
+def rebuild_search(context):
+    """
+    Refills the full-text index from the recipe table and merges its
+    b-trees.
+    """
+    if db.engine.dialect.name != "sqlite":
+        return {}
+    context.progress(0, 2)
+    with db.engine.begin() as conn:
+        rebuild_search_index(conn)
+    context.progress(1, 2)
+    with db.engine.begin() as conn:
+        conn.execute(text("INSERT INTO recipe_search (recipe_search) VALUES ('optimize')"))
+    context.progress(2, 2)
+    with read_session() as session:
+        return {"recipes": session.query(Recipe.id).count()}
+
+@job_type("refresh")
+def refresh(context):
+    """
+    Periodic upkeep of this process and the database: brings the in-memory
+    ingredient index and recommender up to date, so the next request does
+    not pay for a rebuild after other processes have written, folds the
+    recommender's pending changes into its matrices, lets SQLite update
+    its statistics, records interrupted jobs as failed and deletes old
+    jobs.
+    """
+    context.progress(0, 3)
+    with read_session() as session:
+        get_ingredient_index(session)
+        get_recommender(session).compact()
+    context.progress(1, 3)
+    if db.engine.dialect.name == "sqlite":
+        with db.engine.begin() as conn:
+            conn.execute(text("PRAGMA optimize"))
+    context.progress(2, 3)
+    fail_interrupted(db.session, db.session.query(Job).filter(Job.status.in_(UNFINISHED)))
+    deleted = delete_old_jobs(
+        db.session, context.directory, current_app.config.get("JOB_RETENTION", JOB_RETENTION)
+    )
+    context.progress(3, 3)
+    return {"deleted_jobs": deleted}
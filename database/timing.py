@@ -0,0 +1,149 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, has_request_context, make_response, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+_QUERY_START = "cookbook_query_start"
+
+# json.dumps arguments of responses: compact unless the client asks for
+# ?pretty=true
+COMPACT_JSON = {"separators": (",", ":")}
+PRETTY_JSON = {"indent": 4, "separators": (",", ": "), "sort_keys": True}
+PRETTY_VALUES = ("1", "true", "yes")
+
+
+class RequestTiming:
+    """
+    Where the time of one request went. Lives in ``g`` and is created by
+    the first thing that measures something, which may be a query run by
+    a URL converter before any request hook.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.serialize = 0.0
+
+    def header(self, total):
+        """
+        Server-Timing header value, durations in milliseconds.
+        """
+        app_time = max(total - self.db - self.serialize, 0.0)
+        return ", ".join([
+            'db;dur={:.3f};desc="{} queries"'.format(self.db * 1000, self.queries),
+            "serialize;dur={:.3f}".format(self.serialize * 1000),
+            "app;dur={:.3f}".format(app_time * 1000),
+            "total;dur={:.3f}".format(total * 1000),
+        ])
+
+
+def request_timing():
+    """
+    The RequestTiming of the current request, or None outside requests.
+    """
+    if not has_request_context():
+        return None
+    timing = g.get("timing")
+    if timing is None:
+        timing = g.timing = RequestTiming()
+    return timing
+
+@contextmanager
+def timed_serialization():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing = request_timing()
+        if timing is not None:
+            timing.serialize += time.perf_counter() - start
+
+def pretty_requested():
+    return has_request_context() and request.args.get("pretty", "").lower() in PRETTY_VALUES
+
+def dumps(data, **kwargs):
+    """
+    json.dumps that counts as serialization time of the current request.
+    Without ``kwargs`` the output is compact, or indented with sorted keys
+    when the request asks for ?pretty=true.
+    """
+    if not kwargs:
+        kwargs = PRETTY_JSON if pretty_requested() else COMPACT_JSON
+    with timed_serialization():
+        return json.dumps(data, **kwargs)
+
+def output_json(data, code, headers=None):
+    """
+    flask_restful representation for handlers that return plain data, so
+    they are serialized like the rest. Also usable directly to return a
+    Response, which conditional_get needs to cache the body.
+    """
+    response = make_response(dumps(data) + "\n", code)
+    response.mimetype = "application/json"
+    response.headers.extend(headers or {})
+    return response
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(_QUERY_START, []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info[_QUERY_START].pop()
+    timing = request_timing()
+    if timing is not None:
+        timing.queries += 1
+        timing.db += elapsed
+    if not has_app_context():
+        return
+    slow = current_app.config.get("SLOW_QUERY_MS")
+    if slow is not None and elapsed * 1000 >= slow:
+        # URL converters run before the endpoint is known
+        route = "-"
+        if has_request_context():
+            route = request.endpoint or request.path
+        logger.warning("Slow query in %s (%.1f ms): %s", route, elapsed * 1000, statement)
+
+def _discard_failed(exception_context):
+    # A statement that raised never reaches after_cursor_execute
+    starts = exception_context.connection.info.get(_QUERY_START) if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+def _start_request():
+    request_timing()
+
+def _finish_request(response):
+    timing = request_timing()
+    total = time.perf_counter() - timing.start
+    if current_app.config.get("SERVER_TIMING", True):
+        response.headers["Server-Timing"] = timing.header(total)
+    slow = current_app.config.get("SLOW_REQUEST_MS")
+    if slow is not None and total * 1000 >= slow:
+        logger.warning(
+            "Slow request %s %s (%s, %d): %.1f ms, %d queries in %.1f ms, serialization %.1f ms",
+            request.method, request.full_path.rstrip("?"), request.endpoint, response.status_code,
+            total * 1000, timing.queries, timing.db * 1000, timing.serialize * 1000
+        )
+    return response
+
+
+def init_timing(app, engines):
+    """
+    Measures the queries run on ``engines`` and the requests of ``app``.
+    The totals go out in a Server-Timing header unless SERVER_TIMING is
+    false. Requests slower than SLOW_REQUEST_MS and statements slower than
+    SLOW_QUERY_MS are logged as warnings; both are off by default.
+    """
+    for engine in engines:
+        if engine is None or event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+            continue
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _discard_failed)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
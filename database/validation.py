@@ -0,0 +1,48 @@
+from functools import lru_cache
+
+from jsonschema import Draft7Validator, draft7_format_checker
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+
+@lru_cache(maxsize=None)
+def frozen_schema(model):
+    """
+    The model's JSON schema, built once and shared by every response that
+    carries it. Treat the returned dict as read-only.
+    """
+    return model.json_schema()
+
+def compile_schema(schema):
+    """
+    Checks ``schema`` once and returns a validator instance that can be
+    reused for any number of documents. Schemas without a $schema are
+    treated as draft 7.
+    """
+    cls = validator_for(schema, default=Draft7Validator)
+    cls.check_schema(schema)
+    return cls(schema, format_checker=draft7_format_checker)
+
+@lru_cache(maxsize=None)
+def compiled_validator(model):
+    return compile_schema(frozen_schema(model))
+
+def validation_error(model, document):
+    """
+    The most relevant schema violation of ``document``, or None if it is
+    valid for ``model``.
+    """
+    return best_match(compiled_validator(model).iter_errors(document))
+
+def validation_errors_many(model, documents):
+    """
+    Validates a bulk body in one pass with the same compiled validator and
+    returns an error entry for every invalid document.
+    """
+    validator = compiled_validator(model)
+    errors = []
+    for index, document in enumerate(documents):
+        error = best_match(validator.iter_errors(document))
+        if error is not None:
+            errors.append({"index": index, "message": error.message})
+    return errors
@@ -1,11 +1,16 @@
 # test main server API
 
 from flask import request
+import gzip
+import io
 import json
 from matplotlib import use
 import pytest
+import shutil
+import sqlite3
 import sys
 import os
+import zlib
 
 #Solution for importing the needed create_app
 #with telling the tests their folder first
@@ -14,14 +19,28 @@ import os
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
-from database import create_app
+from database import create_app, db
+from database.matching import IngredientIndex
+from database.models import Recipeingredient
+from database.builders.builders import MasonBuilder
+from sqlalchemy import event
+from sqlalchemy.engine import URL
 
 #Pytest init from
 #https://flask.palletsprojects.com/en/2.0.x/testing/
 
+def copied_database(tmp_path):
+    """
+    URI of a copy of the shipped cookbook.db, which create_app would
+    otherwise upgrade in place
+    """
+    path = tmp_path / "cookbook.db"
+    shutil.copyfile(os.path.join(os.path.dirname(__file__), "..", "database", "cookbook.db"), path)
+    return "sqlite:///" + str(path)
+
 @pytest.fixture()
-def app():
-    app = create_app()
+def app(tmp_path):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": copied_database(tmp_path)})
     app.config.update({
         "TESTING": True,
     })
@@ -37,11 +56,33 @@ def client(app):
 def runner(app):
     return app.test_cli_runner()
 
-def test_new_app():
+@pytest.fixture()
+def fresh_client(tmp_path):
+    """
+    Client for an app running on its own throwaway database, populated
+    with the default test data
+    """
+    fresh_app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "test.db"),
+        "METRICS_DIR": str(tmp_path / "metrics"),
+    })
+    test_client = fresh_app.test_client()
+    test_client.post("/api/populate")
+    return test_client
+
+def add_recipes(client, count):
+    for i in range(count):
+        client.post("/api/recipes/", json={
+            "name": "Recipe-{}".format(i),
+            "description": "Generated recipe number {}".format(i)
+        })
+
+def test_new_app(tmp_path):
     """
     Tests to create a new Flask application
     """
-    test_app = create_app()
+    test_app = create_app({"SQLALCHEMY_DATABASE_URI": copied_database(tmp_path)})
 
     with test_app.test_client() as test_flask:
         response = test_flask.get("/api/")
@@ -150,3 +191,1130 @@ def test_get_recipeingredients(client):
     response = client.get("/api/recipeingredients/")
     assert response.status_code == 200
 
+
+def test_recipe_collection_pages(fresh_client):
+    """
+    Tests walking the recipe collection with keyset pagination
+    """
+
+    add_recipes(fresh_client, 5)
+    response = fresh_client.get("/api/recipes/?limit=3")
+    assert [item["name"] for item in response.json["items"]] == [
+        "Cake-Recipe", "Water-Recipe", "Recipe-0"
+    ]
+    assert "prev" not in response.json["@controls"]
+
+    response = fresh_client.get(response.json["@controls"]["next"]["href"])
+    assert [item["name"] for item in response.json["items"]] == [
+        "Recipe-1", "Recipe-2", "Recipe-3"
+    ]
+
+    last = fresh_client.get(response.json["@controls"]["next"]["href"])
+    assert [item["name"] for item in last.json["items"]] == ["Recipe-4"]
+    assert "next" not in last.json["@controls"]
+
+    back = fresh_client.get(last.json["@controls"]["prev"]["href"])
+    assert back.json["items"] == response.json["items"]
+
+def test_recipe_collection_bad_cursor(fresh_client):
+
+    response = fresh_client.get("/api/recipes/?cursor=abc")
+    assert response.status_code == 400
+    response = fresh_client.get("/api/recipes/?limit=0")
+    assert response.status_code == 400
+
+def test_user_recipe_collection_pages(fresh_client):
+
+    response = fresh_client.get("/api/Taneli-Testiukko/?limit=1")
+    assert [item["name"] for item in response.json["items"]] == ["Cake-Recipe"]
+    response = fresh_client.get(response.json["@controls"]["next"]["href"])
+    assert [item["name"] for item in response.json["items"]] == ["Water-Recipe"]
+    assert response.json["@controls"]["prev"]["href"].startswith("/api/Taneli-Testiukko/")
+
+def count_queries(client, url):
+    """
+    Returns the response for url and the number of SQL statements it ran
+    """
+    response, statements = record_queries(client, url)
+    return response, len(statements)
+
+def record_queries(client, url):
+    """
+    Returns the response for url and the SQL statements it ran
+    """
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    with client.application.app_context():
+        engine = db.get_engine()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return response, statements
+
+def test_recipeingredients_per_recipe(fresh_client):
+
+    response, queries = count_queries(fresh_client, "/api/recipeingredients/")
+    by_name = {item["name"]: item["Ingredients"] for item in response.json}
+    assert by_name["Water-Recipe"] == [["Water", 1, "Cup"]]
+    assert sorted(by_name["Cake-Recipe"]) == [
+        ["Egg", 2, "pcs"], ["Salt", 1, "Teaspoon"], ["Sugar", 4, "Teaspoon"], ["Water", 1, "Cup"]
+    ]
+    add_recipes(fresh_client, 10)
+    response, more_queries = count_queries(fresh_client, "/api/recipeingredients/")
+    assert len(response.json) == 12
+    assert more_queries == queries
+
+def test_sparse_fieldsets(fresh_client):
+    """
+    Tests limiting list views to some fields, leaving out controls and
+    asking for pretty output
+    """
+
+    add_recipes(fresh_client, 3)
+    response, queries = record_queries(fresh_client, "/api/recipes/?fields=name,difficulty&limit=2")
+    assert [sorted(item) for item in response.json["items"]] == [["@controls", "difficulty", "name"]] * 2
+    assert not [q for q in queries if "recipe.description" in q]
+    assert "fields=name%2Cdifficulty" in response.json["@controls"]["next"]["href"]
+    assert b"\n" not in response.data
+
+    response = fresh_client.get("/api/recipes/?fields=difficulty&controls=none")
+    assert response.json["items"][0] == {"difficulty": "No difficulty rating"}
+    assert "storage:add-recipe" not in response.json["@controls"]
+    response = fresh_client.get("/api/recipes/search?q=generated&fields=name&controls=none")
+    assert response.json["items"] == [{"name": "Recipe-{}".format(i)} for i in range(3)]
+
+    response = fresh_client.get("/api/recipes/?pretty=true")
+    assert response.data.startswith(b'{\n    "@controls"')
+    assert fresh_client.get("/api/users?pretty=true").data.startswith(b"[\n")
+    assert fresh_client.get("/api/recipes/?fields=password").status_code == 400
+    assert fresh_client.get("/api/recipes/?controls=some").status_code == 400
+
+def test_user_collection_queries(fresh_client):
+
+    response, queries = count_queries(fresh_client, "/api/users")
+    assert response.json[0]["recipes"] == [["Cake-Recipe"], ["Water-Recipe"]]
+    # The version lookup for the ETag and the listing itself
+    assert queries == 2
+    # Repeated requests only look up the versions
+    assert count_queries(fresh_client, "/api/users")[1] == 1
+
+def test_search_recipes(fresh_client):
+    """
+    Tests full-text search over names, descriptions and ingredients
+    """
+
+    response = fresh_client.get("/api/recipes/search?q=hana")
+    assert [item["name"] for item in response.json["items"]] == ["Water-Recipe"]
+
+    response = fresh_client.get("/api/recipes/search?q=sugar")
+    assert [item["name"] for item in response.json["items"]] == ["Cake-Recipe"]
+
+    response = fresh_client.get("/api/recipes/search?q=water")
+    assert len(response.json["items"]) == 2
+
+    response = fresh_client.get('/api/recipes/search?q="unbalanced')
+    assert response.status_code == 200
+    assert response.json["items"] == []
+
+    response = fresh_client.get("/api/recipes/search?q=")
+    assert response.status_code == 400
+
+def test_search_follows_writes(fresh_client):
+
+    add_recipes(fresh_client, 3)
+    response = fresh_client.get("/api/recipes/search?q=generated&limit=2")
+    assert len(response.json["items"]) == 2
+    response = fresh_client.get(response.json["@controls"]["next"]["href"])
+    assert len(response.json["items"]) == 1
+
+    fresh_client.put("/api/recipes/Recipe-0/", json={
+        "name": "Recipe-0",
+        "description": "Pancakes with blueberries"
+    })
+    response = fresh_client.get("/api/recipes/search?q=blueberr")
+    assert [item["name"] for item in response.json["items"]] == ["Recipe-0"]
+
+    fresh_client.delete("/api/recipes/Recipe-0/")
+    response = fresh_client.get("/api/recipes/search?q=blueberries")
+    assert response.json["items"] == []
+
+def test_match_recipes(fresh_client):
+    """
+    Tests finding recipes that can be cooked with the given ingredients
+    """
+
+    response = fresh_client.get("/api/recipes/match?ingredients=Water")
+    assert [item["name"] for item in response.json["items"]] == ["Water-Recipe"]
+
+    response = fresh_client.get("/api/recipes/match?ingredients=Water,Egg,Salt&missing=1")
+    assert [item["name"] for item in response.json["items"]] == ["Water-Recipe", "Cake-Recipe"]
+    assert response.json["items"][1]["missing"] == ["Sugar"]
+
+    response = fresh_client.get("/api/recipes/match?ingredients=Water,Egg,Salt&missing=1&limit=1")
+    assert [item["name"] for item in response.json["items"]] == ["Water-Recipe"]
+    assert "prev" not in response.json["@controls"]
+    response = fresh_client.get(response.json["@controls"]["next"]["href"])
+    assert [item["name"] for item in response.json["items"]] == ["Cake-Recipe"]
+    assert "next" not in response.json["@controls"]
+    assert "offset=0" in response.json["@controls"]["prev"]["href"]
+
+    response = fresh_client.get("/api/recipes/match?ingredients=Egg&missing=abc")
+    assert response.status_code == 400
+
+def test_match_follows_writes(fresh_client):
+
+    response = fresh_client.get("/api/recipes/match?ingredients=Water")
+    assert len(response.json["items"]) == 1
+    fresh_client.delete("/api/recipes/Water-Recipe/")
+    response = fresh_client.get("/api/recipes/match?ingredients=Water")
+    assert response.json["items"] == []
+
+def test_match_sees_other_processes(fresh_client, tmp_path):
+    """
+    Tests that the ingredient index reloads after a write it did not see
+    """
+
+    response = fresh_client.get("/api/recipes/match?ingredients=Water")
+    assert len(response.json["items"]) == 1
+    conn = sqlite3.connect(str(tmp_path / "test.db"))
+    with conn:
+        conn.execute("DELETE FROM recipeingredient WHERE ingredient_id = "
+                     "(SELECT id FROM ingredient WHERE name = 'Water')")
+        conn.execute("UPDATE resource_version SET version = version + 1 "
+                     "WHERE key = 'recipeingredients'")
+    conn.close()
+    response = fresh_client.get("/api/recipes/match?ingredients=Water")
+    assert response.json["items"] == []
+
+def test_recommendations(fresh_client, tmp_path):
+    """
+    Tests recommending recipes by the ingredients of the user's own recipes
+    """
+
+    from database.models import User
+    from database.recommend import RecipeRecommender, get_recommender
+
+    fresh_client.post("/api/populate", json={"scale": 0.05, "seed": 3})
+    conn = sqlite3.connect(str(tmp_path / "test.db"))
+    owned = {row[0] for row in conn.execute(
+        "SELECT recipe.name FROM recipe JOIN user ON user.id = recipe.user_id WHERE user.name = 'User-3-0'"
+    )}
+    response = fresh_client.get("/api/User-3-0/recommendations?limit=5")
+    assert response.status_code == 200
+    items = response.json["items"]
+    assert 0 < len(items) <= 5
+    assert not owned & {item["name"] for item in items}
+    scores = [item["score"] for item in items]
+    assert scores == sorted(scores, reverse=True)
+    assert fresh_client.get("/api/User-3-0/recommendations?limit=0").status_code == 400
+    assert fresh_client.get("/api/Nobody/recommendations").status_code == 404
+
+    # Writes of this process are applied without a reload and match a
+    # rebuild once folded into the matrices
+    app = fresh_client.application
+    fresh_client.delete("/api/recipes/{}/".format(items[0]["name"]))
+    fresh_client.post("/api/recipeingredients/", json={
+        "id": 2, "ingredient_id": 7, "unit_id": 3, "amount": 1
+    })
+    with app.app_context():
+        recommender = get_recommender()
+        assert recommender.loaded and recommender._overlay
+        user_id = db.session.query(User.id).filter_by(name="User-3-0").scalar()
+        assert items[0]["name"] not in [item["name"] for item in fresh_client.get(
+            "/api/User-3-0/recommendations?limit=50"
+        ).json["items"]]
+        recommender._compact()
+        rebuilt = RecipeRecommender()
+        rebuilt.load(db.session)
+        assert [recipe_id for recipe_id, _ in recommender.recommend(user_id, 50)] == \
+            [recipe_id for recipe_id, _ in rebuilt.recommend(user_id, 50)]
+
+    # A recipe handed over to the user by another process is no longer
+    # recommended to them
+    with conn:
+        conn.execute("UPDATE recipe SET user_id = (SELECT id FROM user WHERE name = 'User-3-0') "
+                     "WHERE name = ?", (items[1]["name"],))
+        conn.execute("UPDATE resource_version SET version = version + 1 WHERE key = 'recipes'")
+    conn.close()
+    response = fresh_client.get("/api/User-3-0/recommendations?limit=50")
+    assert items[1]["name"] not in [item["name"] for item in response.json["items"]]
+
+def test_background_jobs(fresh_client, tmp_path):
+    """
+    Tests running exports, imports and generated data as background jobs
+    """
+
+    from database.jobs import get_job_runner
+
+    app = fresh_client.application
+
+    def finish(response):
+        assert response.status_code == 202
+        with app.app_context():
+            get_job_runner().wait(response.json["id"])
+        return fresh_client.get(response.headers["Location"])
+
+    response = finish(fresh_client.post("/api/jobs", json={"type": "export", "format": "csv"}))
+    assert response.json["status"] == "succeeded"
+    assert response.json["progress"]["done"] == response.json["progress"]["total"] == 5
+    download = fresh_client.get(response.json["@controls"]["result"]["href"])
+    assert download.data == fresh_client.get("/api/export?format=csv").data
+
+    lines = "\n".join(json.dumps({
+        "name": "Background-{}".format(i), "description": "Imported by a job",
+        "ingredients": [["Water", 1, "Cup"]]
+    }) for i in range(5))
+    response = finish(fresh_client.post(
+        "/api/import", data=lines, content_type="application/x-ndjson", headers={"Prefer": "respond-async"}
+    ))
+    assert response.json["result"]["imported"] == 5
+    assert fresh_client.get("/api/recipes/Background-4/").status_code == 200
+    assert [name for name in os.listdir(tmp_path / "jobs") if name.startswith("upload-")] == []
+    # A chunked body of unknown length is not imported inline
+    response = fresh_client.post(
+        "/api/import", input_stream=io.BytesIO(lines.replace("Background", "Chunked").encode("utf-8")),
+        content_type="application/x-ndjson", headers={"Transfer-Encoding": "chunked"},
+        environ_overrides={"wsgi.input_terminated": True}
+    )
+    assert response.status_code == 202
+    finish(response)
+    assert fresh_client.get("/api/recipes/Chunked-4/").status_code == 200
+
+    response = finish(fresh_client.post("/api/populate", json={"scale": 0.01, "seed": 4},
+                                        headers={"Prefer": "respond-async"}))
+    assert response.json["result"]["rows"]["recipe"] == 10
+    response = finish(fresh_client.post("/api/populate", json={"scale": 0.01, "seed": 4},
+                                        headers={"Prefer": "respond-async"}))
+    assert response.json["status"] == "failed"
+    assert "Seed 4" in response.json["error"]
+
+    assert fresh_client.post("/api/jobs", json={"type": "import"}).status_code == 400
+    assert fresh_client.post("/api/jobs", json={"type": "refresh", "format": "csv"}).status_code == 400
+    assert fresh_client.get("/api/jobs/999").status_code == 404
+
+    # A job whose process died is reported as failed and recorded as such
+    # by the next refresh job
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    conn = sqlite3.connect(str(tmp_path / "test.db"))
+    with conn:
+        job_id = conn.execute(
+            "INSERT INTO job (kind, status, params, done, pid, created) "
+            "VALUES ('export', 'running', '{}', 0, ?, 0)", (pid,)
+        ).lastrowid
+    response = fresh_client.get("/api/jobs/{}".format(job_id))
+    assert (response.json["status"], response.json["error"]) == ("failed", "Interrupted")
+    assert finish(fresh_client.post("/api/jobs", json={"type": "refresh"})).json["status"] == "succeeded"
+    assert conn.execute("SELECT status FROM job WHERE id = ?", (job_id,)).fetchone()[0] == "failed"
+    conn.close()
+
+    response = fresh_client.get("/api/jobs?limit=2")
+    assert [item["type"] for item in response.json["items"]] == ["refresh", "export"]
+    response = fresh_client.get(response.json["@controls"]["next"]["href"])
+    assert [item["type"] for item in response.json["items"]] == ["populate", "populate"]
+
+def test_shopping_list(fresh_client, tmp_path):
+    """
+    Tests adding up the ingredients of several recipes with servings and
+    unit conversions
+    """
+
+    url = "/api/Taneli-Testiukko/shopping-list?recipes=Cake-Recipe,Water-Recipe&servings=2,3"
+    response = fresh_client.get(url)
+    assert response.status_code == 200
+    assert response.json["items"] == [
+        {"ingredient": "Egg", "amount": 4, "unit": "pcs"},
+        {"ingredient": "Salt", "amount": 2, "unit": "Teaspoon"},
+        {"ingredient": "Sugar", "amount": 8, "unit": "Teaspoon"},
+        {"ingredient": "Water", "amount": 5, "unit": "Cup"},
+    ]
+    assert [recipe["servings"] for recipe in response.json["recipes"]] == [2, 3]
+    etag = response.headers["ETag"]
+    assert fresh_client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    # Teaspoons and tablespoons of sugar add up, a row without an amount
+    # stays unmeasured
+    conn = sqlite3.connect(str(tmp_path / "test.db"))
+    with conn:
+        conn.execute("INSERT INTO unit (id, unit) VALUES (4, 'Tablespoon'), (5, 'pinch')")
+    conn.close()
+    fresh_client.post("/api/recipeingredients/", json={"id": 2, "ingredient_id": 3, "unit_id": 4, "amount": 2})
+    fresh_client.post("/api/recipeingredients/", json={"id": 2, "ingredient_id": 4, "unit_id": 5, "amount": None})
+    assert fresh_client.get(url, headers={"If-None-Match": etag}).status_code == 200
+    items = fresh_client.get("/api/Taneli-Testiukko/shopping-list").json["items"]
+    assert {"ingredient": "Sugar", "amount": 3.33, "unit": "Tablespoon"} in items
+    assert {"ingredient": "Milk", "amount": None, "unit": "pinch"} in items
+
+    response = fresh_client.get("/api/Taneli-Testiukko/shopping-list?recipes=Cake-Recipe,Nothing")
+    assert response.status_code == 404
+    response = fresh_client.get("/api/Taneli-Testiukko/shopping-list?recipes=Cake-Recipe&servings=1,2")
+    assert response.status_code == 400
+    response = fresh_client.get("/api/Taneli-Testiukko/shopping-list?servings=-1")
+    assert response.status_code == 400
+
+def test_recipe_batch(fresh_client):
+    """
+    Tests fetching several recipes at once, with misses reported inline
+    """
+
+    response = fresh_client.get("/api/recipes/batch?names=Water-Recipe,Nothing,Cake-Recipe")
+    assert response.status_code == 200
+    items = response.json["items"]
+    assert [item["name"] for item in items] == ["Water-Recipe", "Nothing", "Cake-Recipe"]
+    assert items[1]["@error"]["@message"] == "Not found"
+    assert response.json["found"] == 2
+    single = fresh_client.get("/api/recipes/Cake-Recipe/").json
+    assert sorted(items[2]["ingredients"]) == sorted(single["ingredients"])
+    assert items[2]["@controls"]["self"]["href"] == single["@controls"]["self"]["href"]
+
+    # The recipes and their ingredient rows take one query each
+    _, queries = record_queries(fresh_client, "/api/recipes/batch?names=Water-Recipe&names=Cake-Recipe")
+    assert len([q for q in queries if "resource_version" not in q]) == 2
+
+    response = fresh_client.post("/api/recipes/batch", json={"names": ["Cake-Recipe", "Water-Recipe"]})
+    assert [item["name"] for item in response.json["items"]] == ["Cake-Recipe", "Water-Recipe"]
+    assert fresh_client.post("/api/recipes/batch", json={"names": []}).status_code == 400
+    assert fresh_client.get("/api/recipes/batch").status_code == 400
+    names = ",".join("Recipe-{}".format(i) for i in range(101))
+    assert fresh_client.get("/api/recipes/batch?names=" + names).status_code == 400
+
+def test_batch_operations(fresh_client):
+    """
+    Tests running writes on several resources in one transaction, and that
+    a failing operation leaves nothing behind
+    """
+
+    cake = fresh_client.get("/api/recipes/Cake-Recipe/").json
+    response = fresh_client.post("/api/batch", json={"operations": [
+        {"op": "create", "type": "ingredient", "data": {"name": "Cocoa"}},
+        {"op": "create", "type": "recipe", "data": {"name": "Cocoa-Recipe", "description": "Hot"}},
+        {"op": "create", "type": "recipeingredient", "data": {"id": "$1", "ingredient_id": "$0", "unit_id": 2, "amount": 3}},
+        {"op": "create", "type": "recipeingredient", "data": {"id": "$1", "ingredient_id": 6, "unit_id": 1, "amount": 1}},
+        {"op": "update", "type": "recipe", "target": "Water-Recipe", "data": {"name": "Tap-Water", "description": "Cold"}},
+        {"op": "delete", "type": "recipeingredient", "target": {"id": 1, "ingredient_id": 1, "unit_id": 3}},
+    ]})
+    assert response.status_code == 200
+    results = response.json["results"]
+    assert [result["status"] for result in results] == [201, 201, 201, 201, 204, 204]
+    assert results[1]["location"] == "/api/recipes/Cocoa-Recipe/"
+    assert sorted(fresh_client.get("/api/recipes/Cocoa-Recipe/").json["ingredients"]) == [
+        ["Cocoa", 3, "Teaspoon"], ["Water", 1, "Cup"]
+    ]
+    assert fresh_client.get("/api/recipes/Tap-Water/").json["description"] == "Cold"
+    assert len(fresh_client.get("/api/recipes/Cake-Recipe/").json["ingredients"]) == len(cake["ingredients"]) - 1
+
+    # The third operation fails, so the first two are rolled back
+    response = fresh_client.post("/api/batch", json={"operations": [
+        {"op": "delete", "type": "recipe", "target": "Cocoa-Recipe"},
+        {"op": "create", "type": "ingredient", "data": {"name": "Vanilla"}},
+        {"op": "create", "type": "ingredient", "data": {"name": "Cocoa"}},
+    ]})
+    assert response.status_code == 409
+    assert response.json["index"] == 2
+    assert fresh_client.get("/api/recipes/Cocoa-Recipe/").status_code == 200
+    assert "Vanilla" not in [item["name"] for item in fresh_client.get("/api/ingredients").json]
+
+    response = fresh_client.post("/api/batch", json={"operations": [
+        {"op": "update", "type": "recipe", "target": "Nothing", "data": {"name": "A", "description": "B"}},
+    ]})
+    assert response.status_code == 404
+    response = fresh_client.post("/api/batch", json={"operations": [
+        {"op": "create", "type": "recipeingredient", "data": {"id": "$0", "ingredient_id": 1, "unit_id": 1}},
+    ]})
+    assert response.status_code == 400
+    response = fresh_client.post("/api/batch", json={"operations": [
+        {"op": "create", "type": "recipe", "data": {"name": "No description"}},
+    ]})
+    assert response.status_code == 400
+    assert fresh_client.post("/api/batch", json={"operations": []}).status_code == 400
+
+def test_ingredient_index_updates():
+
+    index = IngredientIndex()
+    index.add([(1, 10), (1, 11), (2, 10), (3, 12)])
+    assert index.match([10, 11]) == [(1, []), (2, [])]
+    index.add([(2, 12)])
+    index.add([(2, 12)])
+    assert index.match([10]) == []
+    index.remove([(2, 12)])
+    assert index.match([10], missing=1) == [(1, [11]), (2, [12])]
+    index.remove([(2, 12)])
+    assert index.match([10]) == [(2, [])]
+    index.remove([(2, 12)])
+    assert index._extra == {}
+    index.remove_recipes([1])
+    assert index.match([10, 11], missing=5) == [(2, [])]
+
+def test_recipe_etag(fresh_client):
+    """
+    Tests conditional GET of a recipe before and after editing it
+    """
+
+    response = fresh_client.get("/api/recipes/Water-Recipe/")
+    etag = response.headers["ETag"]
+    response = fresh_client.get("/api/recipes/Water-Recipe/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    fresh_client.put("/api/recipes/Water-Recipe/", json={
+        "name": "Water-Recipe",
+        "description": "Tata on muokattu"
+    })
+    response = fresh_client.get("/api/recipes/Water-Recipe/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json["description"] == "Tata on muokattu"
+
+def test_collection_etag(fresh_client):
+
+    first = fresh_client.get("/api/recipes/")
+    cached = fresh_client.get("/api/recipes/")
+    assert cached.headers["ETag"] == first.headers["ETag"]
+    assert cached.data == first.data
+
+    user_etag = fresh_client.get("/api/Taneli-Testiukko/").headers["ETag"]
+    add_recipes(fresh_client, 1)
+    response = fresh_client.get("/api/recipes/", headers={"If-None-Match": first.headers["ETag"]})
+    assert response.status_code == 200
+    assert len(response.json["items"]) == 3
+    response = fresh_client.get("/api/Taneli-Testiukko/", headers={"If-None-Match": user_etag})
+    assert response.status_code == 304
+
+def test_import_recipes(fresh_client):
+    """
+    Tests importing newline delimited recipes with per line errors
+    """
+
+    lines = [
+        {"name": "Pancakes", "description": "Fry thin", "owner": "Taneli-Testiukko",
+         "ingredients": [["Egg", 2, "pcs"], ["Milk", 5, "dl"], ["Flour", 3, "dl"]]},
+        "this is not json",
+        {"name": "Water-Recipe", "description": "Duplicate of an existing recipe"},
+        {"name": "Toast", "description": "No owner like this", "owner": "Nobody"},
+        {"name": "Tea", "description": 5},
+        {"name": "Tea", "description": "Boil water", "ingredients": [["Water", 2, "dl"], ["Tea leaves", 1, "pcs"]]},
+    ]
+    body = "\n".join(line if isinstance(line, str) else json.dumps(line) for line in lines)
+    response = fresh_client.post("/api/import", data=body, content_type="application/x-ndjson")
+    assert response.status_code == 200
+    assert response.json["imported"] == 2
+    assert [error["line"] for error in response.json["errors"]] == [2, 3, 4, 5]
+
+    response = fresh_client.get("/api/recipes/Pancakes/")
+    assert response.json["description"] == "Fry thin"
+    assert sorted(response.json["ingredients"]) == [["Egg", 2, "pcs"], ["Flour", 3, "dl"], ["Milk", 5, "dl"]]
+    response = fresh_client.get("/api/Taneli-Testiukko/")
+    assert "Pancakes" in [item["name"] for item in response.json["items"]]
+    response = fresh_client.get("/api/recipes/search?q=leaves")
+    assert [item["name"] for item in response.json["items"]] == ["Tea"]
+
+    response = fresh_client.post("/api/import", json={"name": "Wrong"})
+    assert response.status_code == 415
+
+def test_import_batches(fresh_client):
+
+    fresh_client.application.config["IMPORT_BATCH_SIZE"] = 2
+    fresh_client.get("/api/recipes/match?ingredients=Salt")
+    body = "\n".join(json.dumps({
+        "name": "Batch-{}".format(i),
+        "description": "Batched",
+        "ingredients": [["Salt", i, "pcs"]]
+    }) for i in range(5))
+    response = fresh_client.post("/api/import", data=body, content_type="application/x-ndjson")
+    assert response.json["imported"] == 5
+    response = fresh_client.get("/api/recipes/match?ingredients=Salt")
+    assert len(response.json["items"]) == 5
+
+def test_export_recipes(fresh_client, tmp_path):
+    """
+    Tests streaming the cookbook out and importing it into another database
+    """
+
+    response = fresh_client.get("/api/export")
+    assert response.status_code == 200
+    lines = response.data.decode("utf-8").splitlines()
+    recipes = {line["name"]: line for line in map(json.loads, lines)}
+    assert recipes["Water-Recipe"] == {
+        "name": "Water-Recipe",
+        "description": "Avaa hana ja laita lasi alle",
+        "difficulty": None,
+        "owner": "Taneli-Testiukko",
+        "ingredients": [["Water", 1, "Cup"]],
+    }
+    assert len(recipes["Cake-Recipe"]["ingredients"]) == 4
+
+    response = fresh_client.get("/api/export?format=csv")
+    rows = response.data.decode("utf-8").splitlines()
+    assert rows[0] == "name,description,difficulty,owner,ingredient,amount,unit"
+    assert len(rows) == 6
+
+    response = fresh_client.get("/api/export?format=xml")
+    assert response.status_code == 400
+
+    empty = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "empty.db")}).test_client()
+    response = empty.get("/api/export?format=csv")
+    assert response.data.decode("utf-8").splitlines() == ["name,description,difficulty,owner,ingredient,amount,unit"]
+
+def test_response_compression(fresh_client):
+    """
+    Tests negotiated compression of large responses, the compressed body
+    cache and streamed compression of exports
+    """
+
+    from database.compression import compress_stream
+
+    add_recipes(fresh_client, 30)
+    plain = fresh_client.get("/api/recipes/?limit=30")
+    assert "Content-Encoding" not in plain.headers
+    assert plain.headers["Vary"] == "Accept-Encoding"
+
+    response = fresh_client.get("/api/recipes/?limit=30", headers={"Accept-Encoding": "gzip, deflate"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.data) == plain.data
+    assert response.headers["ETag"] == '"{}-gzip"'.format(plain.headers["ETag"].strip('"'))
+    assert fresh_client.get(
+        "/api/recipes/?limit=30", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]}
+    ).status_code == 304
+    response = fresh_client.get("/api/recipes/?limit=30", headers={"Accept-Encoding": "deflate, gzip;q=0.5"})
+    assert zlib.decompress(response.data) == plain.data
+
+    # Compressed once per version, then served from the cache
+    metrics = fresh_client.get("/api/metrics").data.decode("utf-8")
+    assert 'cookbook_cache_requests_total{cache="compressed",result="miss"} 2' in metrics
+    fresh_client.get("/api/recipes/?limit=30", headers={"Accept-Encoding": "gzip"})
+    metrics = fresh_client.get("/api/metrics").data.decode("utf-8")
+    assert 'cookbook_cache_requests_total{cache="compressed",result="hit"} 1' in metrics
+
+    # Below the threshold bodies go out as they are
+    response = fresh_client.get("/api/recipes/?limit=1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+    users = fresh_client.get("/api/users")
+    assert fresh_client.get("/api/users", headers={"If-None-Match": users.headers["ETag"]}).status_code == 304
+    response = fresh_client.get("/api/recipeingredients/")
+    assert fresh_client.get(
+        "/api/recipeingredients/", headers={"If-None-Match": response.headers["ETag"]}
+    ).status_code == 304
+
+    plain = fresh_client.get("/api/export")
+    response = fresh_client.get("/api/export", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+    assert gzip.decompress(response.data) == plain.data
+
+    # A client that goes away mid-stream closes the export generator
+    closed = []
+    def export():
+        try:
+            yield "first\n"
+            yield "second\n"
+        finally:
+            closed.append(True)
+    stream = compress_stream(export(), "gzip")
+    next(iter(stream))
+    stream.close()
+    assert closed == [True]
+
+def test_admission_control(tmp_path):
+    """
+    Tests rate limiting per client with endpoint costs, sharing the buckets
+    between apps as between workers, and shedding load over the
+    concurrency limit
+    """
+
+    from database.admission import PROBE, AdmissionState
+
+    config = {
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "test.db"),
+        "ADMISSION_CONTROL": True,
+        "ADMISSION_FILE": str(tmp_path / "admission.db"),
+        "METRICS_DIR": str(tmp_path / "metrics"),
+        "ADMISSION_RATE": 0.01,
+        "ADMISSION_BURST": 8,
+        "ADMISSION_COSTS": {"populate": 0},
+        "ADMISSION_API_KEYS": ["other", "0", "1", "third"],
+    }
+    client = create_app(config).test_client()
+    client.post("/api/populate")
+    assert client.get("/api/recipes/").status_code == 200
+    response = client.get("/api/recipes/")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert response.json["@error"]["@message"] == "Too many requests"
+    # Item reads are cheaper and still fit
+    assert client.get("/api/recipes/Cake-Recipe/").status_code == 200
+    assert client.get("/api/recipes/", headers={"X-API-Key": "other"}).status_code == 200
+    # Keys that are not configured count against the address
+    assert client.get("/api/recipes/", headers={"X-API-Key": "made-up"}).status_code == 429
+
+    # Another worker sees the same buckets
+    other = create_app(config).test_client()
+    assert other.get("/api/recipes/").status_code == 429
+    # Rejections by both apps, which share the metrics directory
+    metrics = client.get("/api/metrics").data.decode("utf-8")
+    assert 'cookbook_admission_rejected_total{endpoint="recipecollection",reason="rate"} 3' in metrics
+
+    # Clients pushing others out of a full table inherit their tokens
+    state = AdmissionState(str(tmp_path / "small.db"), slots=PROBE)
+    with state.locked():
+        for client_id in range(1, PROBE + 1):
+            assert state.take(client_id, 8, 0.01, 8, 1.0) == 0
+        assert state.take(PROBE + 1, 1, 0.01, 8, 2.0) > 0
+
+    # Responses hold their slot until the server closes them, which the
+    # test client leaves to the test
+    config["ADMISSION_FILE"] = str(tmp_path / "concurrency.db")
+    config["ADMISSION_MAX_CONCURRENT"] = 2
+    client = create_app(config).test_client()
+    exports = [
+        client.get("/api/export", headers={"X-API-Key": str(i)}, buffered=False) for i in range(2)
+    ]
+    response = client.get("/api/recipes/Cake-Recipe/", headers={"X-API-Key": "third"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    for export in reversed(exports):
+        export.close()
+    assert client.get("/api/recipes/Cake-Recipe/", headers={"X-API-Key": "third"}).status_code == 200
+
+def test_export_command(fresh_client, tmp_path):
+
+    output = tmp_path / "cookbook.ndjson"
+    result = fresh_client.application.test_cli_runner().invoke(args=["export", "--output", str(output)])
+    assert result.exit_code == 0
+    other = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "other.db")}).test_client()
+    other.post("/api/users", json={
+        "name": "Taneli-Testiukko",
+        "email": "taneli@testi.com",
+        "password": "salasana"
+    })
+    response = other.post("/api/import", data=output.read_text(), content_type="application/x-ndjson")
+    assert response.json["imported"] == 2
+    response = other.get("/api/recipes/Cake-Recipe/")
+    assert len(response.json["ingredients"]) == 4
+
+def test_recipe_loaded_once_per_request(fresh_client):
+    """
+    Tests that converter and handler share a single recipe lookup
+    """
+
+    for _ in range(2):
+        fresh_client.put("/api/recipes/Water-Recipe/", json={
+            "name": "Water-Recipe",
+            "description": "Vesi"
+        })
+        response, statements = record_queries(fresh_client, "/api/recipes/Water-Recipe/")
+        assert response.json["description"] == "Vesi"
+        recipe_queries = [s for s in statements if "FROM recipe \n" in s or "FROM recipe\n" in s]
+        assert len(recipe_queries) == 1
+
+    response, statements = record_queries(fresh_client, "/api/Taneli-Testiukko/Water-Recipe/")
+    assert response.json["owner"] == "Taneli-Testiukko"
+    assert len(statements) == 2
+
+def test_renamed_recipe_lookup(fresh_client):
+
+    fresh_client.get("/api/recipes/Water-Recipe/")
+    fresh_client.put("/api/recipes/Water-Recipe/", json={
+        "name": "Sparkling-Water",
+        "description": "Kuplia"
+    })
+    assert fresh_client.get("/api/recipes/Water-Recipe/").status_code == 404
+    assert fresh_client.get("/api/recipes/Sparkling-Water/").status_code == 200
+    fresh_client.delete("/api/recipes/Sparkling-Water/")
+    assert fresh_client.get("/api/recipes/Sparkling-Water/").status_code == 404
+
+def test_control_templates(app):
+    """
+    Tests that precompiled control URLs match the ones Flask builds
+    """
+
+    from flask import url_for
+    with app.test_request_context("/"):
+        for name in ["Cake-Recipe", "with space", "{braces}", "100%"]:
+            assert MasonBuilder.href("recipeitem", recipe=name) == url_for("recipeitem", recipe=name)
+            assert MasonBuilder.href("userrecipe", user=name, recipe="x") == url_for("userrecipe", user=name, recipe="x")
+        assert MasonBuilder.href("recipecollection") == url_for("recipecollection")
+
+def test_write_validation(fresh_client):
+    """
+    Tests schema validation on the write endpoints
+    """
+
+    response = fresh_client.post("/api/recipes/", json={"name": "No description"})
+    assert response.status_code == 400
+    response = fresh_client.post("/api/recipes/", data="name=form")
+    assert response.status_code == 415
+    response = fresh_client.put("/api/recipes/Water-Recipe/", json={"name": 5, "description": "x"})
+    assert response.status_code == 400
+    response = fresh_client.put("/api/recipes/Water-Recipe/", json={
+        "name": "Cake-Recipe",
+        "description": "Name is taken"
+    })
+    assert response.status_code == 409
+    response = fresh_client.post("/api/users", json={"name": "No email", "password": "x"})
+    assert response.status_code == 400
+    response = fresh_client.post("/api/recipeingredients/", json={"id": 2, "ingredient_id": "Salt"})
+    assert response.status_code == 400
+
+def test_bulk_ingredients_and_rows(fresh_client):
+
+    response = fresh_client.post("/api/ingredients", json=[{"name": "Lemon"}, {"name": 7}, {}])
+    assert response.status_code == 400
+    assert [error["index"] for error in response.json["errors"]] == [1, 2]
+    assert fresh_client.post("/api/ingredients", json=[]).status_code == 400
+
+    response = fresh_client.post("/api/ingredients", json=[{"name": "Lemon"}, {"name": "Ice"}])
+    assert response.status_code == 201
+    response = fresh_client.post("/api/ingredients", json={"name": "Ice"})
+    assert response.status_code == 409
+
+    response = fresh_client.post("/api/recipeingredients/", json={
+        "id": 2, "ingredient_id": 7, "unit_id": 3, "amount": 1
+    })
+    assert response.status_code == 201
+    assert response.headers["Location"].endswith("/api/recipes/Water-Recipe/")
+    response = fresh_client.post("/api/recipeingredients/", json={"id": 99, "ingredient_id": 1, "unit_id": 3})
+    assert response.status_code == 409
+    with fresh_client.application.app_context():
+        assert db.session.query(Recipeingredient).filter_by(id=99).count() == 0
+    assert fresh_client.post("/api/recipeingredients/", json={"id": 2, "ingredient_id": 1, "unit_id": 99}).status_code == 409
+    response = fresh_client.get("/api/recipes/Water-Recipe/")
+    assert ["Lemon", 1, "pcs"] in response.json["ingredients"]
+
+def test_migrations_upgrade_old_database(tmp_path):
+    """
+    Tests that an existing database without indexes is upgraded at startup
+    """
+
+    path = tmp_path / "old.db"
+    conn = sqlite3.connect(str(path))
+    conn.executescript("""
+        CREATE TABLE user (id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, address VARCHAR(100),
+            email VARCHAR(100) NOT NULL, password VARCHAR(100) NOT NULL, PRIMARY KEY (id), UNIQUE (email));
+        CREATE TABLE recipe (id INTEGER NOT NULL, user_id INTEGER, name VARCHAR(64) NOT NULL,
+            difficulty VARCHAR(20), description VARCHAR(2000) NOT NULL, PRIMARY KEY (id), UNIQUE (name));
+        CREATE TABLE recipeingredient (id INTEGER NOT NULL, ingredient_id INTEGER NOT NULL, amount INTEGER,
+            unit_id INTEGER NOT NULL, PRIMARY KEY (id, ingredient_id, unit_id));
+        INSERT INTO user VALUES (1, 'Vanha', NULL, 'vanha@testi.com', 'salasana');
+        INSERT INTO recipe VALUES (1, 1, 'Old-Recipe', NULL, 'From before the migrations');
+    """)
+    conn.close()
+
+    old_app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(path)})
+    response = old_app.test_client().get("/api/Vanha/")
+    assert [item["name"] for item in response.json["items"]] == ["Old-Recipe"]
+
+    conn = sqlite3.connect(str(path))
+    assert conn.execute("PRAGMA user_version").fetchone()[0] >= 1
+    plan = " ".join(row[-1] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM recipe WHERE user_id = 1"
+    ))
+    assert "ix_recipe_user_id" in plan
+    plan = " ".join(row[-1] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM recipeingredient WHERE ingredient_id = 1"
+    ))
+    assert "ix_recipeingredient_ingredient_id" in plan
+    conn.close()
+
+
+def test_failed_migration_rolls_back(tmp_path, monkeypatch):
+    """
+    Tests that a migration failing halfway leaves neither its first
+    statements nor the version bump behind
+    """
+
+    from sqlalchemy import create_engine
+    from database import migrations
+
+    engine = create_engine("sqlite:///" + str(tmp_path / "half.db"))
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE recipe (id INTEGER PRIMARY KEY, user_id INTEGER)")
+    monkeypatch.setattr(migrations, "MIGRATIONS", [(1, "Fails halfway", [
+        "CREATE INDEX ix_half ON recipe (user_id)",
+        "CREATE INDEX ix_broken ON missing (id)",
+    ])])
+    with pytest.raises(Exception):
+        migrations.run_migrations(engine)
+    with engine.connect() as conn:
+        assert migrations.schema_version(conn) == 0
+        assert conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").all() == []
+
+def test_production_engine_profile(tmp_path):
+    """
+    Tests the WAL engine profile with reads going to the read-only pool
+    """
+
+    from database.engine import read_engine, read_only
+    import threading
+
+    # Characters with a meaning in the read pool's file: URI
+    directory = tmp_path / "prod?#%20"
+    directory.mkdir()
+    prod_app = create_app({
+        "DATABASE_PROFILE": "production",
+        "SQLALCHEMY_DATABASE_URI": URL.create("sqlite", database=str(directory / "prod.db")),
+    })
+    prod_client = prod_app.test_client()
+    assert prod_client.post("/api/populate").status_code == 201
+
+    with prod_app.app_context():
+        with db.engine.connect() as conn:
+            assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+            assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        reader = read_engine()
+
+    reads = []
+    def record(conn, cursor, statement, *args):
+        reads.append(statement)
+    event.listen(reader, "before_cursor_execute", record)
+    try:
+        response = prod_client.get("/api/recipes/Cake-Recipe/")
+        assert response.status_code == 200
+        assert reads
+        reads.clear()
+        prod_client.put("/api/recipes/Cake-Recipe/", json={"name": "Cake-Recipe", "description": "Uusi"})
+        assert not reads
+    finally:
+        event.remove(reader, "before_cursor_execute", record)
+
+    reads.clear()
+    event.listen(reader, "before_cursor_execute", record)
+    try:
+        response = prod_client.post("/api/recipes/batch", json={"names": ["Cake-Recipe"]})
+        assert response.json["found"] == 1
+        assert reads
+    finally:
+        event.remove(reader, "before_cursor_execute", record)
+
+    # Handlers marked read_only use the read pool whatever the method
+    with prod_app.test_request_context(method="POST"):
+        assert db.session.get_bind() is not reader
+        assert read_only(lambda: db.session.get_bind())() is reader
+
+    statuses = []
+    def writer(number):
+        thread_client = prod_app.test_client()
+        for i in range(10):
+            response = thread_client.post("/api/recipes/", json={
+                "name": "Thread-{}-{}".format(number, i),
+                "description": "Concurrent write"
+            })
+            statuses.append(response.status_code)
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [201] * 40
+    assert len(prod_client.get("/api/recipes/?limit=100").json["items"]) == 42
+
+def test_serve_warm_up(tmp_path):
+    """
+    Tests the production server setup and the warmup done before forking
+    """
+
+    from database.admission import AdmissionControl
+    from database.builders.builders import URL_TEMPLATES
+    from database.engine import read_engine
+    from database.matching import get_ingredient_index
+    from database.metrics import default_metrics_directory
+    from database.serve import CookbookServer, serve_options, warm_connections, warm_up
+
+    options = serve_options("127.0.0.1:0", workers=2, threads=4)
+    assert options["worker_class"] == "gthread"
+    assert options["preload_app"]
+    assert serve_options(workers=1)["worker_class"] == "sync"
+
+    uri = "sqlite:///" + str(tmp_path / "serve.db")
+    server = CookbookServer(options, {"SQLALCHEMY_DATABASE_URI": uri})
+    assert server.cfg.workers == 2
+    assert server.cfg.threads == 4
+    # The process's own metrics directory, removed when it exits
+    assert server.app_config["METRICS_DIR"] == default_metrics_directory()
+
+    serve_app = server.load()
+    assert serve_app.config["DATABASE_PROFILE"] == "production"
+    assert isinstance(serve_app.wsgi_app, AdmissionControl)
+    assert serve_app.extensions[URL_TEMPLATES]
+    with serve_app.app_context():
+        assert get_ingredient_index().loaded
+        assert db.engine.pool.checkedin() == 0
+        assert read_engine().pool.checkedin() == 0
+
+    warm_connections(serve_app)
+    with serve_app.app_context():
+        assert db.engine.pool.checkedin() == 4
+        assert read_engine().pool.checkedin() == 16
+
+def test_synthetic_cookbook(tmp_path):
+    """
+    Tests the synthetic data generator and the benchmark report
+    """
+
+    from benchmarks.endpoints import RESOURCES, compare, run
+    from database.synthetic import SyntheticCookbook
+
+    book = SyntheticCookbook(users=5, recipes=50, ingredients=20, rows_per_recipe=4, seed=7)
+    report = run(tmp_path / "bench.db", book, requests=3, warmup=1)
+    assert report["rows"]["recipe"] == 50
+    assert report["rows"]["user"] == 5
+    assert set(report["results"]) == set(RESOURCES)
+    for result in report["results"].values():
+        assert result["errors"] == 0
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+
+    conn = sqlite3.connect(str(tmp_path / "bench.db"))
+    owners = [row[0] for row in conn.execute(
+        "SELECT count(*) FROM recipe GROUP BY user_id ORDER BY count(*) DESC"
+    )]
+    assert owners[0] > owners[-1]
+    # Every owner's recipe collection has moved on
+    assert conn.execute(
+        "SELECT count(*) FROM resource_version WHERE key IN "
+        "(SELECT DISTINCT 'user:' || user_id FROM recipe)"
+    ).fetchone()[0] == len(owners)
+    indexed = conn.execute(
+        "SELECT ingredients FROM recipe_search WHERE rowid = "
+        "(SELECT id FROM recipe WHERE name = 'Recipe-7-0')"
+    ).fetchone()[0]
+    assert indexed.startswith("Ingredient-7-")
+    conn.close()
+
+    slower = json.loads(json.dumps(report))
+    slower["results"]["recipeitem"]["p95_ms"] = report["results"]["recipeitem"]["p95_ms"] * 2
+    assert compare(report, report) == []
+    assert compare(report, slower)[0].startswith("recipeitem: p95")
+
+def test_populate_scale(fresh_client, tmp_path):
+    """
+    Tests populating with generated data over HTTP and from the CLI
+    """
+
+    response = fresh_client.post("/api/populate", json={"scale": 0.05, "seed": 3})
+    assert response.status_code == 201
+    assert response.json["rows"]["recipe"] == 50
+    assert fresh_client.get("/api/recipes/Recipe-3-49/").status_code == 200
+    assert fresh_client.post("/api/populate", json={"scale": 0.05, "seed": 3}).status_code == 409
+    assert fresh_client.post("/api/populate", json={"scale": -1}).status_code == 400
+    assert fresh_client.post("/api/populate", json={"scale": 1000}).status_code == 400
+    assert fresh_client.post("/api/populate").status_code == 409
+
+    # Splitting the recipes into transactions gives the same cookbook
+    lines = []
+    for name, per_transaction in [("one.db", 1000), ("many.db", 7)]:
+        cli_app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / name)})
+        result = cli_app.test_cli_runner().invoke(args=[
+            "populate", "--scale", "0.05", "--seed", "5",
+            "--recipes-per-transaction", str(per_transaction)
+        ])
+        assert "50 recipe rows" in result.output
+        lines.append(cli_app.test_cli_runner().invoke(args=["export"]).output)
+    assert lines[0] == lines[1]
+
+def test_server_timing(tmp_path, caplog):
+    """
+    Tests the Server-Timing header and the slow request and query logs
+    """
+
+    import logging
+
+    timed_app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "timing.db"),
+        "SLOW_QUERY_MS": 0,
+        "SLOW_REQUEST_MS": 0,
+    })
+    timed_client = timed_app.test_client()
+    timed_client.post("/api/populate")
+
+    with caplog.at_level(logging.WARNING, logger="database.timing"):
+        response = timed_client.get("/api/recipes/Cake-Recipe/")
+    metrics = {
+        part.split(";")[0]: part for part in response.headers["Server-Timing"].split(", ")
+    }
+    assert set(metrics) == {"db", "serialize", "app", "total"}
+    queries = int(metrics["db"].split('desc="')[1].split(" ")[0])
+    assert queries >= 2
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(m.startswith("Slow query in /api/recipes/Cake-Recipe/") for m in messages)
+    assert any(m.startswith("Slow query in recipeitem") and "recipeingredient.amount" in m for m in messages)
+    assert any(m.startswith("Slow request GET /api/recipes/Cake-Recipe/ (recipeitem, 200)") for m in messages)
+
+    timed_app.config["SERVER_TIMING"] = False
+    assert "Server-Timing" not in timed_client.get("/api/recipes/").headers
+
+def test_metrics(tmp_path):
+    """
+    Tests the Prometheus metrics, including values written by another
+    process
+    """
+
+    from database.metrics import Metrics, default_metrics_directory, get_metrics
+
+    metrics_app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "metrics.db"),
+        "METRICS_DIR": str(tmp_path / "metrics"),
+    })
+    metrics_client = metrics_app.test_client()
+    metrics_client.post("/api/populate")
+    metrics_client.get("/api/recipes/Cake-Recipe/")
+    metrics_client.get("/api/recipes/Cake-Recipe/")
+    metrics_client.get("/api/recipes/Nothing/")
+
+    with metrics_app.app_context():
+        metrics = get_metrics()
+    pid = os.fork()
+    if pid == 0:
+        metrics.inc("cookbook_requests_total", (("endpoint", "recipeitem"), ("method", "GET"), ("status", "200")), 3)
+        metrics.inc("cookbook_db_pool_checked_out", (("pool", "write"),), 5)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    response = metrics_client.get("/api/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    assert samples['cookbook_requests_total{endpoint="recipeitem",method="GET",status="200"}'] == 5
+    assert samples['cookbook_requests_total{endpoint="none",method="GET",status="404"}'] == 1
+    buckets = [
+        value for name, value in samples.items()
+        if name.startswith('cookbook_request_duration_seconds_bucket{endpoint="recipeitem",status="200"')
+    ]
+    assert buckets == sorted(buckets) and buckets[-1] == 2
+    assert samples['cookbook_request_duration_seconds_count{endpoint="recipeitem",status="200"}'] == 2
+    assert samples['cookbook_cache_hit_ratio{cache="response"}'] == 0.5
+    assert samples['cookbook_db_pool_checked_out{pool="write"}'] == 0
+    assert samples['cookbook_db_queries_total{endpoint="recipeitem"}'] > 0
+
+    # A process started later folds the files of exited ones into its own,
+    # keeping their counters but not their gauges
+    child = os.fork()
+    if child == 0:
+        metrics.inc("cookbook_requests_total", (("endpoint", "ingredients"), ("method", "GET"), ("status", "200")))
+        os._exit(0)
+    os.waitpid(child, 0)
+    files = os.listdir(str(tmp_path / "metrics"))
+    assert "metrics-{}.db".format(pid) not in files
+    assert "metrics-{}.db".format(child) in files
+    totals = metrics.collect()
+    key = ("cookbook_requests_total", (("endpoint", "recipeitem"), ("method", "GET"), ("status", "200")))
+    assert totals[key] == 5
+
+    # A new process that got the pid of an exited one keeps its counts
+    reused = Metrics(str(tmp_path / "reused"))
+    os.makedirs(reused.directory)
+    reused.inc("cookbook_requests_total")
+    Metrics(reused.directory).inc("cookbook_requests_total")
+    assert reused.collect()[("cookbook_requests_total", ())] == 2
+    assert default_metrics_directory() == default_metrics_directory()